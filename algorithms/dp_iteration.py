@@ -1,7 +1,12 @@
 import random
 import copy
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import ReinforcementLearning.algorithms.linear_solvers as linear_solvers
 import ReinforcementLearning.algorithms.policy as rl_policy
 import ReinforcementLearning.environments.attributes as env_attributes
+import ReinforcementLearning.environments.compiled_model as env_compiled_model
 
 class PolicyEvaluator:
     def __init__(self, environment,
@@ -9,31 +14,81 @@ class PolicyEvaluator:
                  minimum_change=0.01,
                  number_of_selections_per_state=1,  # Should be 1 for deterministic policies
                  maximum_number_of_iterations=1000,
-                 initial_value=0):
+                 initial_value=0,
+                 backend='dict',  # 'dict' or 'matrix'
+                 legal_actions_authority=None,  # For the 'matrix' backend: the actions to compile in each state. None: environment.ActionsSet()
+                 compiled_model=None,  # For the 'matrix' backend: a precompiled model of the environment
+                 method='sweeps',  # 'sweeps', 'direct', 'gmres', 'bicgstab' or 'exact'
+                 residual_tolerance=1e-10,  # For the 'gmres' and 'bicgstab' methods: the relative residual at which the iterations stop
+                 direct_solve_maximum_number_of_states=20000,  # For the 'exact' method: above this size, use 'gmres'
+                 krylov_maximum_number_of_iterations=1000,
+                 sweep='jacobi',  # 'jacobi' (synchronous) or 'gauss_seidel' (in place)
+                 state_ordering='natural'):  # For 'gauss_seidel': 'natural', 'reverse', 'terminal_distance' or a callable states_list -> ordered states_list
         """
         Implementation of policy evaluation, Cf. Reinforcement Learning, Sutton and Barto, p. 98
         It uses a private playground environment.
+        The 'matrix' backend compiles the environment once, builds P_pi and r_pi once per evaluated policy, and
+        computes each sweep as a sparse matrix-vector product. It uses the exact action probabilities of the policy,
+        so number_of_selections_per_state is ignored.
+        The methods other than 'sweeps' solve (I - gamma P_pi) v = r_pi on the compiled model, with a sparse direct solver
+        ('direct') or Jacobi-preconditioned Krylov iterations ('gmres', 'bicgstab'). 'exact' chooses between 'direct'
+        and 'gmres' according to the number of states.
+        Gauss-Seidel sweeps update the values in place, in the order given by state_ordering. 'terminal_distance' updates
+        the states closest to an absorbing state first, so that the terminal values propagate backward within one sweep.
         """
         if not isinstance(environment, env_attributes.DynamicProgramming):
             raise TypeError("PolicyEvaluator.__init__(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.DynamicProgramming".format(type(environment)))
+        if backend not in ['dict', 'matrix']:
+            raise ValueError("PolicyEvaluator.__init__(): Unknown backend '{}'. It should be 'dict' or 'matrix'".format(backend))
+        if method not in ['sweeps', 'direct', 'gmres', 'bicgstab', 'exact']:
+            raise ValueError("PolicyEvaluator.__init__(): Unknown method '{}'. It should be 'sweeps', 'direct', 'gmres', 'bicgstab' or 'exact'".format(method))
+        if sweep not in ['jacobi', 'gauss_seidel']:
+            raise ValueError("PolicyEvaluator.__init__(): Unknown sweep '{}'. It should be 'jacobi' or 'gauss_seidel'".format(sweep))
+        if not callable(state_ordering) and state_ordering not in ['natural', 'reverse', 'terminal_distance']:
+            raise ValueError("PolicyEvaluator.__init__(): Unknown state ordering '{}'. It should be 'natural', 'reverse', 'terminal_distance' or a callable".format(state_ordering))
         self.environment = copy.deepcopy(environment)  # Must implement StatesSet(), TransitionProbabilitiesAndRewards()
         self.gamma = gamma  # The discount factor
         self.minimum_change = minimum_change  # Equivalent of theta in the book
         self.number_of_selections_per_state = number_of_selections_per_state
         self.maximum_number_of_iterations = maximum_number_of_iterations
         self.initial_value = initial_value
+        self.backend = backend
+        self.legal_actions_authority = legal_actions_authority
+        self.compiled_model = compiled_model
+        self.method = method
+        self.residual_tolerance = residual_tolerance
+        self.direct_solve_maximum_number_of_states = direct_solve_maximum_number_of_states
+        self.krylov_maximum_number_of_iterations = krylov_maximum_number_of_iterations
+        self.sweep = sweep
+        self.state_ordering = state_ordering
+        self.ordered_states_list = None
 
-    def Evaluate(self, policy):
+    def Evaluate(self, policy, initial_state_to_value=None, maximum_number_of_iterations=None):
+        # initial_state_to_value: The values to start from, e.g. the previous evaluation (warm start). None: initial_value
+        # maximum_number_of_iterations: Overrides the maximum number of sweeps for this call, e.g. for truncated evaluations
+        if maximum_number_of_iterations is None:
+            maximum_number_of_iterations = self.maximum_number_of_iterations
+        if self.method != 'sweeps':
+            return self.EvaluateWithLinearSolve(policy, initial_state_to_value)
+        if self.backend == 'matrix':
+            return self.EvaluateWithMatrices(policy, initial_state_to_value, maximum_number_of_iterations)
         minimum_change_is_achieved = True
-        states_set = self.environment.StatesSet()
-        state_to_value_dict = {s: self.initial_value for s in states_set}
+        states_list = self.OrderedStates()
+        if initial_state_to_value is None:
+            state_to_value_dict = {s: self.initial_value for s in states_list}
+        else:
+            state_to_value_dict = {s: initial_state_to_value[s] for s in states_list}
         #state_to_value_dict = {s: random.random() for s in states_set}
         completed_iterations = 0
+        change = 0
         #average_value_exploded = False
-        while minimum_change_is_achieved and completed_iterations < self.maximum_number_of_iterations:
+        while minimum_change_is_achieved and completed_iterations < maximum_number_of_iterations:
             change = 0
-            updated_state_to_value_dict = copy.deepcopy(state_to_value_dict)
-            for state in states_set:
+            if self.sweep == 'gauss_seidel':  # The updated values are used as soon as they are available
+                updated_state_to_value_dict = state_to_value_dict
+            else:
+                updated_state_to_value_dict = dict(state_to_value_dict)
+            for state in states_list:
                 previous_value = state_to_value_dict[state]
                 average_value = 0
                 for selectionNdx in range(self.number_of_selections_per_state):  # More than 1, for non-deterministic policies
@@ -46,22 +101,126 @@ class PolicyEvaluator:
                 average_value = average_value/self.number_of_selections_per_state
                 updated_state_to_value_dict[state] = average_value
                 change = max(change, abs(previous_value - average_value))
-            state_to_value_dict = copy.deepcopy(updated_state_to_value_dict)
+            state_to_value_dict = updated_state_to_value_dict
             minimum_change_is_achieved = change >= self.minimum_change
             completed_iterations += 1
         return (state_to_value_dict, change, completed_iterations)
 
+    def OrderedStates(self):
+        # The order in which the states are updated in a sweep. It only matters for Gauss-Seidel sweeps.
+        if self.ordered_states_list is None:
+            states_list = env_compiled_model.SortedIfPossible(self.environment.StatesSet())
+            if self.state_ordering == 'natural':
+                self.ordered_states_list = states_list
+            elif self.state_ordering == 'reverse':
+                self.ordered_states_list = list(reversed(states_list))
+            elif self.state_ordering == 'terminal_distance':  # The states closest to an absorbing state first
+                model = self.CompiledModel()
+                distances_arr = model.TerminalDistances()
+                self.ordered_states_list = [model.states_list[stateNdx] for stateNdx in np.argsort(distances_arr, kind='stable')]
+            else:
+                self.ordered_states_list = list(self.state_ordering(states_list))
+                if len(self.ordered_states_list) != len(states_list) or set(self.ordered_states_list) != set(states_list):
+                    raise ValueError("PolicyEvaluator.OrderedStates(): The custom state ordering did not return a permutation of the states")
+        return self.ordered_states_list
+
+    def CompiledModel(self):
+        if self.compiled_model is None:
+            self.compiled_model = env_compiled_model.Compile(self.environment, self.legal_actions_authority)
+        return self.compiled_model
+
+    def EvaluateWithMatrices(self, policy, initial_state_to_value=None, maximum_number_of_iterations=None):
+        if maximum_number_of_iterations is None:
+            maximum_number_of_iterations = self.maximum_number_of_iterations
+        model = self.CompiledModel()
+        (P_pi, r_pi) = model.PolicyTransitionMatrixAndRewards(model.PolicyMatrix(policy))
+        values_arr = self.InitialValues(model, initial_state_to_value)
+        ordered_indices = [model.state_to_index[state] for state in self.OrderedStates()]
+        change = 0
+        completed_iterations = 0
+        minimum_change_is_achieved = True
+        while minimum_change_is_achieved and completed_iterations < maximum_number_of_iterations:
+            if self.sweep == 'gauss_seidel':
+                change = 0
+                for stateNdx in ordered_indices:
+                    row_start, row_end = P_pi.indptr[stateNdx], P_pi.indptr[stateNdx + 1]
+                    updated_value = r_pi[stateNdx] + self.gamma * (P_pi.data[row_start: row_end] @ values_arr[P_pi.indices[row_start: row_end]])
+                    change = max(change, abs(updated_value - values_arr[stateNdx]))
+                    values_arr[stateNdx] = updated_value
+                change = float(change)
+            else:
+                updated_values_arr = r_pi + self.gamma * (P_pi @ values_arr)
+                change = float(np.max(np.abs(updated_values_arr - values_arr), initial=0))
+                values_arr = updated_values_arr
+            minimum_change_is_achieved = change >= self.minimum_change
+            completed_iterations += 1
+        return (model.ValuesDict(values_arr), change, completed_iterations)
+
+    def InitialValues(self, model, initial_state_to_value):
+        if initial_state_to_value is None:
+            return np.full(model.NumberOfStates(), self.initial_value, dtype=float)
+        return model.ValuesArray(initial_state_to_value)
+
+    def EvaluateWithLinearSolve(self, policy, initial_state_to_value=None):
+        # Solves (I - gamma P_pi) v = r_pi. The returned change is the Bellman residual max|r_pi + gamma P_pi v - v|,
+        # and the completed iterations are the Krylov iterations (1 for the direct solve)
+        model = self.CompiledModel()
+        (P_pi, r_pi) = model.PolicyTransitionMatrixAndRewards(model.PolicyMatrix(policy))
+        number_of_states = model.NumberOfStates()
+        A = (scipy.sparse.identity(number_of_states, format='csr') - self.gamma * P_pi).tolil()
+        b = r_pi.copy()
+        if self.gamma == 1:
+            # Without discounting, the rows of the absorbing states are zero: pin their value to 0
+            absorbing_states_mask = np.isclose(P_pi.diagonal(), 1.0)
+            if np.any(r_pi[absorbing_states_mask] != 0):
+                raise ValueError("PolicyEvaluator.EvaluateWithLinearSolve(): With gamma = 1, an absorbing state has a non-zero reward: the values diverge")
+            for stateNdx in np.flatnonzero(absorbing_states_mask):
+                A.rows[stateNdx] = [stateNdx]
+                A.data[stateNdx] = [1.0]
+                b[stateNdx] = 0
+        A = A.tocsr()
+
+        method = self.method
+        if method == 'exact':
+            method = 'direct' if number_of_states <= self.direct_solve_maximum_number_of_states else 'gmres'
+        x0 = self.InitialValues(model, initial_state_to_value)  # The starting point of the Krylov iterations
+        if method == 'direct':
+            values_arr = scipy.sparse.linalg.spsolve(A.tocsc(), b)
+            completed_iterations = 1
+        elif method == 'gmres':
+            (values_arr, residual_norm, completed_iterations) = linear_solvers.GMRES(
+                A, b, x0=x0, preconditioner=linear_solvers.JacobiPreconditioner(A),
+                tolerance=self.residual_tolerance, maximum_number_of_iterations=self.krylov_maximum_number_of_iterations)
+        else:  # 'bicgstab'
+            (values_arr, residual_norm, completed_iterations) = linear_solvers.BiCGSTAB(
+                A, b, x0=x0, preconditioner=linear_solvers.JacobiPreconditioner(A),
+                tolerance=self.residual_tolerance, maximum_number_of_iterations=self.krylov_maximum_number_of_iterations)
+        if not np.all(np.isfinite(values_arr)):
+            raise ValueError("PolicyEvaluator.EvaluateWithLinearSolve(): The linear system is singular. With gamma = 1, the policy must reach an absorbing state from every state")
+        bellman_residual = float(np.max(np.abs(r_pi + self.gamma * (P_pi @ values_arr) - values_arr), initial=0))
+        return (model.ValuesDict(values_arr), bellman_residual, completed_iterations)
+
 
 class PolicyIterator:
     """
     Implementation of policy iteration, Cf. 'Reinforcement Learning', Sutton and Barto, p. 98
+    warm_start: Each evaluation starts from the values of the previous evaluation, instead of the evaluator's initial value
+    number_of_evaluation_sweeps: If not None, modified policy iteration: each evaluation is truncated to this number of
+        sweeps. Once an improvement leaves the policy unchanged, the next evaluation runs until convergence, and the policy
+        is stable if the following improvement leaves it unchanged again. Truncated evaluations are usually combined with
+        warm_start=True. Each truncation adds an improvement step, a pass over all the (state, action) pairs: when it costs
+        more than a few sweeps, as on Jack's car rental, a small number_of_evaluation_sweeps trades sweeps for wall time.
+    After IteratePolicy(), iteration_statistics holds one dictionary per iteration, with the number of evaluation sweeps,
+    the number of policy disagreements, and the maximum value change from the previous evaluation.
     """
     def __init__(self, environment,
                  policy_evaluator,
                  legal_actions_authority,
                  gamma=0.9,
                  maximum_number_of_iterations=100,
-                 print_steps=False):
+                 print_steps=False,
+                 warm_start=False,
+                 number_of_evaluation_sweeps=None):
         if not isinstance(environment, env_attributes.DynamicProgramming):
             raise TypeError("PolicyIterator.__init__(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.DynamicProgramming".format(type(environment)))
         self.environment = copy.deepcopy(environment)
@@ -70,6 +229,9 @@ class PolicyIterator:
         self.gamma = gamma
         self.maximum_number_of_iterations = maximum_number_of_iterations
         self.print_steps = print_steps
+        self.warm_start = warm_start
+        self.number_of_evaluation_sweeps = number_of_evaluation_sweeps
+        self.iteration_statistics = []
 
     def IteratePolicy(self):
         states_set = self.environment.StatesSet()
@@ -79,15 +241,24 @@ class PolicyIterator:
 
         policy_is_stable = False
         completed_iterations = 0
+        self.iteration_statistics = []
+        state_to_previous_value_dict = None
+        number_of_evaluation_sweeps = self.number_of_evaluation_sweeps
         while not policy_is_stable and completed_iterations < self.maximum_number_of_iterations:
-            (state_to_updated_value_dict, last_change_magnitude, evaluation_completed_iterations) = self.policy_evaluator.Evaluate(iterated_policy)
+            initial_state_to_value = state_to_previous_value_dict if self.warm_start else None
+            (state_to_updated_value_dict, last_change_magnitude, evaluation_completed_iterations) = self.policy_evaluator.Evaluate(
+                iterated_policy, initial_state_to_value=initial_state_to_value, maximum_number_of_iterations=number_of_evaluation_sweeps)
+            value_delta = None
+            if state_to_previous_value_dict is not None:
+                value_delta = max(abs(state_to_updated_value_dict[s] - state_to_previous_value_dict[s]) for s in states_set)
+            state_to_previous_value_dict = state_to_updated_value_dict
             if self.print_steps:
                 print("Evaluation {} completed.".format(completed_iterations + 1))
                 print("last_change_magnitude = {}; evaluation_completed_iterations = {}".format(last_change_magnitude, evaluation_completed_iterations))
             state_to_most_valuable_action = {}
             for state in states_set:
                 action_to_expected_value_dict = {}
-                legal_actions = self.legal_actions_authority.LegalActions(state)
+                legal_actions = self.legal_actions_authority.ImmutableLegalActions(state)
                 for candidate_action in legal_actions:
                     #self.environment.SetState(state)
                     new_state_to_probability_reward = self.environment.TransitionProbabilitiesAndRewards(state,
@@ -105,6 +276,16 @@ class PolicyIterator:
                     number_of_disagreements += 1
             if number_of_disagreements == 0:
                 policy_is_stable = True
+                if number_of_evaluation_sweeps is not None and last_change_magnitude >= self.policy_evaluator.minimum_change:
+                    # The truncated evaluation has not converged yet: evaluate the unchanged policy until convergence,
+                    # rather than alternating truncated evaluations with improvements that don't change it
+                    policy_is_stable = False
+                    number_of_evaluation_sweeps = None
+            else:
+                number_of_evaluation_sweeps = self.number_of_evaluation_sweeps
+            self.iteration_statistics.append({'evaluation_sweeps': evaluation_completed_iterations,
+                                              'number_of_disagreements': number_of_disagreements,
+                                              'value_delta': value_delta})
 
             if self.print_steps:
                 print ("policy_is_stable = {}; number_of_disagreements = {}".format(policy_is_stable, number_of_disagreements))
@@ -136,16 +317,35 @@ class ValueIterator:
                  legal_actions_authority,
                  gamma,
                  minimum_change,
-                 maximum_number_of_iterations):
+                 maximum_number_of_iterations,
+                 backend='dict',  # 'dict', 'matrix' or 'specialized'
+                 compiled_model=None):  # For the 'matrix' backend: a precompiled model of the environment
+        """
+        Implementation of value iteration, Cf. 'Reinforcement Learning', Sutton and Barto
+        The 'dict' backend updates the values in place, summing over the successors of each (state, action) pair.
+        The 'matrix' backend applies the max-over-actions Bellman operator to the whole compiled model at each sweep.
+        The 'specialized' backend uses the environment's IterateValues() kernel, or the 'matrix' backend if it has none.
+        After Iterate(), the final values are in state_to_value.
+        """
         if not isinstance(environment, env_attributes.DynamicProgramming):
             raise TypeError("ValueIterator.__init__(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.DynamicProgramming".format(type(environment)))
+        if backend not in ['dict', 'matrix', 'specialized']:
+            raise ValueError("ValueIterator.__init__(): Unknown backend '{}'. It should be 'dict', 'matrix' or 'specialized'".format(backend))
         self.environment = copy.deepcopy(environment)
         self.legal_actions_authority = legal_actions_authority
         self.gamma = gamma
         self.minimum_change = minimum_change
         self.maximum_number_of_iterations = maximum_number_of_iterations
+        self.backend = backend
+        self.compiled_model = compiled_model
+        self.state_to_value = None
+        self.completed_iterations = 0
 
     def Iterate(self):
+        if self.backend == 'matrix':
+            return self.IterateWithMatrices()
+        if self.backend == 'specialized':
+            return self.IterateWithEnvironmentKernel()
         states_set = self.environment.StatesSet()
         actions_set = self.environment.ActionsSet()
         state_to_value = {s: 0 for s in states_set}
@@ -158,12 +358,11 @@ class ValueIterator:
                 previous_value = state_to_value[origin_state]
                 max_value = float('-inf')
                 most_valuable_action = None
-                for candidate_action in self.legal_actions_authority.LegalActions(origin_state):
+                for candidate_action in self.legal_actions_authority.ImmutableLegalActions(origin_state):
                     #self.environment.SetState(origin_state)
                     newState_to_probabilityReward = self.environment.TransitionProbabilitiesAndRewards(origin_state, candidate_action)
-                    candidate_value = sum(newState_to_probabilityReward.get(new_state, (0, 0))[0] *
-                                          (newState_to_probabilityReward.get(new_state, (0, 0))[1] +
-                                           self.gamma * state_to_value[new_state]) for new_state in states_set)
+                    candidate_value = sum(probability * (reward + self.gamma * state_to_value[new_state])
+                                          for (new_state, (probability, reward)) in newState_to_probabilityReward.items())
                     if candidate_value > max_value:
                         max_value = candidate_value
                         most_valuable_action = candidate_action
@@ -174,6 +373,44 @@ class ValueIterator:
                 if delta_value > self.minimum_change:
                     evaluation_is_stable = False
             completed_iterations += 1
+        self.state_to_value = state_to_value
+        self.completed_iterations = completed_iterations
+        # Return a greedy deterministic policy
+        return rl_policy.Greedy(state_to_most_valuable_action, self.legal_actions_authority)
+
+    def CompiledModel(self):
+        if self.compiled_model is None:
+            self.compiled_model = env_compiled_model.Compile(self.environment, self.legal_actions_authority)
+        return self.compiled_model
+
+    def IterateWithMatrices(self):
+        model = self.CompiledModel()
+        has_legal_actions_arr = np.any(model.legal_actions_mask, axis=1)
+        values_arr = np.zeros(model.NumberOfStates(), dtype=float)
+        action_values_arr = model.ActionValues(values_arr, self.gamma)
+        evaluation_is_stable = False
+        completed_iterations = 0
+        while not evaluation_is_stable and completed_iterations < self.maximum_number_of_iterations:
+            action_values_arr = model.ActionValues(values_arr, self.gamma)
+            updated_values_arr = np.where(has_legal_actions_arr, np.max(action_values_arr, axis=1), 0)
+            evaluation_is_stable = not np.any(np.abs(updated_values_arr - values_arr) > self.minimum_change)
+            values_arr = updated_values_arr
+            completed_iterations += 1
+        most_valuable_action_indices = np.argmax(action_values_arr, axis=1)
+        state_to_most_valuable_action = {}
+        for stateNdx, state in enumerate(model.states_list):
+            state_to_most_valuable_action[state] = model.actions_list[most_valuable_action_indices[stateNdx]] if has_legal_actions_arr[stateNdx] else None
+        self.state_to_value = model.ValuesDict(values_arr)
+        self.completed_iterations = completed_iterations
+        # Return a greedy deterministic policy
+        return rl_policy.Greedy(state_to_most_valuable_action, self.legal_actions_authority)
+
+    def IterateWithEnvironmentKernel(self):
+        kernel_result = self.environment.IterateValues(self.gamma, self.minimum_change, self.maximum_number_of_iterations,
+                                                       self.legal_actions_authority)
+        if kernel_result is None:  # No kernel for this environment and authority
+            return self.IterateWithMatrices()
+        (self.state_to_value, state_to_most_valuable_action, self.completed_iterations) = kernel_result
         # Return a greedy deterministic policy
         return rl_policy.Greedy(state_to_most_valuable_action, self.legal_actions_authority)
 
@@ -195,7 +432,7 @@ class EpsilonGreedy(rl_policy.Policy):
 
 
     def ActionProbabilities(self, state):
-        legal_actions_set = self.legal_actions_authority.LegalActions(state)
+        legal_actions_set = self.legal_actions_authority.ImmutableLegalActions(state)
         if len(legal_actions_set) == 0:
             return {}
         action_to_probability_dict = {}
@@ -15,6 +15,7 @@ parser.add_argument('--gamma', help="The discount factor. Default: 0.9", type=fl
 parser.add_argument('--numberOfIterations', help="The number of iterations. Default: 100", type=int, default=100)
 parser.add_argument('--initialValue', help="The initial value for all states. Default: 0", type=float, default=0)
 parser.add_argument('--episodeMaximumLength', help="The episode maximum length. Default: 100", type=int, default=100)
+parser.add_argument('--numberOfProcesses', help="If specified, the episodes are generated in batches by this number of processes, seeded from --randomSeed. Default: None", type=int, default=None)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s [%(levelname)s] %(message)s')
@@ -47,7 +48,9 @@ def main():
         gamma=args.gamma,
         number_of_iterations=args.numberOfIterations,
         initial_value=args.initialValue,
-        episode_maximum_length=args.episodeMaximumLength
+        episode_maximum_length=args.episodeMaximumLength,
+        number_of_processes=args.numberOfProcesses,
+        random_seed=args.randomSeed
     )
     logging.info("Starting iteration...")
     policy = policy_iterator.IteratePolicy()
@@ -16,6 +16,7 @@ parser.add_argument('--epsilon', help='The probability of selecting randomly, fo
 parser.add_argument('--gamma', help="The discount factor. Default: 1.0", type=float, default=1.0)
 parser.add_argument('--numberOfIterations', help="The number of iterations. Default: 100", type=int, default=100)
 parser.add_argument('--episodeMaximumLength', help="The episode maximum length. Default: 100", type=int, default=100)
+parser.add_argument('--importanceSampling', help="The importance sampling: 'weighted', 'per_decision' or 'discounting_aware'. Default: 'weighted'", default='weighted')
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s [%(levelname)s] %(message)s')
@@ -47,7 +48,8 @@ def main():
         legal_actions_authority=legal_actions_authority,
         gamma=args.gamma,
         number_of_iterations=args.numberOfIterations,
-        episode_maximum_length=args.episodeMaximumLength
+        episode_maximum_length=args.episodeMaximumLength,
+        importance_sampling=args.importanceSampling
     )
     # Create the arbitrary epsilon-soft policy that will generate episodes
     states_set = environment.StatesSet()
@@ -55,7 +57,8 @@ def main():
     stateAction_to_value = {(state, action): np.random.normal()
                             for state in states_set
                             for action in actions_set}
-    epsilon_soft_policy = rl_policy.EpsilonGreedy(args.epsilon, stateAction_to_value)
+    # The behavior policy doesn't change during the iteration: tabulate it for fast selection
+    epsilon_soft_policy = rl_policy.TabularPolicy.FromEpsilonGreedy(rl_policy.EpsilonGreedy(args.epsilon, stateAction_to_value))
     logging.info("Starting iteration...")
     policy = policy_iterator.IteratePolicy(epsilon_soft_policy)
     logging.info("Done!")
@@ -21,6 +21,10 @@ parser.add_argument('--minimumChange', help="The minimum value change to keep it
 parser.add_argument('--numberOfIterations', help="The number of iterations. Default: 100", type=int, default=100)
 parser.add_argument('--initialValue', help="The initial value for all states. Default: 0", type=float, default=0)
 parser.add_argument('--episodeMaximumLength', help="The episode maximum length. Default: 100", type=int, default=100)
+parser.add_argument('--stepSize', help="The constant step size of the value updates. Default: None (average the returns)", type=float, default=None)
+parser.add_argument('--confidenceIntervalWidth', help="If specified, stop when the confidence intervals of the visited states are narrower than this width. Default: None", type=float, default=None)
+parser.add_argument('--confidenceLevel', help="The confidence level of the intervals. Default: 0.95", type=float, default=0.95)
+parser.add_argument('--numberOfProcesses', help="If specified, the episodes are generated in batches by this number of processes, seeded from --randomSeed. Default: None", type=int, default=None)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s [%(levelname)s] %(message)s')
@@ -61,11 +65,17 @@ def main():
         gamma=args.gamma,
         number_of_iterations=args.numberOfIterations,
         initial_value=args.initialValue,
-        episode_maximum_length=args.episodeMaximumLength
+        episode_maximum_length=args.episodeMaximumLength,
+        step_size=args.stepSize,
+        number_of_processes=args.numberOfProcesses,
+        random_seed=args.randomSeed
     )
     logging.info("Starting evaluation...")
-    state_to_value_dict = policy_evaluator.Evaluate(evaluated_policy, print_iteration=True)
-    logging.info("Done!")
+    (state_to_value_dict, state_to_half_width_dict, completed_iterations) = policy_evaluator.EvaluateWithConfidenceIntervals(
+        evaluated_policy, confidence_interval_width=args.confidenceIntervalWidth, confidence_level=args.confidenceLevel,
+        print_iteration=True)
+    logging.info("Done! completed_iterations = {}; maximum confidence interval half-width = {}".format(
+        completed_iterations, max(state_to_half_width_dict.values())))
     print ("state_to_value_dict = \n{}".format(state_to_value_dict))
 
     WriteOutput(args.environment, args.policy, environment, state_to_value_dict)
@@ -18,6 +18,8 @@ parser.add_argument('--minimumChange', help="The minimum value change to keep it
 parser.add_argument('--numberOfSelectionsPerState', help="The number of tried selections per state. Should be 1 if the policy and the environment are deterministic. Default: 100", type=int, default=100)
 parser.add_argument('--maximumNumberOfIterations', help="The maximum number of iterations. Default: 1000", type=int, default=1000)
 parser.add_argument('--initialValue', help="The initial value for all states. Default: 0", type=float, default=0)
+parser.add_argument('--backend', help="The evaluator backend: 'dict' or 'matrix'. Default: 'dict'", default='dict')
+parser.add_argument('--method', help="The evaluation method: 'sweeps', 'direct', 'gmres', 'bicgstab' or 'exact'. Default: 'sweeps'", default='sweeps')
 parser.add_argument('--epsilon', help="For epsilon-greedy policies, the probability of choosing a random action. Default: 0.1", type=float, default=0.1)
 args = parser.parse_args()
 
@@ -82,7 +84,10 @@ def main():
                                               minimum_change=args.minimumChange,
                                               number_of_selections_per_state=args.numberOfSelectionsPerState,
                                               maximum_number_of_iterations=args.maximumNumberOfIterations,
-                                              initial_value=args.initialValue
+                                              initial_value=args.initialValue,
+                                              backend=args.backend,
+                                              method=args.method,
+                                              legal_actions_authority=legal_actions_authority
                                               )
 
     # Evaluation
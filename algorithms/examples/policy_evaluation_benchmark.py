@@ -0,0 +1,73 @@
+import logging
+import argparse
+import ReinforcementLearning.algorithms.policy as rl_policy
+import ReinforcementLearning.algorithms.dp_iteration as dp_iteration
+from ReinforcementLearning.environments import gridworlds
+from ReinforcementLearning.environments import gamblers_problem
+from ReinforcementLearning.environments import frozen_lake
+import random
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--randomSeed', help="The seed for the random module. Default: 0", type=int, default=0)
+parser.add_argument('--environments', help="The comma-separated list of environments. Default: 'gridworld1,gridworld2x2,frozenlake4x4,frozenlake8x8,gamblersproblem'", default='gridworld1,gridworld2x2,frozenlake4x4,frozenlake8x8,gamblersproblem')
+parser.add_argument('--gamma', help="The discount factor. The Gambler's problem always uses 1.0. Default: 0.9", type=float, default=0.9)
+parser.add_argument('--minimumChange', help="The minimum value change to keep iterating. Default: 0.0001", type=float, default=0.0001)
+parser.add_argument('--maximumNumberOfIterations', help="The maximum number of sweeps. Default: 10000", type=int, default=10000)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s [%(levelname)s] %(message)s')
+
+
+def main():
+    logging.info("policy_evaluation_benchmark.py main()")
+    sweep_state_ordering_list = [('jacobi', 'natural'), ('gauss_seidel', 'natural'), ('gauss_seidel', 'reverse'),
+                                 ('gauss_seidel', 'terminal_distance')]
+    print("{:<20}{:<15}{:<20}{:>10}{:>15}{:>20}".format("environment", "sweep", "state_ordering", "sweeps", "seconds", "max |v - v_exact|"))
+    for environment_name in args.environments.split(','):
+        (environment, legal_actions_authority, gamma) = CreateEnvironment(environment_name)
+        random.seed(args.randomSeed)
+        states_list = sorted(environment.StatesSet())
+        policy = rl_policy.Greedy({s: random.choice(sorted(legal_actions_authority.LegalActions(s))) for s in states_list},
+                                  legal_actions_authority)
+        exact_evaluator = dp_iteration.PolicyEvaluator(environment, gamma=gamma, method='exact',
+                                                       legal_actions_authority=legal_actions_authority)
+        (exact_state_to_value, _, _) = exact_evaluator.Evaluate(policy)
+        for (sweep, state_ordering) in sweep_state_ordering_list:
+            policy_evaluator = dp_iteration.PolicyEvaluator(environment,
+                                                            gamma=gamma,
+                                                            minimum_change=args.minimumChange,
+                                                            number_of_selections_per_state=1,
+                                                            maximum_number_of_iterations=args.maximumNumberOfIterations,
+                                                            legal_actions_authority=legal_actions_authority,
+                                                            sweep=sweep,
+                                                            state_ordering=state_ordering)
+            policy_evaluator.OrderedStates()  # Exclude the ordering computation from the timing
+            policy_evaluator.environment = exact_evaluator.environment  # Reuse the cached transitions
+            start_time = time.time()
+            (state_to_value, change, completed_iterations) = policy_evaluator.Evaluate(policy)
+            elapsed_time = time.time() - start_time
+            maximum_error = max(abs(state_to_value[s] - exact_state_to_value[s]) for s in states_list)
+            print("{:<20}{:<15}{:<20}{:>10}{:>15.4f}{:>20.2e}".format(environment_name, sweep, state_ordering,
+                                                                      completed_iterations, elapsed_time, maximum_error))
+
+
+def CreateEnvironment(environment_name):
+    if environment_name.lower() == 'gridworld1':
+        environment = gridworlds.GridWorld1()
+    elif environment_name.lower() == 'gridworld2x2':
+        environment = gridworlds.GridWorld2x2()
+    elif environment_name.lower() == 'frozenlake4x4':
+        environment = frozen_lake.FrozenLake(size='4x4')
+    elif environment_name.lower() == 'frozenlake8x8':
+        environment = frozen_lake.FrozenLake(size='8x8')
+    elif environment_name.lower() == 'gamblersproblem':
+        environment = gamblers_problem.GamblersProblem(heads_probability=0.4)
+        return (environment, gamblers_problem.GamblersPossibleStakes(), 1.0)
+    else:
+        raise NotImplementedError("CreateEnvironment(): Not implemented environment '{}'".format(environment_name))
+    return (environment, rl_policy.AllActionsLegalAuthority(environment.ActionsSet()), args.gamma)
+
+
+if __name__ == '__main__':
+    main()
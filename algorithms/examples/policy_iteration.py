@@ -7,7 +7,10 @@ from ReinforcementLearning.environments import gridworlds
 from ReinforcementLearning.environments import jacks_car_rental
 from ReinforcementLearning.environments import gamblers_problem
 from ReinforcementLearning.environments import frozen_lake
+from ReinforcementLearning.environments import compiled_model
+from ReinforcementLearning.environments import model_cache
 import random
+import time
 import numpy as np
 
 parser = argparse.ArgumentParser()
@@ -19,7 +22,13 @@ parser.add_argument('--minimumChange', help="For the evaluator, the minimum valu
 #parser.add_argument('--numberOfSelectionsPerState', help="For the evaluator, the number of tried selections per state. Should be 1 if the policy and the environment are deterministic. Default: 100", type=int, default=100)
 parser.add_argument('--evaluatorMaximumNumberOfIterations', help="For the evaluator, the maximum number of iterations. Default: 1000", type=int, default=1000)
 parser.add_argument('--initialValue', help="The initial value for all states. Default: 0", type=float, default=0)
+parser.add_argument('--evaluatorBackend', help="For the evaluator, the backend: 'dict' or 'matrix'. Default: 'dict'", default='dict')
+parser.add_argument('--evaluationMethod', help="For the evaluator, the method: 'sweeps', 'direct', 'gmres', 'bicgstab' or 'exact'. Default: 'sweeps'", default='sweeps')
 parser.add_argument('--iteratorMaximumNumberOfIterations', help="For the policy iterator, the maximum number of iterations. Default: 100", type=int, default=100)
+parser.add_argument('--warmStart', help="Start each evaluation from the previous values", action='store_true')
+parser.add_argument('--numberOfEvaluationSweeps', help="For modified policy iteration, the number of evaluation sweeps per improvement. Default: None (evaluate until convergence)", type=int, default=None)
+parser.add_argument('--modelCacheDirectory', help="If set, the directory of the on-disk cache of compiled models, used by the 'matrix' backend and the linear solve methods. Default: None (compile in memory)", default=None)
+parser.add_argument('--numberOfProcesses', help="If set, the number of worker processes that precompute the transition model. Default: None (lazy computation)", type=int, default=None)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s [%(levelname)s] %(message)s')
@@ -60,13 +69,27 @@ def main():
     else:
         raise NotImplementedError("main(): Not implemented legal actions authority '{}'".format(args.legalActionsAuthority))
 
+    if args.numberOfProcesses is not None:
+        logging.info("Precomputing the transition model with {} processes...".format(args.numberOfProcesses))
+        compiled_model.PrecomputeTransitions(environment, legal_actions_authority, args.numberOfProcesses)
+
+    environment_compiled_model = None
+    if args.modelCacheDirectory is not None:
+        start_time = time.time()
+        environment_compiled_model = model_cache.ModelCache(args.modelCacheDirectory).CompiledModel(environment, legal_actions_authority)
+        logging.info("Compiled model loaded or built in {:.3f} s".format(time.time() - start_time))
+
     # Create the policy evaluator
     policy_evaluator = dp_iteration.PolicyEvaluator(environment=environment,
                                               gamma=args.gamma,
                                               minimum_change=args.minimumChange,
                                               number_of_selections_per_state=1,  # The evaluated policy in the PolicyIterator loop is Greedy, and therefore deterministic
                                               maximum_number_of_iterations=args.evaluatorMaximumNumberOfIterations,
-                                              initial_value=args.initialValue
+                                              initial_value=args.initialValue,
+                                              backend=args.evaluatorBackend,
+                                              method=args.evaluationMethod,
+                                              legal_actions_authority=legal_actions_authority,
+                                              compiled_model=environment_compiled_model
                                               )
 
     # Create the policy iterator
@@ -79,12 +102,15 @@ def main():
          #initial_value=args.initialValue,
          #number_of_trials_per_action=args.numberOfTrialsPerAction,
          maximum_number_of_iterations=args.iteratorMaximumNumberOfIterations,
-         print_steps=True
+         print_steps=True,
+         warm_start=args.warmStart,
+         number_of_evaluation_sweeps=args.numberOfEvaluationSweeps
     )
 
     # Iterate the policy
     policy, policy_state_to_actions_probabilities, policy_state_to_most_valuable_action = policy_iterator.IteratePolicy()
 
+    logging.info("Total number of evaluation sweeps: {}".format(sum(statistics['evaluation_sweeps'] for statistics in policy_iterator.iteration_statistics)))
     #print("policy_state_to_actions_probabilities =\n{}".format(policy_state_to_actions_probabilities))
     print ("policy_state_to_most_valuable_action = \n{}".format(policy_state_to_most_valuable_action))
 
@@ -17,6 +17,11 @@ parser.add_argument('--legalActionsAuthority', help="The authority that filters
 parser.add_argument('--gamma', help="The discount factor. Default: 0.9", type=float, default=0.9)
 parser.add_argument('--minimumChange', help="For the value iterator, the minimum value change to keep iterating. Default: 0.01", type=float, default=0.01)
 parser.add_argument('--maximumNumberOfIterations', help="For the value iterator, the maximum number of iterations. Default: 1000", type=int, default=1000)
+parser.add_argument('--gridWidth', help="For the 'gridworld' environment, the width of the grid. Default: 5", type=int, default=5)
+parser.add_argument('--gridHeight', help="For the 'gridworld' environment, the height of the grid. Default: 5", type=int, default=5)
+parser.add_argument('--slipProbability', help="For the 'gridworld' environment, the probability to slip perpendicularly to the selected direction. Default: 0", type=float, default=0)
+parser.add_argument('--goal', help="For the 'gamblersproblem' environment, the capital to reach, at most 10^5: the value iteration sweeps are quadratic in the goal. Default: 100", type=int, default=100)
+parser.add_argument('--backend', help="For the value iterator, the backend: 'dict', 'matrix' or 'specialized'. Default: 'dict'", default='dict')
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s [%(levelname)s] %(message)s')
@@ -33,12 +38,16 @@ def main():
         environment = gridworlds.GridWorld1()
     elif args.environment.lower() == 'gridworld2x2':
         environment = gridworlds.GridWorld2x2()
+    elif args.environment.lower() == 'gridworld':  # GridWorld1's teleports, on a grid of arbitrary size
+        environment = gridworlds.GridWorld(width=args.gridWidth, height=args.gridHeight,
+                                           teleports={(0, 1): ((args.gridHeight - 1, 1), 10.), (0, 3): ((2, 3), 5.)},
+                                           slip_probability=args.slipProbability)
     elif args.environment.lower() == 'jackscarrental':
         environment = jacks_car_rental.JacksCarRental('original')
     elif args.environment.lower() == 'jackscarrental4.4':
         environment = jacks_car_rental.JacksCarRental('exercise_4.4')
     elif args.environment.lower() == 'gamblersproblem':
-        environment = gamblers_problem.GamblersProblem(heads_probability=0.4)
+        environment = gamblers_problem.GamblersProblem(heads_probability=0.4, goal=args.goal)
     elif args.environment.lower() == 'frozenlake4x4':
         environment = frozen_lake.FrozenLake(size='4x4')
     elif args.environment.lower() == 'frozenlake8x8':
@@ -54,7 +63,7 @@ def main():
     elif args.legalActionsAuthority.lower() == 'jackspossiblemoves':
         legal_actions_authority = jacks_car_rental.JacksPossibleMoves()
     elif args.legalActionsAuthority.lower() == 'gamblerspossiblestakes':
-        legal_actions_authority = gamblers_problem.GamblersPossibleStakes()
+        legal_actions_authority = gamblers_problem.GamblersPossibleStakes(goal=args.goal)
     else:
         raise NotImplementedError(
             "main(): Not implemented legal actions authority '{}'".format(args.legalActionsAuthority))
@@ -65,14 +74,17 @@ def main():
         legal_actions_authority=legal_actions_authority,
         gamma=args.gamma,
         minimum_change = args.minimumChange,
-        maximum_number_of_iterations = args.maximumNumberOfIterations
+        maximum_number_of_iterations = args.maximumNumberOfIterations,
+        backend=args.backend
     )
 
     # Iterate value
     logging.info("Starting value iteration...")
     policy = value_iterator.Iterate()
     logging.info("Done!")
+    logging.info("completed_iterations = {}".format(value_iterator.completed_iterations))
     logging.info("policy.state_to_most_valuable_action = \n{}".format(policy.state_to_most_valuable_action))
+    logging.info("value_iterator.state_to_value = \n{}".format(value_iterator.state_to_value))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,124 @@
+import numpy as np
+
+
+def JacobiPreconditioner(A):
+    """
+    Returns the function z -> D^-1 z, where D is the diagonal of the sparse matrix A
+    """
+    diagonal_arr = np.asarray(A.diagonal(), dtype=float)
+    if np.any(diagonal_arr == 0):
+        raise ValueError("linear_solvers.JacobiPreconditioner(): The diagonal of the matrix has zero entries")
+    inverse_diagonal_arr = 1.0/diagonal_arr
+    return lambda z: inverse_diagonal_arr * z
+
+
+def GMRES(A, b, x0=None, preconditioner=None, tolerance=1e-10, restart=30, maximum_number_of_iterations=1000):
+    """
+    Restarted GMRES(m) with right preconditioning, Cf. 'Iterative Methods for Sparse Linear Systems', Saad, p. 284
+    A: Matrix or object supporting A @ x
+    preconditioner: Function z -> M^-1 z. None: no preconditioning
+    tolerance: The relative residual ||b - A x|| / ||b|| at which the iterations stop
+    Returns (x, residual_norm, completed_iterations)
+    """
+    b = np.asarray(b, dtype=float)
+    if preconditioner is None:
+        preconditioner = lambda z: z
+    x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=float)
+    b_norm = np.linalg.norm(b)
+    if b_norm == 0:
+        b_norm = 1.0
+    residual_arr = b - A @ x
+    residual_norm = np.linalg.norm(residual_arr)
+    completed_iterations = 0
+    while residual_norm / b_norm > tolerance and completed_iterations < maximum_number_of_iterations:
+        V = np.zeros((restart + 1, len(b)), dtype=float)  # Orthonormal basis of the Krylov subspace
+        Z = np.zeros((restart, len(b)), dtype=float)  # Preconditioned basis vectors
+        H = np.zeros((restart + 1, restart), dtype=float)  # Hessenberg matrix, reduced to triangular by Givens rotations
+        cosines = np.zeros(restart, dtype=float)
+        sines = np.zeros(restart, dtype=float)
+        g = np.zeros(restart + 1, dtype=float)
+        g[0] = residual_norm
+        V[0] = residual_arr / residual_norm
+        basis_size = restart
+        for j in range(restart):
+            Z[j] = preconditioner(V[j])
+            w = A @ Z[j]
+            for i in range(j + 1):  # Modified Gram-Schmidt
+                H[i, j] = w @ V[i]
+                w = w - H[i, j] * V[i]
+            H[j + 1, j] = np.linalg.norm(w)
+            happy_breakdown = H[j + 1, j] <= 1e-14 * b_norm
+            if not happy_breakdown:
+                V[j + 1] = w / H[j + 1, j]
+            for i in range(j):  # Apply the previous rotations to the new column
+                (H[i, j], H[i + 1, j]) = (cosines[i] * H[i, j] + sines[i] * H[i + 1, j],
+                                          -sines[i] * H[i, j] + cosines[i] * H[i + 1, j])
+            denominator = np.hypot(H[j, j], H[j + 1, j])
+            cosines[j] = H[j, j] / denominator
+            sines[j] = H[j + 1, j] / denominator
+            H[j, j] = denominator
+            H[j + 1, j] = 0
+            g[j + 1] = -sines[j] * g[j]
+            g[j] = cosines[j] * g[j]
+            completed_iterations += 1
+            if happy_breakdown or abs(g[j + 1]) / b_norm <= tolerance or completed_iterations >= maximum_number_of_iterations:
+                basis_size = j + 1
+                break
+        y = np.linalg.solve(H[:basis_size, :basis_size], g[:basis_size])
+        x = x + Z[:basis_size].T @ y
+        residual_arr = b - A @ x
+        residual_norm = np.linalg.norm(residual_arr)
+    return (x, residual_norm, completed_iterations)
+
+
+def BiCGSTAB(A, b, x0=None, preconditioner=None, tolerance=1e-10, maximum_number_of_iterations=1000):
+    """
+    Right-preconditioned BiCGSTAB, Cf. 'Iterative Methods for Sparse Linear Systems', Saad, p. 246
+    A: Matrix or object supporting A @ x
+    preconditioner: Function z -> M^-1 z. None: no preconditioning
+    tolerance: The relative residual ||b - A x|| / ||b|| at which the iterations stop
+    Returns (x, residual_norm, completed_iterations)
+    """
+    b = np.asarray(b, dtype=float)
+    if preconditioner is None:
+        preconditioner = lambda z: z
+    x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=float)
+    b_norm = np.linalg.norm(b)
+    if b_norm == 0:
+        b_norm = 1.0
+    residual_arr = b - A @ x
+    shadow_residual_arr = residual_arr.copy()
+    rho = alpha = omega = 1.0
+    v = np.zeros_like(b)
+    p = np.zeros_like(b)
+    completed_iterations = 0
+    while np.linalg.norm(residual_arr) / b_norm > tolerance and completed_iterations < maximum_number_of_iterations:
+        new_rho = shadow_residual_arr @ residual_arr
+        if new_rho == 0:  # Breakdown: restart from the current residual
+            shadow_residual_arr = residual_arr.copy()
+            new_rho = shadow_residual_arr @ residual_arr
+            p = np.zeros_like(b)
+            v = np.zeros_like(b)
+            rho = alpha = omega = 1.0
+        beta = (new_rho / rho) * (alpha / omega)
+        p = residual_arr + beta * (p - omega * v)
+        p_hat = preconditioner(p)
+        v = A @ p_hat
+        alpha = new_rho / (shadow_residual_arr @ v)
+        s = residual_arr - alpha * v
+        completed_iterations += 1
+        if np.linalg.norm(s) / b_norm <= tolerance:
+            x = x + alpha * p_hat
+            residual_arr = s
+            break
+        s_hat = preconditioner(s)
+        t = A @ s_hat
+        t_norm_squared = t @ t
+        omega = (t @ s) / t_norm_squared if t_norm_squared > 0 else 0.0
+        x = x + alpha * p_hat + omega * s_hat
+        residual_arr = s - omega * t
+        rho = new_rho
+        if omega == 0:
+            break
+    residual_norm = np.linalg.norm(b - A @ x)
+    return (x, residual_norm, completed_iterations)
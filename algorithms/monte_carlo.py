@@ -1,11 +1,16 @@
 import random
 import copy
-import statistics
+import contextlib
+import multiprocessing
 import ReinforcementLearning.environments.attributes as env_attributes
+import ReinforcementLearning.environments.compiled_model as env_compiled_model
 import ReinforcementLearning.algorithms.policy as rl_policy
 import ReinforcementLearning.utilities.rewards as rewards
+import ReinforcementLearning.utilities.episode_returns as episode_returns
 import numpy as np
 
+CONFIDENCE_CHECK_PERIOD = 100  # The number of episodes between the checks of the confidence intervals widths
+
 
 class FirstVisitPolicyEvaluator:
     """
@@ -16,14 +21,29 @@ class FirstVisitPolicyEvaluator:
         state
         step(action) -> observation, reward, done, info
         Episode(policy, maximum_number_of_steps) -> observationActionReward_list
+        Trajectory(policy, maximum_number_of_steps, state_index) -> Trajectory, if use_trajectories
     Policy interface:
         Select(state)
+    number_of_processes: None to generate the episodes one after another. Otherwise, the episodes are generated in batches of
+        number_of_episodes_per_batch episodes by a pool of processes, each batch with its own seed derived from random_seed, and
+        the first-visit return sums of the batches are merged in the batch order: the result doesn't depend on the number of processes.
+    use_trajectories: Record the episodes with Episodic.Trajectory(), as arrays of state indices, and find the first visits
+        and their returns with array operations. The default, Episode() lists, is faster for short episodes such as Blackjack's.
+    With sample averages (step_size=None), the environments that simulate batches of episodes, like
+    blackjack.BufferedBlackjackES, return the first-visit return sums of whole blocks of episodes (Cf.
+    Episodic.FirstVisitReturnSums()). With a confidence_interval_width, the confidence intervals are checked after each block,
+    and the blocks double from CONFIDENCE_CHECK_PERIOD episodes, so that the evaluation overshoots by less than its length.
     """
     def __init__(self, environment,
                  gamma=0.9,
                  number_of_iterations=1000,
                  initial_value=0,
-                 episode_maximum_length=1000):
+                 episode_maximum_length=1000,
+                 step_size=None,
+                 number_of_processes=None,
+                 number_of_episodes_per_batch=100,
+                 random_seed=None,
+                 use_trajectories=False):
         if not isinstance(environment, env_attributes.Tabulatable):
             raise TypeError("FirstVisitPolicyEvaluator.__init__(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.Tabulatable".format(type(environment)))
         if not isinstance(environment, env_attributes.GymCompatible):
@@ -37,36 +57,115 @@ class FirstVisitPolicyEvaluator:
         self.number_of_iterations = number_of_iterations
         self.initial_value = initial_value
         self.episode_maximum_length = episode_maximum_length
+        self.step_size = step_size  # None: average the returns. Otherwise, the constant step size of the value updates.
+        ValidateBatchArguments('FirstVisitPolicyEvaluator', number_of_processes, number_of_episodes_per_batch)
+        if number_of_processes is not None and step_size is not None:
+            raise ValueError("FirstVisitPolicyEvaluator.__init__(): The batches of episodes cannot be merged with a constant step size ({})".format(step_size))
+        self.number_of_processes = number_of_processes
+        self.number_of_episodes_per_batch = number_of_episodes_per_batch
+        self.random_seed = random_seed
+        self.use_trajectories = use_trajectories
 
     def Evaluate(self, policy, print_iteration=False):
-        states_set = self.environment.StatesSet()
-        state_to_value_dict = {s: self.initial_value for s in states_set}
-        state_to_returns_dict = {s: [] for s in states_set}
+        (state_to_value_dict, _, _) = self.EvaluateWithConfidenceIntervals(policy, print_iteration=print_iteration)
+        return state_to_value_dict
+
+    def EvaluateWithConfidenceIntervals(self, policy, confidence_interval_width=None, confidence_level=0.95, print_iteration=False):
+        # Returns (state_to_value_dict, state_to_half_width_dict, completed_iterations)
+        # state_to_half_width_dict: The half-widths of the confidence intervals of the values; inf for the states visited less than twice
+        # confidence_interval_width: If not None, the evaluation stops when the confidence intervals of all the visited states are narrower
+        # than this width. The states that were never visited are ignored, since they may be unreachable under the policy.
+        states_list = env_compiled_model.SortedIfPossible(self.environment.StatesSet())
+        state_index = env_attributes.StateIndex(states_list)
+        state_to_return_statistics = rewards.RunningStatistics(len(states_list), step_size=self.step_size,
+                                                               initial_mean=self.initial_value)
 
         if print_iteration:
             print ("FirstVisitPolicyEvaluator.Evaluate()")
 
+        if self.number_of_processes is None:
+            completed_iterations = self.GenerateEpisodes(policy, state_index, state_to_return_statistics, confidence_interval_width,
+                                                         confidence_level, print_iteration)
+        else:
+            completed_iterations = self.GenerateBatches(policy, state_index, state_to_return_statistics, confidence_interval_width,
+                                                        confidence_level, print_iteration)
+        if print_iteration:
+            print()
+        half_widths_arr = state_to_return_statistics.ConfidenceHalfWidths(confidence_level)
+        state_to_value_dict = dict(zip(states_list, state_to_return_statistics.means.tolist()))
+        state_to_half_width_dict = dict(zip(states_list, half_widths_arr.tolist()))
+        return (state_to_value_dict, state_to_half_width_dict, completed_iterations)
+
+    def GenerateEpisodes(self, policy, state_index, state_to_return_statistics, confidence_interval_width, confidence_level, print_iteration):
+        # Generates the episodes one after another, or in blocks if the environment simulates batches. Returns the number of completed iterations.
+        if self.step_size is None:
+            completed_iterations = self.GenerateEpisodeBlocks(policy, state_index, state_to_return_statistics, confidence_interval_width,
+                                                              confidence_level, print_iteration)
+            if completed_iterations is not None:
+                return completed_iterations
+        completed_iterations = 0
         for iteration in range(self.number_of_iterations):
-            # Generate an episode
-            observationActionReward_list = self.environment.Episode(policy, maximum_number_of_steps=self.episode_maximum_length)
-            # [reward0, obs0, action1, reward1, obs1, action2, reward2, obs2, ...]
-            observations_list = [observationActionReward_list[ndx] for ndx in
-                                 range(len(observationActionReward_list)) if ndx%3 == 1]
-            rewards_list = [observationActionReward_list[ndx] for ndx in
-                            range(len(observationActionReward_list)) if ndx%3 == 0]
-            observation_first_visit_is_encountered = {o: False for o in observations_list}
-            for observationNdx in range(len(observations_list)):
-                observation = observations_list[observationNdx]
-                if observation in states_set and not observation_first_visit_is_encountered[observation]:
-                    observationReturn = rewards.Return(rewards_list[observationNdx:], self.gamma)
-                    state_to_returns_dict[observation].append(observationReturn)
-                    observation_first_visit_is_encountered[observation] = True
-                    state_to_value_dict[observation] = statistics.mean(state_to_returns_dict[observation])
+            if self.use_trajectories:
+                trajectory = self.environment.Trajectory(policy, maximum_number_of_steps=self.episode_maximum_length, state_index=state_index)
+                (indices, first_visit_returns) = FirstVisitReturns(trajectory, self.gamma)
+            else:
+                observationActionReward_list = self.environment.Episode(policy, maximum_number_of_steps=self.episode_maximum_length)
+                # [reward0, obs0, action1, reward1, obs1, action2, reward2, obs2, ...]
+                returns_list = episode_returns.Returns(observationActionReward_list[0::3], self.gamma)
+                indices = []
+                first_visit_returns = []
+                AppendFirstVisits(observationActionReward_list[1::3], returns_list, state_index.state_to_index, indices, first_visit_returns)
+            state_to_return_statistics.Append(indices, first_visit_returns)
+            completed_iterations += 1
             if print_iteration and iteration % 100 == 1:
                 print('.', end='', flush=True)
-        if print_iteration:
-            print()
-        return state_to_value_dict
+            if confidence_interval_width is not None and iteration % CONFIDENCE_CHECK_PERIOD == CONFIDENCE_CHECK_PERIOD - 1 and \
+                    ConfidenceIntervalsAreNarrower(state_to_return_statistics, confidence_interval_width, confidence_level):
+                break
+        return completed_iterations
+
+    def GenerateEpisodeBlocks(self, policy, state_index, state_to_return_statistics, confidence_interval_width, confidence_level, print_iteration):
+        # Merges the first-visit return sums of blocks of episodes simulated by the environment. Returns the number of
+        # completed iterations, or None if the environment doesn't simulate batches of episodes.
+        block_size = self.number_of_iterations if confidence_interval_width is None else CONFIDENCE_CHECK_PERIOD
+        completed_iterations = 0
+        while completed_iterations < self.number_of_iterations:
+            number_of_episodes = min(block_size, self.number_of_iterations - completed_iterations)
+            return_sums = self.environment.FirstVisitReturnSums(policy, number_of_episodes, state_index.states_list, self.gamma,
+                                                                self.episode_maximum_length)
+            if return_sums is None:
+                return None
+            state_to_return_statistics.MergeSums(*return_sums)
+            completed_iterations += number_of_episodes
+            if print_iteration:
+                print('.', end='', flush=True)
+            if confidence_interval_width is not None and \
+                    ConfidenceIntervalsAreNarrower(state_to_return_statistics, confidence_interval_width, confidence_level):
+                break
+            block_size *= 2
+        return completed_iterations
+
+    def GenerateBatches(self, policy, state_index, state_to_return_statistics, confidence_interval_width, confidence_level, print_iteration):
+        # Generates the batches of episodes in a pool of processes, and merges them in order. Returns the number of completed iterations.
+        root_seed_sequence = np.random.SeedSequence(self.random_seed)
+        batch_sizes_list = [self.number_of_episodes_per_batch] * (self.number_of_iterations // self.number_of_episodes_per_batch)
+        if self.number_of_iterations % self.number_of_episodes_per_batch > 0:
+            batch_sizes_list.append(self.number_of_iterations % self.number_of_episodes_per_batch)
+        tasks = [(policy, BatchSeedSequence(root_seed_sequence, (batchNdx,)), batch_size) for (batchNdx, batch_size) in enumerate(batch_sizes_list)]
+        constant_arguments = (state_index, self.gamma, self.episode_maximum_length, self.use_trajectories)
+        completed_iterations = 0
+        with BatchPool(self.environment, self.number_of_processes, constant_arguments) as pool:
+            for (batch_size, (counts_arr, sums_arr, sums_of_squares_arr)) in zip(batch_sizes_list, MapBatches(
+                    pool, self.environment, EvaluationBatchSums, tasks, constant_arguments)):
+                state_to_return_statistics.MergeSums(counts_arr, sums_arr, sums_of_squares_arr)
+                completed_iterations += batch_size
+                if print_iteration:
+                    print('.', end='', flush=True)
+                if confidence_interval_width is not None and \
+                        ConfidenceIntervalsAreNarrower(state_to_return_statistics, confidence_interval_width, confidence_level):
+                    break
+        return completed_iterations
+
 
 class MonteCarloESPolicyIterator:
     """
@@ -75,6 +174,11 @@ class MonteCarloESPolicyIterator:
         Tabulatable
         Episodic
         ExplorationStarts
+    number_of_processes: None to generate the episodes one after another, updating the policy after each episode. Otherwise, the
+        episodes of an iteration are split into batches of number_of_episodes_per_batch exploration starts, generated by a pool of
+        processes with the policy of the previous iteration, each batch with its own seed derived from random_seed. The
+        first-visit return sums of the batches are merged in the batch order, then the policy is updated: the result doesn't
+        depend on the number of processes.
     """
     def __init__(self,
                  environment,
@@ -82,7 +186,10 @@ class MonteCarloESPolicyIterator:
                  gamma=0.9,
                  number_of_iterations=1000,
                  initial_value=0,
-                 episode_maximum_length=1000
+                 episode_maximum_length=1000,
+                 number_of_processes=None,
+                 number_of_episodes_per_batch=100,
+                 random_seed=None
                  ):
         if not isinstance(environment, env_attributes.Tabulatable):
             raise TypeError("MonteCarloESPolicyIterator.__init__(): The environment {} is not an instance of ReinforcementLearning.environments.attributes.Tabulatable".format(environment))
@@ -101,8 +208,14 @@ class MonteCarloESPolicyIterator:
         self.number_of_iterations = number_of_iterations
         self.initial_value = initial_value
         self.episode_maximum_length = episode_maximum_length
+        ValidateBatchArguments('MonteCarloESPolicyIterator', number_of_processes, number_of_episodes_per_batch)
+        self.number_of_processes = number_of_processes
+        self.number_of_episodes_per_batch = number_of_episodes_per_batch
+        self.random_seed = random_seed
 
     def IteratePolicy(self):
+        if self.number_of_processes is not None:
+            return self.IteratePolicyInBatches()
         states_set = self.environment.StatesSet()
         actions_set = self.environment.ActionsSet()
         # Initialization
@@ -110,7 +223,7 @@ class MonteCarloESPolicyIterator:
         stateAction_to_returns = {}
         state_to_mostValuableAction = {}
         for state in states_set:
-            legal_actions_set = self.legal_actions_authority.LegalActions(state)
+            legal_actions_set = self.legal_actions_authority.ImmutableLegalActions(state)
             state_to_mostValuableAction[state] = random.choice(list(legal_actions_set))
             for action in actions_set:
                 stateAction_to_value[(state, action)] = self.initial_value
@@ -119,30 +232,28 @@ class MonteCarloESPolicyIterator:
 
         for iteration in range(self.number_of_iterations):
             for start_state in states_set:
-                start_legal_actions = self.legal_actions_authority.LegalActions(start_state)
+                start_legal_actions = self.legal_actions_authority.ImmutableLegalActions(start_state)
                 for start_legal_action in start_legal_actions:
                     episode = self.environment.Episode(policy,
                                                        start_state=start_state,
                                                        start_action=start_legal_action,
                                                        maximum_number_of_steps=self.episode_maximum_length)
                     stateAction_pairs = self.environment.StateActionPairs(episode)
-                    rewards_list = [episode[ndx] for ndx in
-                                    range(len(episode)) if ndx % 3 == 0]
-                    rewards_list = rewards_list[1:]  # Get rid of reward 0, as it is not the consequence of an action
+                    rewards_list = episode_returns.EpisodeRewards(episode)  # Without reward 0, as it is not the consequence of an action
                     if len(stateAction_pairs) != len(rewards_list):
                         raise ValueError("MonteCarloESPolicyIterator.IteratePolicy(): len(stateAction_pairs) ({}) != len(rewards_list) ({})".format(len(stateAction_pairs), len(rewards_list)))
+                    returns_list = episode_returns.Returns(rewards_list, self.gamma)
                     stateAction_is_encountered = {stateAction: False for stateAction in stateAction_pairs}
                     for stateActionNdx in range(len(stateAction_pairs)):
                         stateAction = stateAction_pairs[stateActionNdx]
                         if not stateAction_is_encountered[stateAction]:
-                            return_value = rewards.Return(rewards_list[stateActionNdx:], self.gamma)
-                            stateAction_to_returns[stateAction].Append(return_value)
+                            stateAction_to_returns[stateAction].Append(returns_list[stateActionNdx])
                             stateAction_to_value[stateAction] = stateAction_to_returns[stateAction].Average()
                             stateAction_is_encountered[stateAction] = True
-                    # Update policy through state_to_mostValuableAction
-                    visited_states_list = [s for (s, a) in stateAction_pairs]
+                    # Update the policy in place, for the visited states only: the values of the other states didn't change
+                    visited_states_list = list(dict.fromkeys(s for (s, a) in stateAction_pairs))
                     for visited_state in visited_states_list:
-                        legal_actions = self.legal_actions_authority.LegalActions(visited_state)
+                        legal_actions = self.legal_actions_authority.ImmutableLegalActions(visited_state)
                         highest_value = float('-inf')
                         most_valuable_action = None
                         for action in legal_actions:
@@ -150,8 +261,41 @@ class MonteCarloESPolicyIterator:
                             if action_value > highest_value:
                                 highest_value = action_value
                                 most_valuable_action = action
-                        state_to_mostValuableAction[visited_state] = most_valuable_action
-                    policy = rl_policy.Greedy(state_to_mostValuableAction, self.legal_actions_authority)
+                        policy.SetMostValuableAction(visited_state, most_valuable_action)
+        return policy
+
+    def IteratePolicyInBatches(self):
+        root_seed_sequence = np.random.SeedSequence(self.random_seed)
+        SeedRandomGenerators(root_seed_sequence)  # For the initial policy
+        states_list = env_compiled_model.SortedIfPossible(self.environment.StatesSet())
+        stateAction_pairs = [(state, action) for state in states_list
+                             for action in env_compiled_model.SortedIfPossible(self.legal_actions_authority.ImmutableLegalActions(state))]
+        stateAction_to_index = {stateAction: ndx for ndx, stateAction in enumerate(stateAction_pairs)}
+        stateAction_to_return_statistics = rewards.RunningStatistics(len(stateAction_pairs), initial_mean=self.initial_value)
+        policy = rl_policy.Greedy({state: random.choice(list(self.legal_actions_authority.ImmutableLegalActions(state))) for state in states_list},
+                                  self.legal_actions_authority)
+        start_arguments_list = [{'start_state': state, 'start_action': action} for (state, action) in stateAction_pairs]
+        batches_start_arguments = [start_arguments_list[firstNdx: firstNdx + self.number_of_episodes_per_batch]
+                                   for firstNdx in range(0, len(start_arguments_list), self.number_of_episodes_per_batch)]
+        constant_arguments = (stateAction_to_index, self.gamma, self.episode_maximum_length)
+        with BatchPool(self.environment, self.number_of_processes, constant_arguments) as pool:
+            for iteration in range(self.number_of_iterations):
+                tasks = [(policy, BatchSeedSequence(root_seed_sequence, (iteration, batchNdx)), batch_start_arguments)
+                         for (batchNdx, batch_start_arguments) in enumerate(batches_start_arguments)]
+                visited_states_set = set()
+                for (counts_arr, sums_arr, sums_of_squares_arr) in MapBatches(pool, self.environment, ControlBatchSums, tasks, constant_arguments):
+                    stateAction_to_return_statistics.MergeSums(counts_arr, sums_arr, sums_of_squares_arr)
+                    visited_states_set.update(stateAction_pairs[ndx][0] for ndx in np.flatnonzero(counts_arr))
+                # Update the policy for the visited states
+                for visited_state in env_compiled_model.SortedIfPossible(visited_states_set):
+                    highest_value = float('-inf')
+                    most_valuable_action = None
+                    for action in self.legal_actions_authority.ImmutableLegalActions(visited_state):
+                        action_value = stateAction_to_return_statistics.means[stateAction_to_index[(visited_state, action)]]
+                        if action_value > highest_value:
+                            highest_value = action_value
+                            most_valuable_action = action
+                    policy.SetMostValuableAction(visited_state, most_valuable_action)
         return policy
 
 
@@ -162,6 +306,11 @@ class MonteCarloOnPolicyIterator():
     Environment interface:
         Tabulatable
         Episodic
+    number_of_processes: None to generate the episodes one after another, updating the policy after each episode. Otherwise, the
+        episodes are generated in rounds of number_of_batches_per_round batches of number_of_episodes_per_batch episodes, by a
+        pool of processes with the policy of the previous round, each batch with its own seed derived from random_seed. The
+        first-visit return sums of the batches are merged in the batch order, then the policy is updated: the result doesn't
+        depend on the number of processes.
     """
     def __init__(self,
                  environment,
@@ -169,7 +318,11 @@ class MonteCarloOnPolicyIterator():
                  epsilon=0.1,
                  gamma=0.9,
                  number_of_iterations=1000,
-                 episode_maximum_length=1000):
+                 episode_maximum_length=1000,
+                 number_of_processes=None,
+                 number_of_episodes_per_batch=100,
+                 number_of_batches_per_round=8,
+                 random_seed=None):
         if not isinstance(environment, env_attributes.Tabulatable):
             raise TypeError(
                 "MonteCarloOnPolicyIterator.__init__(): The environment {} is not an instance of ReinforcementLearning.environments.attributes.Tabulatable".format(
@@ -188,47 +341,90 @@ class MonteCarloOnPolicyIterator():
         self.gamma = gamma
         self.number_of_iterations = number_of_iterations
         self.episode_maximum_length = episode_maximum_length
+        ValidateBatchArguments('MonteCarloOnPolicyIterator', number_of_processes, number_of_episodes_per_batch)
+        if number_of_batches_per_round < 1:
+            raise ValueError("MonteCarloOnPolicyIterator.__init__(): The number of batches per round ({}) is less than 1".format(number_of_batches_per_round))
+        self.number_of_processes = number_of_processes
+        self.number_of_episodes_per_batch = number_of_episodes_per_batch
+        self.number_of_batches_per_round = number_of_batches_per_round
+        self.random_seed = random_seed
 
     def IteratePolicy(self):
+        if self.number_of_processes is not None:
+            return self.IteratePolicyInBatches()
         stateAction_to_value = {}
         stateAction_to_returns = {}
         states_list = list(self.environment.StatesSet())
         for state in states_list:
-            legal_actions = list(self.legal_actions_authority.LegalActions(state))
+            legal_actions = list(self.legal_actions_authority.ImmutableLegalActions(state))
             for legal_action in legal_actions:
                 stateAction_to_value[(state, legal_action)] = np.random.normal()
                 stateAction_to_returns[(state, legal_action)] = rewards.RunningSum()
-        policy = rl_policy.EpsilonGreedy(self.epsilon, stateAction_to_value)
+        policy = rl_policy.IncrementalEpsilonGreedy(self.epsilon, stateAction_to_value)  # Updated in place, through UpdateValue()
 
         for iteration in range(self.number_of_iterations):
             episode = self.environment.Episode(
                 policy, maximum_number_of_steps=self.episode_maximum_length
             )
-            rewards_list = [episode[ndx] for ndx in
-                            range(len(episode)) if ndx % 3 == 0]
-            rewards_list = rewards_list[1:]  # Get rid of reward 0, as it is not the consequence of an action
+            rewards_list = episode_returns.EpisodeRewards(episode)  # Without reward 0, as it is not the consequence of an action
             stateAction_pairs = self.environment.StateActionPairs(episode)
             if len(stateAction_pairs) != len(rewards_list):
                 raise ValueError("MonteCarloOnPolicyIterator.IteratePolicy(): len(stateAction_pairs) ({}) != len(rewards_list) ({})".format(
                         len(stateAction_pairs),len(rewards_list)))
+            returns_list = episode_returns.Returns(rewards_list, self.gamma)
             stateAction_to_occurred = {stateAction: False for stateAction in stateAction_pairs}
             for stateActionNdx in range(len(stateAction_pairs)):
                 (state, action) = stateAction_pairs[stateActionNdx]
                 if not stateAction_to_occurred[(state, action)]:
-                    return_value = rewards.Return(rewards_list[stateActionNdx:], self.gamma)
-                    stateAction_to_returns[(state, action)].Append(return_value)
-                    stateAction_to_value[(state, action)] = stateAction_to_returns[(state, action)].Average()
+                    stateAction_to_returns[(state, action)].Append(returns_list[stateActionNdx])
+                    policy.UpdateValue(state, action, stateAction_to_returns[(state, action)].Average())
                     stateAction_to_occurred[(state, action)] = True
 
-            policy = rl_policy.EpsilonGreedy(self.epsilon, stateAction_to_value)
+        return policy
 
+    def IteratePolicyInBatches(self):
+        root_seed_sequence = np.random.SeedSequence(self.random_seed)
+        SeedRandomGenerators(root_seed_sequence)  # For the initial values
+        states_list = env_compiled_model.SortedIfPossible(self.environment.StatesSet())
+        stateAction_to_value = {}
+        for state in states_list:
+            for legal_action in self.legal_actions_authority.ImmutableLegalActions(state):
+                stateAction_to_value[(state, legal_action)] = np.random.normal()
+        stateAction_pairs = list(stateAction_to_value.keys())
+        stateAction_to_index = {stateAction: ndx for ndx, stateAction in enumerate(stateAction_pairs)}
+        stateAction_to_return_statistics = rewards.RunningStatistics(len(stateAction_pairs))
+        policy = rl_policy.IncrementalEpsilonGreedy(self.epsilon, stateAction_to_value)  # Updated in place, through UpdateValue()
+        batch_sizes_list = [self.number_of_episodes_per_batch] * (self.number_of_iterations // self.number_of_episodes_per_batch)
+        if self.number_of_iterations % self.number_of_episodes_per_batch > 0:
+            batch_sizes_list.append(self.number_of_iterations % self.number_of_episodes_per_batch)
+        constant_arguments = (stateAction_to_index, self.gamma, self.episode_maximum_length)
+        with BatchPool(self.environment, self.number_of_processes, constant_arguments) as pool:
+            for (roundNdx, firstBatchNdx) in enumerate(range(0, len(batch_sizes_list), self.number_of_batches_per_round)):
+                tasks = [(policy, BatchSeedSequence(root_seed_sequence, (roundNdx, batchNdx)), [{}] * batch_size)
+                         for (batchNdx, batch_size) in enumerate(batch_sizes_list[firstBatchNdx: firstBatchNdx + self.number_of_batches_per_round])]
+                round_counts_arr = np.zeros(len(stateAction_pairs), dtype=np.int64)
+                for (counts_arr, sums_arr, sums_of_squares_arr) in MapBatches(pool, self.environment, ControlBatchSums, tasks, constant_arguments):
+                    stateAction_to_return_statistics.MergeSums(counts_arr, sums_arr, sums_of_squares_arr)
+                    round_counts_arr += counts_arr
+                for ndx in np.flatnonzero(round_counts_arr):
+                    (state, action) = stateAction_pairs[ndx]
+                    policy.UpdateValue(state, action, float(stateAction_to_return_statistics.means[ndx]))
         return policy
 
+
 class MonteCarloOffPolicyIterator():
     """
-    Implements 'An off-policy Monte Carlo control algorithm', 'Reinforcement Learning', Sutton & Barto p. 127
+    Implements 'Off-policy MC control, for estimating pi ~ pi*', 'Reinforcement Learning', Sutton & Barto, 2nd edition, p. 111
     Gets rid of the dependence on exploration starts.
-    It iterates a deterministic policy based on episodes generated by an epsilon-soft policy pi'
+    It iterates a deterministic policy based on episodes generated by an epsilon-soft policy b.
+    Each episode is processed in a single backward pass.
+    importance_sampling:
+        'weighted': Incremental weighted importance sampling, with the cumulative weight W and the per-pair sum of weights C.
+            The pass stops as soon as W becomes 0, i.e. at the latest action that the deterministic policy would not take.
+        'per_decision': Per-decision importance sampling (p. 114): each reward is only weighted by the ratios of the actions that
+            precede it, and the returns are averaged.
+        'discounting_aware': Weighted discounting-aware importance sampling (p. 112): the flat partial returns are weighted by the
+            ratios up to their horizon. Reduces the variance when gamma < 1.
     Environment interface:
         Tabulatable
         Episodic
@@ -238,7 +434,8 @@ class MonteCarloOffPolicyIterator():
                  legal_actions_authority,
                  gamma=0.9,
                  number_of_iterations=1000,
-                 episode_maximum_length=1000
+                 episode_maximum_length=1000,
+                 importance_sampling='weighted'
                  ):
         if not isinstance(environment, env_attributes.Tabulatable):
             raise TypeError(
@@ -252,65 +449,193 @@ class MonteCarloOffPolicyIterator():
             raise TypeError(
                 "MonteCarloOffPolicyIterator.__init__(): The legal_actions_authority {} is not an instance of ReinforcementLearning.algorithms.LegalActionsAuthority".format(
                     legal_actions_authority))
+        if importance_sampling not in ['weighted', 'per_decision', 'discounting_aware']:
+            raise ValueError("MonteCarloOffPolicyIterator.__init__(): Unknown importance sampling '{}'. It should be 'weighted', 'per_decision' or 'discounting_aware'".format(importance_sampling))
         self.environment = copy.deepcopy(environment)
         self.legal_actions_authority = legal_actions_authority
         self.gamma = gamma
         self.number_of_iterations = number_of_iterations
         self.episode_maximum_length = episode_maximum_length
+        self.importance_sampling = importance_sampling
 
     def IteratePolicy(self, epsilon_soft_policy):
         stateAction_to_value = {}
-        stateAction_to_numerator = {}
-        stateAction_to_denominator = {}
+        stateAction_to_cumulativeWeight = {}  # C(s, a): The sum of the weights. For per-decision sampling: the number of returns.
         state_to_mostValuableAction = {}
         states_list = list(self.environment.StatesSet())
         for state in states_list:
-            legal_actions = list(self.legal_actions_authority.LegalActions(state))
+            legal_actions = list(self.legal_actions_authority.ImmutableLegalActions(state))
             for legal_action in legal_actions:
                 stateAction_to_value[(state, legal_action)] = np.random.normal()
-                stateAction_to_numerator[(state, legal_action)] = 0
-                stateAction_to_denominator[(state, legal_action)] = 0
+                stateAction_to_cumulativeWeight[(state, legal_action)] = 0
             state_to_mostValuableAction[state] = legal_actions[0]  # Arbitrarily select the first action
         policy = rl_policy.Greedy(state_to_mostValuableAction, self.legal_actions_authority)
 
         for iterationNdx in range(self.number_of_iterations):
             episode = self.environment.Episode(epsilon_soft_policy, maximum_number_of_steps=self.episode_maximum_length)
             # episode = [reward0, obs0, action1, reward1, obs1, action2, reward2, obs2, ..., obsN-1]
-            rewards_list = [episode[ndx] for ndx in range(1, len(episode)) if ndx % 3 == 0]  # Ignore reward0
+            rewards_list = episode_returns.EpisodeRewards(episode)  # Ignore reward0
             stateAction_pairs = self.environment.StateActionPairs(episode)
-            # tau: the latest time at which a_tau != pi(s_tau)
-            tau = None
-            for candidateNdx in reversed(range(len(stateAction_pairs))):
-                state = stateAction_pairs[candidateNdx][0]
-                epsilon_soft_action = stateAction_pairs[candidateNdx][1]
-                policy_action = policy.Select(state)  # policy is deterministic
-                if epsilon_soft_action != policy_action:
-                    tau = candidateNdx
-                    break  # Stop searching
-            if tau is not None:  # tau would be None if all actions taken by epsilon_soft_policy were identical to actions taken by policy
-                stateAction_to_occurred = {stateAction: False for stateAction in stateAction_pairs[tau:]}
-                for time in range(tau, len(stateAction_pairs)):
-                    (state, action) = stateAction_pairs[time]
-                    if not stateAction_to_occurred[(state, action)]:  # First occurrence
-                        weight = 1
-                        for k in range(time + 1, len(stateAction_pairs)):
-                            epsilon_soft_prob = epsilon_soft_policy.ActionProbabilities(state)[action]
-                            weight = weight * 1.0/epsilon_soft_prob
-                        return_t = rewards.Return(rewards_list[time:], self.gamma)
-                        stateAction_to_numerator[(state, action)] = stateAction_to_numerator[(state, action)] + weight * return_t
-                        stateAction_to_denominator[(state, action)] = stateAction_to_denominator[(state, action)] + weight
-                        stateAction_to_value[(state, action)] = stateAction_to_numerator[(state, action)]/stateAction_to_denominator[(state, action)]
-                # Update the deterministic policy
-                for state in states_list:
-                    legal_actions = list(self.legal_actions_authority.LegalActions(state))
-                    most_valuable_actions = None
-                    highest_value = float('-inf')
-                    for legal_action in legal_actions:
-                        if stateAction_to_value[(state, legal_action)] > highest_value:
-                            highest_value = stateAction_to_value[(state, legal_action)]
-                            most_valuable_actions = [legal_action]
-                        elif stateAction_to_value[(state, legal_action)] == highest_value:
-                            most_valuable_actions.append(legal_action)
-                    state_to_mostValuableAction[state] = random.choice(most_valuable_actions)
-                policy = rl_policy.Greedy(state_to_mostValuableAction, self.legal_actions_authority)
-        return policy
\ No newline at end of file
+            discounted_return = 0  # G
+            weight = 1  # W: for weighted sampling, the product of the ratios of the actions that follow the current pair
+            numerator = 0  # Discounting-aware sampling: the weighted sum of the flat partial returns
+            ratio = 1  # pi(a_t+1|s_t+1)/b(a_t+1|s_t+1): the ratio of the action that follows the current pair
+            for time in range(len(stateAction_pairs) - 1, -1, -1):
+                (state, action) = stateAction_pairs[time]
+                reward = rewards_list[time]
+                if self.importance_sampling == 'weighted':
+                    discounted_return = reward + self.gamma * discounted_return
+                    weight = weight * ratio
+                elif self.importance_sampling == 'per_decision':
+                    discounted_return = reward + self.gamma * ratio * discounted_return
+                else:  # 'discounting_aware': the weight is the sum of the weights of the flat partial returns
+                    weight = (1 - self.gamma) + self.gamma * ratio * weight
+                    numerator = reward * weight + self.gamma * ratio * numerator
+                if weight == 0:
+                    break  # The weights of all the earlier pairs are 0 as well
+                if self.importance_sampling == 'discounting_aware':
+                    discounted_return = numerator/weight
+                stateAction_to_cumulativeWeight[(state, action)] += weight
+                stateAction_to_value[(state, action)] += weight/stateAction_to_cumulativeWeight[(state, action)] * (discounted_return - stateAction_to_value[(state, action)])
+                most_valuable_action = self.MostValuableAction(state, stateAction_to_value)
+                policy.SetMostValuableAction(state, most_valuable_action)
+                # The ratio of the current action, for the preceding pair. pi is deterministic: pi(a|s) is 1 or 0.
+                if action == most_valuable_action:
+                    ratio = 1.0/epsilon_soft_policy.Probability(state, action)
+                else:
+                    ratio = 0
+        return policy
+
+    def MostValuableAction(self, state, stateAction_to_value):
+        most_valuable_actions = None
+        highest_value = float('-inf')
+        for legal_action in self.legal_actions_authority.ImmutableLegalActions(state):
+            if stateAction_to_value[(state, legal_action)] > highest_value:
+                highest_value = stateAction_to_value[(state, legal_action)]
+                most_valuable_actions = [legal_action]
+            elif stateAction_to_value[(state, legal_action)] == highest_value:
+                most_valuable_actions.append(legal_action)
+        if len(most_valuable_actions) == 1:
+            return most_valuable_actions[0]
+        return random.choice(most_valuable_actions)
+
+
+def ConfidenceIntervalsAreNarrower(return_statistics, confidence_interval_width, confidence_level):
+    # True if the confidence intervals of all the visited states are narrower than confidence_interval_width
+    visited_mask = return_statistics.counts > 0
+    return bool(np.all(2 * return_statistics.ConfidenceHalfWidths(confidence_level)[visited_mask] < confidence_interval_width))
+
+def SeedRandomGenerators(seed_sequence, environment=None):
+    # Seeds the generators that the episodes draw from: the random module (policies and some environments), numpy's
+    # global generator, and the generators of the environment
+    (python_seed, numpy_seed, environment_seed) = seed_sequence.generate_state(3)
+    random.seed(int(python_seed))
+    np.random.seed(int(numpy_seed))
+    if environment is not None and hasattr(environment, 'seed'):
+        environment.seed(int(environment_seed))
+
+def BatchSeedSequence(root_seed_sequence, batch_key):
+    # The seed sequence of a batch depends on the root seed and on the batch key only, not on the process that runs the batch
+    return np.random.SeedSequence(root_seed_sequence.entropy, spawn_key=root_seed_sequence.spawn_key + tuple(batch_key))
+
+def EvaluationBatchSums(environment, policy, seed_sequence, number_of_episodes, state_index, gamma, episode_maximum_length, use_trajectories):
+    # Returns the (counts, sums, sums_of_squares) arrays of the first-visit returns of the states, over number_of_episodes episodes
+    SeedRandomGenerators(seed_sequence, environment)
+    return_sums = environment.FirstVisitReturnSums(policy, number_of_episodes, state_index.states_list, gamma, episode_maximum_length)
+    if return_sums is not None:
+        return return_sums
+    indices_list = []
+    first_visit_returns_list = []
+    for episodeNdx in range(number_of_episodes):
+        if use_trajectories:
+            trajectory = environment.Trajectory(policy, maximum_number_of_steps=episode_maximum_length, state_index=state_index)
+            (indices_arr, first_visit_returns_arr) = FirstVisitReturns(trajectory, gamma)
+            indices_list.append(indices_arr)
+            first_visit_returns_list.append(first_visit_returns_arr)
+        else:
+            observationActionReward_list = environment.Episode(policy, maximum_number_of_steps=episode_maximum_length)
+            AppendFirstVisits(observationActionReward_list[1::3], episode_returns.Returns(observationActionReward_list[0::3], gamma),
+                              state_index.state_to_index, indices_list, first_visit_returns_list)
+    if use_trajectories:
+        (indices_list, first_visit_returns_list) = (np.concatenate(indices_list), np.concatenate(first_visit_returns_list))
+    return Sums(indices_list, first_visit_returns_list, len(state_index.states_list))
+
+def FirstVisitReturns(trajectory, gamma):
+    # Returns the (indices, returns) arrays of the first visits of the indexed states of a trajectory. The return of an
+    # observation includes the reward received in it, like Returns() of the [reward0, reward1, ...] list.
+    observations_arr = trajectory.Observations()
+    first_visit_mask = trajectory.FirstVisitMask(include_last_observation=True) & (observations_arr >= 0)
+    return (observations_arr[first_visit_mask], trajectory.ObservationReturns(gamma)[first_visit_mask])
+
+def ControlBatchSums(environment, policy, seed_sequence, episode_arguments_list, stateAction_to_index, gamma, episode_maximum_length):
+    # Returns the (counts, sums, sums_of_squares) arrays of the first-visit returns of the (state, action) pairs
+    # episode_arguments_list: The keyword arguments of Episode() for each episode of the batch, e.g. the exploration start
+    SeedRandomGenerators(seed_sequence, environment)
+    indices_list = []
+    first_visit_returns_list = []
+    for episode_arguments in episode_arguments_list:
+        episode = environment.Episode(policy, maximum_number_of_steps=episode_maximum_length, **episode_arguments)
+        stateAction_pairs = environment.StateActionPairs(episode)
+        rewards_list = episode_returns.EpisodeRewards(episode)  # Without reward 0, as it is not the consequence of an action
+        if len(stateAction_pairs) != len(rewards_list):
+            raise ValueError("monte_carlo.ControlBatchSums(): len(stateAction_pairs) ({}) != len(rewards_list) ({})".format(len(stateAction_pairs), len(rewards_list)))
+        AppendFirstVisits(stateAction_pairs, episode_returns.Returns(rewards_list, gamma), stateAction_to_index, indices_list, first_visit_returns_list)
+    return Sums(indices_list, first_visit_returns_list, len(stateAction_to_index))
+
+def AppendFirstVisits(keys_list, returns_list, key_to_index, indices_list, first_visit_returns_list):
+    # Appends the index and the return of the first occurrence of each indexed key of an episode
+    visited_indices_set = set()
+    for (key, key_return) in zip(keys_list, returns_list):
+        index = key_to_index.get(key)
+        if index is not None and index not in visited_indices_set:
+            visited_indices_set.add(index)
+            indices_list.append(index)
+            first_visit_returns_list.append(key_return)
+
+def Sums(indices_list, values_list, number_of_indices):
+    indices_arr = np.array(indices_list, dtype=np.intp)
+    values_arr = np.array(values_list, dtype=float)
+    return (np.bincount(indices_arr, minlength=number_of_indices),
+            np.bincount(indices_arr, weights=values_arr, minlength=number_of_indices),
+            np.bincount(indices_arr, weights=values_arr**2, minlength=number_of_indices))
+
+@contextlib.contextmanager
+def BatchPool(environment, number_of_processes, constant_arguments):
+    # A pool of worker processes, each with its own copy of the environment. None if number_of_processes is 1.
+    if number_of_processes <= 1:
+        yield None
+        return
+    pool = multiprocessing.Pool(number_of_processes, initializer=_InitializeWorker, initargs=(environment, constant_arguments))
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+
+def MapBatches(pool, environment, batch_function, tasks, constant_arguments):
+    # Yields batch_function(environment, *task, *constant_arguments) for the tasks, in their order. pool=None: in this process.
+    if pool is None:
+        for task in tasks:
+            yield batch_function(environment, *task, *constant_arguments)
+    else:
+        yield from pool.imap(_RunWorkerBatch, [(batch_function, task) for task in tasks])
+
+def ValidateBatchArguments(class_name, number_of_processes, number_of_episodes_per_batch):
+    if number_of_processes is not None and (not isinstance(number_of_processes, int) or number_of_processes < 1):
+        raise ValueError("{}.__init__(): The number of processes ({}) should be None or a positive integer".format(class_name, number_of_processes))
+    if number_of_episodes_per_batch < 1:
+        raise ValueError("{}.__init__(): The number of episodes per batch ({}) is less than 1".format(class_name, number_of_episodes_per_batch))
+
+
+_worker_environment = None  # The environment copy of a worker process of BatchPool()
+_worker_constant_arguments = None
+
+
+def _InitializeWorker(environment, constant_arguments):
+    global _worker_environment, _worker_constant_arguments
+    _worker_environment = environment
+    _worker_constant_arguments = constant_arguments
+
+
+def _RunWorkerBatch(batchFunction_task):
+    (batch_function, task) = batchFunction_task
+    return batch_function(_worker_environment, *task, *_worker_constant_arguments)
@@ -1,29 +1,69 @@
 import abc
 import random
 import copy
+import numpy as np
 
 
 class LegalActionsAuthority(abc.ABC):
     """
     Abstract class that filters the legal actions in a state, among the actions set
+    The legal actions of a state are assumed not to change: ImmutableLegalActions() caches them, and LegalActionMask()
+    tabulates them for vectorized solvers. The cache holds every state that was queried and is never invalidated.
+    Subclasses must call LegalActionsAuthority.__init__(), which creates the cache.
     """
     def __init__(self):
         super().__init__()
+        self.state_to_immutable_legal_actions = {}
 
     @abc.abstractmethod
     def LegalActions(self, state):
         pass # return legal_actions_set
 
+    def ImmutableLegalActions(self, state):
+        # Returns the cached legal actions, as a frozenset, a tuple or a range. The callers must not modify them.
+        if state not in self.state_to_immutable_legal_actions:
+            legal_actions = self.LegalActions(state)
+            if not isinstance(legal_actions, (frozenset, tuple, range)):
+                legal_actions = frozenset(legal_actions)
+            self.state_to_immutable_legal_actions[state] = legal_actions
+        return self.state_to_immutable_legal_actions[state]
+
+    def LegalActionMask(self, states_list, actions_list):
+        """
+        Returns the (S, A) boolean array legal_actions_mask[stateNdx, actionNdx]
+        Raises a ValueError if a legal action is not in actions_list. Authorities can override it with array operations.
+        """
+        action_to_index = {action: index for index, action in enumerate(actions_list)}
+        legal_actions_mask = np.zeros((len(states_list), len(actions_list)), dtype=bool)
+        for stateNdx, state in enumerate(states_list):
+            for action in self.ImmutableLegalActions(state):
+                if action not in action_to_index:
+                    raise ValueError("{}.LegalActionMask(): The legal action {} in state {} is not in the actions list".format(type(self).__name__, action, state))
+                legal_actions_mask[stateNdx, action_to_index[action]] = True
+        return legal_actions_mask
+
 class AllActionsLegalAuthority(LegalActionsAuthority):
     """
     Utility class that always allows all actions
+    LegalActions() returns the shared frozenset of the actions, not a copy: the callers cannot modify it, and must copy it
+    into a set to do so.
     """
     def __init__(self, actions_set):
         super().__init__()
-        self.actions_set = actions_set
+        self.actions_set = frozenset(actions_set)
 
     def LegalActions(self, state):
-        return copy.deepcopy(self.actions_set)
+        return self.actions_set
+
+    def ImmutableLegalActions(self, state):
+        return self.actions_set
+
+    def LegalActionMask(self, states_list, actions_list):
+        missing_actions_set = self.actions_set.difference(actions_list)
+        if len(missing_actions_set) > 0:
+            raise ValueError("AllActionsLegalAuthority.LegalActionMask(): The legal actions {} are not in the actions list".format(missing_actions_set))
+        is_legal_arr = np.array([action in self.actions_set for action in actions_list], dtype=bool)
+        return np.tile(is_legal_arr, (len(states_list), 1))
 
 
 class Policy(abc.ABC):
@@ -63,7 +103,7 @@ class Random(Policy):  # Selects randomly one of the legal actions
         super().__init__(legal_actions_authority)
 
     def ActionProbabilities(self, state):
-        legal_actions_set = self.legal_actions_authority.LegalActions(state)
+        legal_actions_set = self.legal_actions_authority.ImmutableLegalActions(state)
         action_to_probability_dict = {}
         for action in legal_actions_set:
             action_to_probability_dict[action] = 1/len(legal_actions_set)
@@ -72,13 +112,20 @@ class Random(Policy):  # Selects randomly one of the legal actions
 class Greedy(Policy):
     """
     Always selects the most valuable action, as kept in a table
+    The table can be updated in place with SetMostValuableAction(), which increments revision.
     """
     def __init__(self, state_to_most_valuable_action, legal_actions_authority):
         super().__init__(legal_actions_authority)
         self.state_to_most_valuable_action = copy.deepcopy(state_to_most_valuable_action)
+        self.revision = 0
+
+    def SetMostValuableAction(self, state, action):
+        if self.state_to_most_valuable_action.get(state) != action:
+            self.state_to_most_valuable_action[state] = action
+            self.revision += 1
 
     def ActionProbabilities(self, state):
-        legal_actions_set = self.legal_actions_authority.LegalActions(state)
+        legal_actions_set = self.legal_actions_authority.ImmutableLegalActions(state)
         if self.state_to_most_valuable_action[state] not in legal_actions_set:  # Initialization error: Attribute an arbitrary legal action
             self.state_to_most_valuable_action[state] = list(legal_actions_set)[0]
         return {self.state_to_most_valuable_action[state]: 1}
@@ -113,4 +160,214 @@ class EpsilonGreedy(Policy):
         for (_state, action) in stateActions_list:
             action_to_probability[action] = self.epsilon/number_of_actions
         action_to_probability[most_valuable_action] += (1.0 - self.epsilon)
-        return action_to_probability
\ No newline at end of file
+        return action_to_probability
+
+class IncrementalEpsilonGreedy(EpsilonGreedy):
+    """
+    Mutable EpsilonGreedy that shares the stateAction_to_value table and keeps the most valuable action of each state.
+    UpdateValue() changes one value and updates the most valuable action of its state only: the values must be
+    changed through it. Select() draws a single random number and allocates nothing.
+    revision is incremented at each update, so that users that cache the policy behavior can detect the changes.
+    """
+    def __init__(self, epsilon, stateAction_to_value):
+        super().__init__(epsilon, stateAction_to_value)
+        self.state_to_actions = {state: [action for (_state, action) in stateActions_list]
+                                 for (state, stateActions_list) in self.state_to_stateActions.items()}
+        self.state_to_most_valuable_action = {state: self.MostValuableAction(state) for state in self.state_to_actions}
+        self.revision = 0
+
+    def MostValuableAction(self, state):
+        # The first action of highest value, in the order of stateAction_to_value, like EpsilonGreedy
+        most_valuable_action = None
+        highest_value = float('-inf')
+        for action in self.state_to_actions[state]:
+            value = self.stateAction_to_value[(state, action)]
+            if value > highest_value:
+                highest_value = value
+                most_valuable_action = action
+        return most_valuable_action
+
+    def UpdateValue(self, state, action, value):
+        if (state, action) not in self.stateAction_to_value:
+            raise KeyError("IncrementalEpsilonGreedy.UpdateValue(): The pair ({}, {}) is not in the table".format(state, action))
+        previous_value = self.stateAction_to_value[(state, action)]
+        self.stateAction_to_value[(state, action)] = value
+        most_valuable_action = self.state_to_most_valuable_action[state]
+        highest_value = self.stateAction_to_value[(state, most_valuable_action)]
+        if action == most_valuable_action:
+            if value < previous_value:  # Another action may now be the most valuable
+                self.state_to_most_valuable_action[state] = self.MostValuableAction(state)
+        elif value > highest_value:
+            self.state_to_most_valuable_action[state] = action
+        elif value == highest_value:  # The tie goes to the first action
+            self.state_to_most_valuable_action[state] = self.MostValuableAction(state)
+        self.revision += 1
+
+    def ActionProbabilities(self, state):
+        actions_list = self.state_to_actions[state]
+        if len(actions_list) == 0:
+            return {}
+        action_to_probability = {action: self.epsilon/len(actions_list) for action in actions_list}
+        action_to_probability[self.state_to_most_valuable_action[state]] += (1.0 - self.epsilon)
+        return action_to_probability
+
+    def Select(self, state):
+        random_0to1 = random.random()
+        if random_0to1 < self.epsilon:  # Uniform over all the actions, the most valuable one included
+            actions_list = self.state_to_actions[state]
+            return actions_list[int(random_0to1 / self.epsilon * len(actions_list))]
+        return self.state_to_most_valuable_action[state]
+
+
+class TabularPolicy(Policy):
+    """
+    Policy stored as a (S, A) matrix of action probabilities, probabilities_arr[stateNdx, actionNdx]
+    Select() is O(1): deterministic states store their action, the others sample from an alias table built on first use
+    (Cf. Vose, 'A linear algorithm for generating random numbers with a given distribution', 1991).
+    SelectMany() samples the actions of an array of states at once, by inversion of the cumulative distributions.
+    A row of zeros is a state without legal actions.
+    """
+    def __init__(self, states_list, actions_list, probabilities_arr, legal_actions_authority=None):
+        super().__init__(legal_actions_authority)
+        self.states_list = list(states_list)
+        self.state_to_index = {state: index for index, state in enumerate(self.states_list)}
+        self.actions_list = list(actions_list)
+        self.action_to_index = {action: index for index, action in enumerate(self.actions_list)}
+        self.probabilities_arr = np.array(probabilities_arr, dtype=float)
+        if self.probabilities_arr.shape != (len(self.states_list), len(self.actions_list)):
+            raise ValueError("TabularPolicy.__init__(): probabilities_arr.shape {} is not ({}, {})".format(self.probabilities_arr.shape, len(self.states_list), len(self.actions_list)))
+        if np.any(self.probabilities_arr < 0):
+            raise ValueError("TabularPolicy.__init__(): The probabilities matrix has negative entries")
+        row_sums_arr = np.sum(self.probabilities_arr, axis=1)
+        has_actions_arr = row_sums_arr > 0
+        if np.any(np.abs(row_sums_arr[has_actions_arr] - 1) > 1e-6):
+            raise ValueError("TabularPolicy.__init__(): The probabilities of a state don't sum to 1")
+        self.cumulative_probabilities_arr = np.cumsum(self.probabilities_arr, axis=1)
+        self.cumulative_probabilities_arr[has_actions_arr, -1] = 1.  # Absorb the rounding errors
+        self.deterministic_actionNdxs_list = np.where(np.max(self.probabilities_arr, axis=1, initial=0) == 1,
+                                                      np.argmax(self.probabilities_arr, axis=1), -1).tolist()
+        self.alias_tables = [None] * len(self.states_list)  # Built on demand by Select()
+        self.actions_arr = np.array(self.actions_list)
+        if self.actions_arr.ndim != 1:  # E.g. tuple actions
+            self.actions_arr = np.empty(len(self.actions_list), dtype=object)
+            self.actions_arr[:] = self.actions_list
+
+    def ActionProbabilities(self, state):
+        return {action: probability for action, probability in zip(self.actions_list, self.probabilities_arr[self.state_to_index[state]].tolist())
+                if probability > 0}
+
+    def Probability(self, state, action):
+        if action not in self.action_to_index:
+            return 0
+        return self.probabilities_arr[self.state_to_index[state], self.action_to_index[action]]
+
+    def Select(self, state):
+        stateNdx = self.state_to_index[state]
+        actionNdx = self.deterministic_actionNdxs_list[stateNdx]
+        if actionNdx < 0:
+            alias_table = self.alias_tables[stateNdx]
+            if alias_table is None:
+                if not self.probabilities_arr[stateNdx].any():
+                    raise ValueError("TabularPolicy.Select(): State {} has no legal action".format(state))
+                alias_table = AliasTable(self.probabilities_arr[stateNdx].tolist())
+                self.alias_tables[stateNdx] = alias_table
+            (thresholds, aliases) = alias_table
+            scaled_random = random.random() * len(thresholds)
+            column = int(scaled_random)
+            actionNdx = column if scaled_random - column < thresholds[column] else aliases[column]
+        return self.actions_list[actionNdx]
+
+    def SelectMany(self, states, rng=None):
+        """
+        Returns the array of the actions selected in each of the states
+        rng: The numpy Generator that draws the actions. None: a Generator seeded from the random module, so that
+        random.seed() makes the selections reproducible
+        """
+        if rng is None:
+            rng = np.random.default_rng(random.getrandbits(64))
+        stateNdxs_arr = np.fromiter((self.state_to_index[state] for state in states), dtype=np.int64, count=len(states))
+        if np.any(self.cumulative_probabilities_arr[stateNdxs_arr, -1] == 0):
+            raise ValueError("TabularPolicy.SelectMany(): A state has no legal action")
+        random_0to1_arr = rng.random(len(stateNdxs_arr))
+        actionNdxs_arr = np.sum(random_0to1_arr[:, None] >= self.cumulative_probabilities_arr[stateNdxs_arr], axis=1)
+        return self.actions_arr[actionNdxs_arr]
+
+    @classmethod
+    def FromPolicy(cls, policy, states_list, actions_list, legal_actions_authority=None):
+        # Tabulates policy.ActionProbabilities() over the states
+        if legal_actions_authority is None:
+            legal_actions_authority = getattr(policy, 'legal_actions_authority', None)
+        action_to_index = {action: index for index, action in enumerate(actions_list)}
+        probabilities_arr = np.zeros((len(states_list), len(actions_list)), dtype=float)
+        for stateNdx, state in enumerate(states_list):
+            for action, probability in policy.ActionProbabilities(state).items():
+                if action not in action_to_index:
+                    raise ValueError("TabularPolicy.FromPolicy(): The action {} of state {} is not in the actions list".format(action, state))
+                probabilities_arr[stateNdx, action_to_index[action]] += probability
+        return cls(states_list, actions_list, probabilities_arr, legal_actions_authority)
+
+    @classmethod
+    def FromGreedy(cls, greedy_policy, actions_list):
+        # The states are the keys of greedy_policy.state_to_most_valuable_action
+        states_list = list(greedy_policy.state_to_most_valuable_action)
+        action_to_index = {action: index for index, action in enumerate(actions_list)}
+        probabilities_arr = np.zeros((len(states_list), len(actions_list)), dtype=float)
+        for stateNdx, state in enumerate(states_list):
+            most_valuable_action = greedy_policy.state_to_most_valuable_action[state]
+            if most_valuable_action not in action_to_index:  # Let the Greedy policy attribute a legal action
+                most_valuable_action = next(iter(greedy_policy.ActionProbabilities(state)))
+            probabilities_arr[stateNdx, action_to_index[most_valuable_action]] = 1
+        return cls(states_list, actions_list, probabilities_arr, greedy_policy.legal_actions_authority)
+
+    @classmethod
+    def FromEpsilonGreedy(cls, epsilon_greedy_policy):
+        # The states and the actions are those of epsilon_greedy_policy.stateAction_to_value
+        states_list = list(epsilon_greedy_policy.state_to_stateActions)
+        actions_list = list(dict.fromkeys(action for (state, action) in epsilon_greedy_policy.stateAction_to_value))
+        return cls.FromPolicy(epsilon_greedy_policy, states_list, actions_list)
+
+    def LegalActionsAuthorityOrAllActions(self):
+        if self.legal_actions_authority is not None:
+            return self.legal_actions_authority
+        return AllActionsLegalAuthority(set(self.actions_list))
+
+    def ToGreedy(self):
+        # The most probable action of each state. The states without legal actions get None.
+        most_probable_actionNdxs_list = np.argmax(self.probabilities_arr, axis=1).tolist()
+        has_actions_list = self.probabilities_arr.any(axis=1).tolist()
+        state_to_most_valuable_action = {state: self.actions_list[actionNdx] if has_actions else None
+                                         for (state, actionNdx, has_actions) in zip(self.states_list, most_probable_actionNdxs_list, has_actions_list)}
+        return Greedy(state_to_most_valuable_action, self.LegalActionsAuthorityOrAllActions())
+
+    def ToEpsilonGreedy(self, epsilon):
+        # The most probable action of each state gets (1 - epsilon), plus its share of epsilon among the legal actions
+        legal_actions_authority = self.LegalActionsAuthorityOrAllActions()
+        stateAction_to_value = {}
+        for stateNdx, state in enumerate(self.states_list):
+            legal_actions_set = legal_actions_authority.ImmutableLegalActions(state)
+            for action in self.actions_list:  # The ties are broken in the order of the actions list, like np.argmax()
+                if action in legal_actions_set:
+                    stateAction_to_value[(state, action)] = self.probabilities_arr[stateNdx, self.action_to_index[action]]
+        return EpsilonGreedy(epsilon, stateAction_to_value)
+
+
+def AliasTable(probabilities):
+    # Returns (thresholds, aliases) such that column k is selected with probability thresholds[k], otherwise aliases[k]
+    number_of_columns = len(probabilities)
+    scaled_probabilities = [probability * number_of_columns for probability in probabilities]
+    thresholds = [1.] * number_of_columns
+    aliases = list(range(number_of_columns))
+    small_columns = [k for k in range(number_of_columns) if scaled_probabilities[k] < 1]
+    large_columns = [k for k in range(number_of_columns) if scaled_probabilities[k] >= 1]
+    while small_columns and large_columns:
+        small_column = small_columns.pop()
+        large_column = large_columns.pop()
+        thresholds[small_column] = scaled_probabilities[small_column]
+        aliases[small_column] = large_column
+        scaled_probabilities[large_column] -= 1 - scaled_probabilities[small_column]
+        if scaled_probabilities[large_column] < 1:
+            small_columns.append(large_column)
+        else:
+            large_columns.append(large_column)
+    # The remaining columns have a scaled probability of 1, up to rounding errors: their threshold stays 1
+    return (thresholds, aliases)
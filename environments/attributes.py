@@ -1,6 +1,12 @@
 import abc
+import collections
+import collections.abc
 import gym
 import sys
+import numpy as np
+import ReinforcementLearning.utilities.episode_returns as episode_returns
+
+VECTORIZED_FIRST_VISIT_MINIMUM_LENGTH = 128  # Below this length, a set finds the first visits faster than np.unique()
 
 
 class GymCompatible(abc.ABC, gym.Env):
@@ -47,18 +53,230 @@ class Tabulatable(abc.ABC):
         pass
 
 class DynamicProgramming(Tabulatable, TransitionDynamics):
+    """
+    Environment with known transition probabilities and rewards, cached by (state, action) in
+    originStateAction_to_newStateToProbabilityReward. The cache policy is set by ConfigureTransitionCache():
+        'unbounded': Keep all the computed transitions (default)
+        'lru': Keep the most recently used transitions, within an estimated size of maximum_size_in_bytes
+        'compute_through': Don't keep anything; each call computes the transitions
+    With record_type='arrays', the entries are TransitionRecord objects instead of dictionaries: parallel arrays of
+    successor indices, probabilities and rewards, without the zero-probability successors. They behave as read-only
+    dictionaries, and solvers can use their arrays directly.
+    """
     def __init__(self):
         self.originStateAction_to_newStateToProbabilityReward = {}  # The cached transition probabilities and rewards
+        self.transition_cache_policy = 'unbounded'
+        self.transition_cache_maximum_size_in_bytes = None
+        self.stateAction_to_size_in_bytes = {}  # For the 'lru' policy: the estimated size of each cached entry
+        self.transition_cache_size_in_bytes = 0
+        self.number_of_transition_cache_hits = 0
+        self.number_of_transition_cache_misses = 0
+        self.number_of_transition_cache_evictions = 0
+        self.transition_record_type = 'dict'
+        self.transition_state_index = None  # For the 'arrays' record type: the index of the successor states, shared by all the records
 
     def TransitionProbabilitiesAndRewards(self, state, action):
-        if (state, action) not in self.originStateAction_to_newStateToProbabilityReward:
-            self.originStateAction_to_newStateToProbabilityReward[(state, action)] = self.ComputeTransitionProbabilitiesAndRewards(state, action)
-        return self.originStateAction_to_newStateToProbabilityReward[(state, action)]
+        newState_to_probabilityReward = self.originStateAction_to_newStateToProbabilityReward.get((state, action))
+        if newState_to_probabilityReward is not None:
+            self.number_of_transition_cache_hits += 1
+            if self.transition_cache_policy == 'lru':
+                self.originStateAction_to_newStateToProbabilityReward.move_to_end((state, action))
+            return newState_to_probabilityReward
+        self.number_of_transition_cache_misses += 1
+        return self.CacheTransitions(state, action, self.ComputeTransitionProbabilitiesAndRewards(state, action))
+
+    def CacheTransitions(self, state, action, newState_to_probabilityReward):
+        # Stores an entry computed elsewhere (e.g. by a worker process), according to the cache policy.
+        # Returns the stored entry, converted to the record type.
+        if self.transition_record_type == 'arrays' and not isinstance(newState_to_probabilityReward, TransitionRecord):
+            newState_to_probabilityReward = TransitionRecord.FromDict(newState_to_probabilityReward, self.TransitionStateIndex())
+        if self.transition_cache_policy == 'compute_through':
+            return newState_to_probabilityReward
+        self.originStateAction_to_newStateToProbabilityReward[(state, action)] = newState_to_probabilityReward
+        if self.transition_cache_policy == 'lru':
+            self.transition_cache_size_in_bytes -= self.stateAction_to_size_in_bytes.get((state, action), 0)
+            self.stateAction_to_size_in_bytes[(state, action)] = TransitionsSizeInBytes(newState_to_probabilityReward)
+            self.transition_cache_size_in_bytes += self.stateAction_to_size_in_bytes[(state, action)]
+            self.originStateAction_to_newStateToProbabilityReward.move_to_end((state, action))
+            self.EvictTransitions()
+        return newState_to_probabilityReward
+
+    def EvictTransitions(self):
+        # Removes the least recently used entries until the cache fits in its budget. The newest entry is always kept.
+        cache = self.originStateAction_to_newStateToProbabilityReward
+        while self.transition_cache_size_in_bytes > self.transition_cache_maximum_size_in_bytes and len(cache) > 1:
+            (stateAction, _) = cache.popitem(last=False)
+            self.transition_cache_size_in_bytes -= self.stateAction_to_size_in_bytes.pop(stateAction)
+            self.number_of_transition_cache_evictions += 1
+
+    def ConfigureTransitionCache(self, policy='unbounded', maximum_size_in_bytes=None, record_type='dict'):
+        if policy not in ['unbounded', 'lru', 'compute_through']:
+            raise ValueError("DynamicProgramming.ConfigureTransitionCache(): Unknown policy '{}'. It should be 'unbounded', 'lru' or 'compute_through'".format(policy))
+        if record_type not in ['dict', 'arrays']:
+            raise ValueError("DynamicProgramming.ConfigureTransitionCache(): Unknown record type '{}'. It should be 'dict' or 'arrays'".format(record_type))
+        if policy == 'lru' and (maximum_size_in_bytes is None or maximum_size_in_bytes <= 0):
+            raise ValueError("DynamicProgramming.ConfigureTransitionCache(): The 'lru' policy requires a positive maximum_size_in_bytes. Got {}".format(maximum_size_in_bytes))
+        previous_entries = list(self.originStateAction_to_newStateToProbabilityReward.items())
+        self.transition_cache_policy = policy
+        self.transition_cache_maximum_size_in_bytes = maximum_size_in_bytes
+        self.transition_record_type = record_type
+        self.originStateAction_to_newStateToProbabilityReward = collections.OrderedDict() if policy == 'lru' else {}
+        self.stateAction_to_size_in_bytes = {}
+        self.transition_cache_size_in_bytes = 0
+        for ((state, action), newState_to_probabilityReward) in previous_entries:  # Keep what fits in the new policy
+            if record_type == 'dict' and isinstance(newState_to_probabilityReward, TransitionRecord):
+                newState_to_probabilityReward = dict(newState_to_probabilityReward)
+            self.CacheTransitions(state, action, newState_to_probabilityReward)
+
+    def TransitionStateIndex(self):
+        # The index of the successor states used by the TransitionRecord objects: the sorted states, if they are comparable
+        if self.transition_state_index is None:
+            try:
+                states_list = sorted(self.StatesSet())
+            except TypeError:
+                states_list = list(self.StatesSet())
+            self.transition_state_index = StateIndex(states_list)
+        return self.transition_state_index
+
+    def TransitionCacheStatistics(self):
+        size_in_bytes = self.transition_cache_size_in_bytes
+        if self.transition_cache_policy != 'lru':  # Only the 'lru' policy tracks the size incrementally
+            size_in_bytes = sum(TransitionsSizeInBytes(newState_to_probabilityReward) for newState_to_probabilityReward in self.originStateAction_to_newStateToProbabilityReward.values())
+        return {'policy': self.transition_cache_policy,
+                'number_of_entries': len(self.originStateAction_to_newStateToProbabilityReward),
+                'size_in_bytes': size_in_bytes,
+                'maximum_size_in_bytes': self.transition_cache_maximum_size_in_bytes,
+                'hits': self.number_of_transition_cache_hits,
+                'misses': self.number_of_transition_cache_misses,
+                'evictions': self.number_of_transition_cache_evictions}
 
     @abc.abstractmethod
     def ComputeTransitionProbabilitiesAndRewards(self, state, action):
         pass  # return newState_to_probabilityAndReward_dict
 
+    def ComputeCompiledModel(self, legal_actions_authority=None):
+        # Optional vectorized model builder, used by compiled_model.Compile()
+        return None  # return ReinforcementLearning.environments.compiled_model.CompiledModel, or None to compile pair by pair
+
+    def IterateValues(self, gamma, minimum_change, maximum_number_of_iterations, legal_actions_authority=None):
+        # Optional value iteration kernel that exploits the structure of the environment, used by the 'specialized' backend
+        # of ReinforcementLearning.algorithms.dp_iteration.ValueIterator
+        return None  # return (state_to_value, state_to_most_valuable_action, completed_iterations), or None to use the compiled model
+
+    def ModelParameters(self):
+        # The parameters that determine the transition model, used to key the cached models (Cf. model_cache.ModelCache)
+        # Default: the simple attributes, except the current state and the transition cache configuration and counters
+        return SimpleAttributes(self, excluded_attribute_names=['state'] + _TRANSITION_CACHE_ATTRIBUTE_NAMES)
+
+class StateIndex:
+    """
+    Bidirectional map between the states and their indices, shared by the TransitionRecord objects of an environment
+    """
+    __slots__ = ('states_list', 'state_to_index')
+
+    def __init__(self, states_list):
+        self.states_list = list(states_list)
+        self.state_to_index = {state: index for index, state in enumerate(self.states_list)}
+
+class TransitionRecord(collections.abc.Mapping):
+    """
+    Compact transitions of a (state, action) pair: the parallel arrays successor_indices (int32, increasing),
+    probabilities and rewards (float64), without zero-probability successors. The indices refer to a shared StateIndex.
+    It is a read-only mapping new_state -> (probability, reward), like the dictionaries returned by
+    ComputeTransitionProbabilitiesAndRewards().
+    """
+    __slots__ = ('state_index', 'successor_indices', 'probabilities', 'rewards')
+
+    def __init__(self, state_index, successor_indices, probabilities, rewards):
+        self.state_index = state_index
+        self.successor_indices = successor_indices
+        self.probabilities = probabilities
+        self.rewards = rewards
+
+    @classmethod
+    def FromDict(cls, newState_to_probabilityReward, state_index):
+        index_probability_reward_list = []
+        for (new_state, (probability, reward)) in newState_to_probabilityReward.items():
+            if probability == 0:
+                continue
+            if new_state not in state_index.state_to_index:
+                raise ValueError("TransitionRecord.FromDict(): The new state {} is not in the state index".format(new_state))
+            index_probability_reward_list.append((state_index.state_to_index[new_state], probability, reward))
+        index_probability_reward_list.sort()
+        return cls(state_index,
+                   np.array([index for (index, _, _) in index_probability_reward_list], dtype=np.int32),
+                   np.array([probability for (_, probability, _) in index_probability_reward_list], dtype=float),
+                   np.array([reward for (_, _, reward) in index_probability_reward_list], dtype=float))
+
+    def __getitem__(self, new_state):
+        index = self.state_index.state_to_index.get(new_state)
+        if index is not None:
+            position = np.searchsorted(self.successor_indices, index)
+            if position < len(self.successor_indices) and self.successor_indices[position] == index:
+                return (float(self.probabilities[position]), float(self.rewards[position]))
+        raise KeyError(new_state)
+
+    def __iter__(self):
+        states_list = self.state_index.states_list
+        return (states_list[index] for index in self.successor_indices.tolist())
+
+    def __len__(self):
+        return len(self.successor_indices)
+
+    def items(self):
+        states_list = self.state_index.states_list
+        return [(states_list[index], (probability, reward)) for (index, probability, reward) in
+                zip(self.successor_indices.tolist(), self.probabilities.tolist(), self.rewards.tolist())]
+
+    def SizeInBytes(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(arr) for arr in [self.successor_indices, self.probabilities, self.rewards])
+
+def TransitionsSizeInBytes(newState_to_probabilityReward):
+    # Estimated memory footprint of a cached entry: the dictionary, and its keys and (probability, reward) tuples
+    if isinstance(newState_to_probabilityReward, TransitionRecord):
+        return newState_to_probabilityReward.SizeInBytes()
+    size_in_bytes = sys.getsizeof(newState_to_probabilityReward)
+    for (new_state, (probability, reward)) in newState_to_probabilityReward.items():
+        size_in_bytes += sys.getsizeof(new_state) + _PROBABILITY_REWARD_TUPLE_SIZE_IN_BYTES + sys.getsizeof(probability) + sys.getsizeof(reward)
+    return size_in_bytes
+
+_PROBABILITY_REWARD_TUPLE_SIZE_IN_BYTES = sys.getsizeof((0.0, 0.0))
+
+_TRANSITION_CACHE_ATTRIBUTE_NAMES = ['transition_cache_policy', 'transition_cache_maximum_size_in_bytes', 'transition_cache_size_in_bytes',
+                                     'number_of_transition_cache_hits', 'number_of_transition_cache_misses',
+                                     'number_of_transition_cache_evictions', 'transition_record_type', 'transition_state_index']
+
+def SimpleAttributes(obj, excluded_attribute_names=()):
+    # Returns {name: value} for the attributes of obj that are numbers, strings, booleans, None, or lists, tuples and sets
+    # of those. The sets are converted to sorted tuples, so that the representation is reproducible.
+    name_to_value = {}
+    for name, value in sorted(vars(obj).items()):
+        if name.startswith('_') or name in excluded_attribute_names:
+            continue
+        (is_simple, canonical_value) = CanonicalSimpleValue(value)
+        if is_simple:
+            name_to_value[name] = canonical_value
+    return name_to_value
+
+def CanonicalSimpleValue(value):
+    # Returns (is_simple, canonical_value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return (True, value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        canonical_values = []
+        for element in value:
+            (is_simple, canonical_element) = CanonicalSimpleValue(element)
+            if not is_simple:
+                return (False, None)
+            canonical_values.append(canonical_element)
+        if isinstance(value, (set, frozenset)):
+            try:
+                canonical_values.sort()
+            except TypeError:  # Incomparable types
+                canonical_values.sort(key=repr)
+        return (True, tuple(canonical_values))
+    return (False, None)
+
 class Episodic(GymCompatible):
     def Episode(self, policy,
                 start_state=None,
@@ -98,6 +316,40 @@ class Episodic(GymCompatible):
             number_of_steps += 1
         return observationActionReward_list
 
+    def Trajectory(self, policy,
+                   start_state=None,
+                   start_action=None,
+                   maximum_number_of_steps=None,
+                   state_index=None,
+                   action_index=None):
+        # Like Episode(), but returns a Trajectory object. With a state_index and an action_index (StateIndex objects), the
+        # states and the actions are recorded as integer indices.
+        trajectory = Trajectory(state_index=state_index, action_index=action_index)
+        if start_state is not None:
+            if not isinstance(self, ExplorationStarts):
+                raise TypeError("Episodic.Trajectory(): The start state is not None and the environment is not an instance of ReinforcementLearning.environments.attributes.ExplorationStarts")
+            (observation, reward, episode_is_done, info) = self.SetState(start_state)
+        else:
+            (observation, reward, episode_is_done, info) = self.reset()
+        trajectory.Start(reward, observation)
+        number_of_steps = 0
+        if maximum_number_of_steps is None:
+            maximum_number_of_steps = sys.maxsize
+        if start_action is not None:
+            observation, reward, episode_is_done, info = self.step(start_action)
+            trajectory.Append(start_action, reward, observation)
+            number_of_steps += 1
+        while not episode_is_done and number_of_steps < maximum_number_of_steps:
+            action = policy.Select(observation)
+            observation, reward, episode_is_done, info = self.step(action)
+            trajectory.Append(action, reward, observation)
+            number_of_steps += 1
+        return trajectory
+
+    def FirstVisitReturnSums(self, policy, number_of_episodes, states_list, gamma, maximum_number_of_steps=None):
+        # Optional batch simulation of episodes from reset(), used by ReinforcementLearning.algorithms.monte_carlo.FirstVisitPolicyEvaluator
+        return None  # return the (counts, sums, sums_of_squares) arrays of the first-visit returns of the states of states_list, or None to generate the episodes one by one
+
     @staticmethod
     def StateActionPairs(episode):
         # episode = [reward0, obs0, action1, reward1, obs1, action2, reward2, obs2, ..., obsN - 1]
@@ -109,4 +361,216 @@ class Episodic(GymCompatible):
             stateNdx = 3 * stepNdx + 1
             actionNdx = 3 * stepNdx + 2
             stateAction_pairs.append((episode[stateNdx], episode[actionNdx]))
-        return stateAction_pairs
\ No newline at end of file
+        return stateAction_pairs
+
+
+class Trajectory:
+    """
+    Columnar record of an episode, an alternative to the list [reward0, obs0, action1, reward1, obs1, ..., obsN-1] of
+    Episodic.Episode(): the arrays of the T + 1 observations, the T actions and the T + 1 rewards, rewards[0] being reward0.
+    The arrays are preallocated and doubled when they are full.
+    With a state_index or an action_index (StateIndex objects), the states or the actions are stored as int32 indices;
+    otherwise, in object arrays. An observation that is not in the state index, e.g. a terminal observation outside
+    StatesSet(), is stored as -1 and kept aside for decoding.
+    Slicing returns a read-only Trajectory whose arrays are non-writeable views: trajectory[t0: t1] has the observations
+    t0 to t1, the actions t0 to t1 - 1, and the reward received in observation t0 as its reward0.
+    """
+    __slots__ = ('state_index', 'action_index', 'observations', 'actions', 'rewards', 'number_of_steps',
+                 'time_to_unindexed_observation', 'first_time', 'is_view')
+
+    def __init__(self, state_index=None, action_index=None, initial_capacity=16):
+        self.state_index = state_index
+        self.action_index = action_index
+        self.observations = np.empty(initial_capacity + 1, dtype=np.int32 if state_index is not None else object)
+        self.actions = np.empty(initial_capacity, dtype=np.int32 if action_index is not None else object)
+        self.rewards = np.empty(initial_capacity + 1, dtype=float)
+        self.number_of_steps = -1  # Not started
+        self.time_to_unindexed_observation = {}  # Shared with the slices, by time in the arrays of the whole trajectory
+        self.first_time = 0  # The time of the first observation in the whole trajectory
+        self.is_view = False
+
+    @classmethod
+    def FromList(cls, episode, state_index=None, action_index=None):
+        # Converts an episode in the format of Episodic.Episode()
+        if len(episode) % 3 != 2:
+            raise ValueError("Trajectory.FromList(): The length of the episode ({}) modulo 3 is not 2".format(len(episode)))
+        trajectory = cls(state_index, action_index, initial_capacity=len(episode)//3)
+        trajectory.Start(episode[0], episode[1])
+        for stepNdx in range(len(episode)//3):
+            trajectory.Append(episode[3 * stepNdx + 2], episode[3 * stepNdx + 3], episode[3 * stepNdx + 4])
+        return trajectory
+
+    @classmethod
+    def FromArrays(cls, rewards, observations, actions, state_index=None, action_index=None, time_to_unindexed_observation=None):
+        # Copies encoded arrays: the T + 1 rewards, the T + 1 observations (indices in state_index, -1 for the observations
+        # of time_to_unindexed_observation, or objects without a state index) and the T actions (indices in action_index, or objects)
+        number_of_steps = len(actions)
+        if len(observations) != number_of_steps + 1 or len(rewards) != number_of_steps + 1:
+            raise ValueError("Trajectory.FromArrays(): The numbers of rewards ({}) and observations ({}) are not the number of actions ({}) + 1".format(
+                len(rewards), len(observations), number_of_steps))
+        trajectory = cls(state_index, action_index, initial_capacity=number_of_steps)
+        trajectory.rewards[: number_of_steps + 1] = rewards
+        trajectory.observations[: number_of_steps + 1] = observations
+        trajectory.actions[: number_of_steps] = actions
+        trajectory.number_of_steps = number_of_steps
+        if time_to_unindexed_observation is not None:
+            trajectory.time_to_unindexed_observation.update(time_to_unindexed_observation)
+        return trajectory
+
+    def Start(self, reward0, observation0):
+        if self.is_view:
+            raise ValueError("Trajectory.Start(): A slice is read-only")
+        self.rewards[0] = reward0
+        self.number_of_steps = 0
+        self.time_to_unindexed_observation.clear()
+        self.SetObservation(0, observation0)
+
+    def Append(self, action, reward, observation):
+        if self.is_view:
+            raise ValueError("Trajectory.Append(): A slice is read-only")
+        if self.number_of_steps < 0:
+            raise ValueError("Trajectory.Append(): The trajectory was not started")
+        if self.number_of_steps == len(self.actions):
+            self.Grow(max(2 * len(self.actions), 1))
+        time = self.number_of_steps
+        self.actions[time] = action if self.action_index is None else self.action_index.state_to_index[action]
+        self.rewards[time + 1] = reward
+        self.SetObservation(time + 1, observation)
+        self.number_of_steps += 1
+
+    def SetObservation(self, time, observation):
+        if self.state_index is None:
+            self.observations[time] = observation
+            return
+        index = self.state_index.state_to_index.get(observation)
+        if index is None:
+            index = -1
+            self.time_to_unindexed_observation[time] = observation
+        self.observations[time] = index
+
+    def Grow(self, capacity):
+        # Reallocates the arrays for capacity steps
+        previous_capacity = len(self.actions)
+        for name in ['observations', 'actions', 'rewards']:
+            arr = getattr(self, name)
+            grown_arr = np.empty(capacity + len(arr) - previous_capacity, dtype=arr.dtype)
+            grown_arr[: len(arr)] = arr
+            setattr(self, name, grown_arr)
+
+    def __len__(self):
+        return max(self.number_of_steps, 0)
+
+    def __getitem__(self, time_slice):
+        if not isinstance(time_slice, slice) or time_slice.step not in [None, 1]:
+            raise TypeError("Trajectory.__getitem__(): Only contiguous slices are supported. Got {}".format(time_slice))
+        (start, stop, _) = time_slice.indices(len(self))
+        stop = max(start, stop)
+        trajectory = Trajectory.__new__(Trajectory)
+        trajectory.state_index = self.state_index
+        trajectory.action_index = self.action_index
+        trajectory.observations = self.observations[start: stop + 1]
+        trajectory.actions = self.actions[start: stop]
+        trajectory.rewards = self.rewards[start: stop + 1]
+        for arr in [trajectory.observations, trajectory.actions, trajectory.rewards]:
+            arr.flags.writeable = False
+        trajectory.number_of_steps = stop - start
+        trajectory.time_to_unindexed_observation = self.time_to_unindexed_observation
+        trajectory.first_time = self.first_time + start
+        trajectory.is_view = True
+        return trajectory
+
+    def States(self):
+        # The T observations in which an action was taken (indices, with a state_index)
+        return self.observations[: len(self)]
+
+    def NextStates(self):
+        # The T observations that follow the actions
+        return self.observations[1: len(self) + 1]
+
+    def Observations(self):
+        return self.observations[: len(self) + 1]
+
+    def Actions(self):
+        return self.actions[: len(self)]
+
+    def Rewards(self):
+        # The T rewards that follow the actions, without reward0
+        return self.rewards[1: len(self) + 1]
+
+    def InitialReward(self):
+        return self.rewards[0]
+
+    def Returns(self, gamma, bootstrap_value=0):
+        # The array of the discounted returns that follow each action
+        return episode_returns.ReturnsArray(self.Rewards(), gamma, bootstrap_value)
+
+    def ObservationReturns(self, gamma):
+        # The array of the discounted returns from each of the T + 1 observations, the reward received in the observation
+        # included: reward0 for the first one
+        return episode_returns.ReturnsArray(self.rewards[: len(self) + 1], gamma)
+
+    def DecodedObservations(self):
+        # The list of the T + 1 observations, decoded from the indices
+        observations_list = self.Observations().tolist()
+        if self.state_index is None:
+            return observations_list
+        states_list = self.state_index.states_list
+        return [states_list[index] if index >= 0 else self.time_to_unindexed_observation[self.first_time + time]
+                for (time, index) in enumerate(observations_list)]
+
+    def DecodedActions(self):
+        actions_list = self.Actions().tolist()
+        if self.action_index is None:
+            return actions_list
+        return [self.action_index.states_list[index] for index in actions_list]
+
+    def StateActionPairs(self):
+        # The list of (state, action) pairs, like Episodic.StateActionPairs()
+        return list(zip(self.DecodedObservations()[: len(self)], self.DecodedActions()))
+
+    def FirstVisitMask(self, include_actions=False, include_last_observation=False):
+        # The boolean array of the steps at which the state (or the (state, action) pair) occurs for the first time.
+        # include_last_observation: The mask covers the T + 1 observations. Incompatible with include_actions.
+        if include_actions and include_last_observation:
+            raise ValueError("Trajectory.FirstVisitMask(): include_actions and include_last_observation are incompatible")
+        number_of_keys = len(self) + 1 if include_last_observation else len(self)
+        mask_arr = np.zeros(number_of_keys, dtype=bool)
+        if self.state_index is None or (include_actions and self.action_index is None) or \
+                number_of_keys < VECTORIZED_FIRST_VISIT_MINIMUM_LENGTH:
+            keys_list = self.StateActionPairs() if include_actions else self.DecodedObservations()[: number_of_keys]
+            FirstVisits(keys_list, range(number_of_keys), mask_arr)
+            return mask_arr
+        codes_arr = self.observations[: number_of_keys].astype(np.int64)
+        unindexed_times_arr = np.flatnonzero(codes_arr < 0)
+        if include_actions:
+            codes_arr = codes_arr * len(self.action_index.states_list) + self.Actions()
+        indexed_times_arr = np.flatnonzero(codes_arr >= 0)  # With include_actions, the codes of the unindexed observations stay negative
+        (_, first_positions_arr) = np.unique(codes_arr[indexed_times_arr], return_index=True)
+        mask_arr[indexed_times_arr[first_positions_arr]] = True
+        if len(unindexed_times_arr) > 0:  # The observations outside the state index, compared as objects
+            unindexed_times_list = unindexed_times_arr.tolist()
+            keys_list = [self.time_to_unindexed_observation[self.first_time + time] for time in unindexed_times_list]
+            if include_actions:
+                actions_list = self.DecodedActions()
+                keys_list = [(key, actions_list[time]) for (key, time) in zip(keys_list, unindexed_times_list)]
+            FirstVisits(keys_list, unindexed_times_list, mask_arr)
+        return mask_arr
+
+    def ToList(self):
+        # The episode in the format of Episodic.Episode()
+        observations_list = self.DecodedObservations()
+        actions_list = self.DecodedActions()
+        rewards_list = self.rewards[: len(self) + 1].tolist()
+        episode = [rewards_list[0], observations_list[0]]
+        for time in range(len(self)):
+            episode += [actions_list[time], rewards_list[time + 1], observations_list[time + 1]]
+        return episode
+
+
+def FirstVisits(keys_list, times, mask_arr):
+    # Sets mask_arr[time] to True for the first occurrence of each key
+    encountered_keys_set = set()
+    for (time, key) in zip(times, keys_list):
+        if key not in encountered_keys_set:
+            encountered_keys_set.add(key)
+            mask_arr[time] = True
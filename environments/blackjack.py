@@ -1,3 +1,5 @@
+import collections
+import sys
 import gym
 from gym import spaces
 from gym.utils import seeding
@@ -54,6 +56,7 @@ class Blackjack(env_attributes.Tabulatable,
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
+        self.blackjack_env.seed(seed)  # The gym environment draws the cards
         return [seed]
 
     def step(self, action):
@@ -271,6 +274,496 @@ class BlackjackES(env_attributes.Tabulatable,
     def StatesSet(self):
         return self.states_set
 
+class BlackjackESBatch:
+    """
+    Vectorized BlackjackES: simulates many hands at once, with numpy array operations. It reproduces BlackjackES.reset()
+    (automatic hits below 12, and a natural that ends the episode with reward 1, or 0 when the dealer shows a 10 or an
+    ace), SetState() and step(), and the exploring starts of Episodic.Episode(): the start action is played even if the
+    start state is terminal.
+    Each hand is an observation code (Cf. ObservationCode()), and a step is a few table lookups: a hit looks up the code
+    after the drawn card, a stand draws the dealer's final sum, which the last observation holds like BlackjackES.step(),
+    and reset() draws the start observation. The dealer's play and the automatic hits don't depend on the policy, so
+    their outcomes are drawn from their exact distributions, with a single random number per hand.
+    The policy is given as a table hit_probabilities_arr[player_sum, usable_ace, dealer_card], of shape (22, 2, 11).
+    """
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def HitProbabilities(policy, states_set):
+        hit_probabilities_arr = np.zeros((22, 2, 11), dtype=float)
+        for (player_sum, usable_ace, dealer_card) in states_set:
+            hit_probabilities_arr[player_sum, int(usable_ace), dealer_card] = policy.ActionProbabilities((player_sum, usable_ace, dealer_card)).get(1, 0)
+        return hit_probabilities_arr
+
+    def Simulate(self, hit_probabilities_arr, number_of_episodes, start_states=None, start_actions=None, maximum_number_of_steps=None):
+        """
+        start_states: None (reset), or a list of (player_sum, usable_ace, dealer_card) tuples, one per episode
+        start_actions: None, or a list of actions, one per episode. They are played without consulting the policy.
+        Returns a BlackjackEpisodes object
+        """
+        if maximum_number_of_steps is None:
+            maximum_number_of_steps = sys.maxsize
+        if np.shape(hit_probabilities_arr) != (22, 2, 11):
+            raise ValueError("BlackjackESBatch.Simulate(): The shape of the hit probabilities table ({}) is not (22, 2, 11)".format(np.shape(hit_probabilities_arr)))
+        if start_states is None:
+            (codes_arr, rewards_arr, dones_arr) = self.Reset(number_of_episodes)
+        else:
+            if len(start_states) != number_of_episodes:
+                raise ValueError("BlackjackESBatch.Simulate(): The number of start states ({}) is not the number of episodes ({})".format(len(start_states), number_of_episodes))
+            start_states_arr = np.array([(player_sum, int(usable_ace), dealer_card) for (player_sum, usable_ace, dealer_card) in start_states], dtype=np.int64).reshape(-1, 3)
+            if np.any((start_states_arr[:, 0] < 0) | (start_states_arr[:, 0] > 31) | (start_states_arr[:, 1] < 0) | (start_states_arr[:, 1] > 1) |
+                      (start_states_arr[:, 2] < 1) | (start_states_arr[:, 2] > 10)):
+                raise ValueError("BlackjackESBatch.Simulate(): The start states should have a player sum in [0, 31] and a dealer card in [1, 10]")
+            codes_arr = (start_states_arr[:, 0] * 2 + start_states_arr[:, 1]) * 32 + start_states_arr[:, 2]
+            dones_arr = (start_states_arr[:, 0] == 21) & (start_states_arr[:, 1] == 1)  # Cf. BlackjackES.SetState()
+            rewards_arr = dones_arr.astype(np.int8)
+            dones_arr |= start_states_arr[:, 0] > 21
+        actions = None
+        if start_actions is not None:
+            if len(start_actions) != number_of_episodes:
+                raise ValueError("BlackjackESBatch.Simulate(): The number of start actions ({}) is not the number of episodes ({})".format(len(start_actions), number_of_episodes))
+            actions = np.array(start_actions, dtype=np.int8)
+            if np.any((actions != 0) & (actions != 1)):
+                raise ValueError("BlackjackESBatch.Simulate(): The actions should be 0 for stand or 1 for hit")
+            if np.any((actions == 1) & (codes_arr >= ObservationCode(22, False, 0))):
+                raise ValueError("BlackjackESBatch.Simulate(): Hit with a player sum > 21")
+            episodeNdxs = np.arange(number_of_episodes)  # The start action is played even if the start state is terminal
+        else:
+            episodeNdxs = np.flatnonzero(~dones_arr) if maximum_number_of_steps > 0 else np.zeros(0, dtype=np.int64)
+
+        # The policy, indexed by observation code
+        hit_probabilities_by_code_arr = np.zeros((32, 2, 32), dtype=np.float32)
+        hit_probabilities_by_code_arr[: 22, :, : 11] = hit_probabilities_arr
+        hit_probabilities_by_code_arr = hit_probabilities_by_code_arr.ravel()
+        policy_is_deterministic = bool(np.all((hit_probabilities_by_code_arr == 0) | (hit_probabilities_by_code_arr == 1)))
+        deterministic_actions_by_code_arr = hit_probabilities_by_code_arr.astype(np.int8)
+        (hit_codes_arr, step_rewards_arr, terminal_codes_arr) = TransitionTables()
+        dealer_final_sum_sampler = DealerFinalSumSampler()
+        # Only the hands that are still playing are simulated. Each step records the indices of these hands, their
+        # actions, rewards and observations.
+        codes_arr_list = [codes_arr]
+        rewards_arr_list = [rewards_arr]
+        actions_arr_list = []
+        episodeNdxs_arr_list = []
+        codes = codes_arr[episodeNdxs]
+        while len(episodeNdxs) > 0:
+            if actions is None:
+                if policy_is_deterministic:  # No random draw
+                    actions = deterministic_actions_by_code_arr[codes]
+                else:
+                    actions = (self.rng.random(len(codes), dtype=np.float32) < hit_probabilities_by_code_arr[codes]).astype(np.int8)
+            # Both outcomes are looked up for all the hands, with the same random number, which is cheaper than splitting them
+            uniforms = self.rng.random(len(codes))
+            hit_codes = hit_codes_arr[codes * 13 + (uniforms * 13).astype(np.int32)]
+            dealer_cards = codes & 31
+            stand_codes = codes - dealer_cards + dealer_final_sum_sampler.Sample(uniforms, dealer_cards)
+            codes = np.where(actions == 1, hit_codes, stand_codes)
+            codes_arr_list.append(codes)
+            rewards_arr_list.append(step_rewards_arr[codes])
+            actions_arr_list.append(actions)
+            episodeNdxs_arr_list.append(episodeNdxs)
+            if len(actions_arr_list) >= maximum_number_of_steps:
+                break
+            playingNdxs = np.flatnonzero(~terminal_codes_arr[codes])
+            episodeNdxs = episodeNdxs[playingNdxs]
+            codes = codes[playingNdxs]
+            actions = None
+
+        step_starts_arr = np.cumsum([0] + [len(actions) for actions in actions_arr_list])
+        return BlackjackEpisodes(np.concatenate(codes_arr_list).astype(np.int16), np.concatenate(rewards_arr_list).astype(np.int8),
+                                 np.concatenate([np.zeros(0, dtype=np.int8)] + actions_arr_list),
+                                 np.concatenate([np.zeros(0, dtype=np.int64)] + episodeNdxs_arr_list), step_starts_arr)
+
+    def Reset(self, number_of_episodes):
+        # Cf. BlackjackES.reset(). Returns (codes_arr, rewards_arr, dones_arr)
+        outcomes_arr = StartObservationSampler().Sample(self.rng.random(number_of_episodes))
+        dones_arr = outcomes_arr >= NUMBER_OF_OBSERVATION_CODES  # Naturals
+        codes_arr = outcomes_arr - NUMBER_OF_OBSERVATION_CODES * dones_arr
+        dealer_cards_arr = codes_arr & 31
+        rewards_arr = (dones_arr & (dealer_cards_arr != 10) & (dealer_cards_arr != 1)).astype(np.int8)
+        return (codes_arr, rewards_arr, dones_arr)
+
+
+NUMBER_OF_OBSERVATION_CODES = 32 * 2 * 32
+
+def ObservationCode(player_sum, usable_ace, dealer_card):
+    # The integer code of an observation (player_sum, usable_ace, dealer_card), for sums below 32. After a stand, the
+    # dealer_card field holds the dealer's final sum.
+    return (player_sum * 2 + int(usable_ace)) * 32 + dealer_card
+
+def ObservationTuples():
+    # Object array of the observations (player_sum, usable_ace, dealer_card), indexed by their code
+    global _observation_tuples_arr
+    if _observation_tuples_arr is None:
+        _observation_tuples_arr = np.empty(NUMBER_OF_OBSERVATION_CODES, dtype=object)
+        for player_sum in range(32):
+            for usable_ace in [False, True]:
+                for dealer_card in range(32):
+                    _observation_tuples_arr[ObservationCode(player_sum, usable_ace, dealer_card)] = (player_sum, usable_ace, dealer_card)
+    return _observation_tuples_arr
+
+_observation_tuples_arr = None
+
+def TransitionTables():
+    # Returns (hit_codes_arr, step_rewards_arr, terminal_codes_arr), indexed by observation code:
+    # hit_codes_arr[code * 13 + rank]: The code after the player draws a card of rank 0 to 12 (ace, 2, ..., 10, jack,
+    #   queen, king); -1 for the player sums above 21
+    # step_rewards_arr[code]: The reward of the step that ends in the observation: -1 if the player busted, the outcome
+    #   of the game if the observation holds the dealer's final sum (17 to 26), 0 otherwise
+    # terminal_codes_arr[code]: True if the observation ends the episode
+    global _transition_tables
+    if _transition_tables is None:
+        hit_codes_arr = np.full((NUMBER_OF_OBSERVATION_CODES, 13), -1, dtype=np.int64)
+        step_rewards_arr = np.zeros(NUMBER_OF_OBSERVATION_CODES, dtype=np.int8)
+        terminal_codes_arr = np.zeros(NUMBER_OF_OBSERVATION_CODES, dtype=bool)
+        for player_sum in range(32):
+            for usable_ace in [False, True]:
+                for dealer_card in range(32):
+                    code = ObservationCode(player_sum, usable_ace, dealer_card)
+                    if dealer_card >= 17:  # The dealer's final sum, after a stand
+                        terminal_codes_arr[code] = True
+                        step_rewards_arr[code] = 1 if dealer_card > 21 else np.sign(player_sum - dealer_card)
+                    elif player_sum > 21:
+                        terminal_codes_arr[code] = True
+                        step_rewards_arr[code] = -1
+                    if player_sum > 21:
+                        continue
+                    for rank in range(13):  # Cf. BlackjackES.step(1)
+                        card = min(rank + 1, 10)
+                        (new_sum, new_usable_ace) = (player_sum + card, usable_ace)
+                        if card == 1 and player_sum <= 10:
+                            (new_sum, new_usable_ace) = (player_sum + 11, True)
+                        if new_sum > 21 and new_usable_ace:
+                            (new_sum, new_usable_ace) = (new_sum - 10, False)
+                        hit_codes_arr[code, rank] = ObservationCode(new_sum, new_usable_ace, dealer_card)
+        _transition_tables = (hit_codes_arr.ravel(), step_rewards_arr, terminal_codes_arr)
+    return _transition_tables
+
+_transition_tables = None
+
+
+class CategoricalSampler:
+    """
+    Draws the outcomes of the rows of a table of probabilities with one uniform random number per draw: the outcome is
+    the number of cumulative probabilities of the row that are below or equal to the number. A table over
+    number_of_buckets equal subintervals of [0, 1) gives the outcome directly, except in the few subintervals that
+    contain a cumulative probability, where it is searched.
+    """
+    def __init__(self, probabilities_arr, number_of_buckets=4096):
+        probabilities_arr = np.atleast_2d(probabilities_arr)
+        (number_of_rows, self.number_of_outcomes) = probabilities_arr.shape
+        self.number_of_buckets = number_of_buckets
+        cumulative_probabilities_arr = np.cumsum(probabilities_arr, axis=1)
+        cumulative_probabilities_arr[:, -1] = 1.
+        # Offsetting each row of cumulative probabilities by its index makes the flattened table sorted
+        self.flat_cumulative_arr = (cumulative_probabilities_arr + np.arange(number_of_rows)[:, None]).ravel()
+        bucket_bounds_arr = np.arange(number_of_buckets + 1)/number_of_buckets + np.arange(number_of_rows)[:, None]
+        row_offsets_arr = self.number_of_outcomes * np.arange(number_of_rows)[:, None]
+        first_outcomes_arr = np.searchsorted(self.flat_cumulative_arr, bucket_bounds_arr[:, : -1], side='right') - row_offsets_arr
+        last_outcomes_arr = np.searchsorted(self.flat_cumulative_arr, bucket_bounds_arr[:, 1:], side='left') - row_offsets_arr
+        self.bucket_outcomes_arr = np.where(first_outcomes_arr == last_outcomes_arr, first_outcomes_arr, -1).ravel()  # -1: Searched
+
+    def Sample(self, uniforms_arr, rows_arr=0):
+        outcomes_arr = self.bucket_outcomes_arr[rows_arr * self.number_of_buckets + (uniforms_arr * self.number_of_buckets).astype(np.int32)]
+        searchedNdxs = np.flatnonzero(outcomes_arr < 0)
+        if len(searchedNdxs) > 0:
+            searched_rows_arr = np.broadcast_to(rows_arr, uniforms_arr.shape)[searchedNdxs]
+            outcomes_arr[searchedNdxs] = np.searchsorted(self.flat_cumulative_arr, uniforms_arr[searchedNdxs] + searched_rows_arr,
+                                                         side='right') - self.number_of_outcomes * searched_rows_arr
+        return outcomes_arr
+
+
+def DealerFinalSumSampler():
+    # The CategoricalSampler of the dealer's final sum, whose rows are the dealer's showing card
+    global _dealer_final_sum_sampler
+    if _dealer_final_sum_sampler is None:
+        _dealer_final_sum_sampler = CategoricalSampler(DealerFinalSumProbabilities())
+    return _dealer_final_sum_sampler
+
+_dealer_final_sum_sampler = None
+
+def DealerFinalSumProbabilities():
+    # Returns the (11, 27) array probabilities_arr[dealer_card1, final_sum] of the dealer's final sum, given the showing
+    # card, with the rules of BlackjackES.step(0). Busted hands keep their sum (22 to 26).
+    global _dealer_final_sum_probabilities_arr
+    if _dealer_final_sum_probabilities_arr is None:
+        card_probabilities = {card: (4 if card == 10 else 1) / 13 for card in range(1, 11)}  # Face cards count as 10
+        sumUsableAce_to_finalSumProbabilities = {}
+
+        def FinalSumProbabilities(dealer_sum, dealer_has_usable_ace):
+            # The dealer draws while dealer_sum <= 16
+            if dealer_sum > 16:
+                final_sum_probabilities = np.zeros(27)
+                final_sum_probabilities[dealer_sum] = 1
+                return final_sum_probabilities
+            if (dealer_sum, dealer_has_usable_ace) not in sumUsableAce_to_finalSumProbabilities:
+                final_sum_probabilities = np.zeros(27)
+                for card, card_probability in card_probabilities.items():
+                    (new_sum, new_has_usable_ace) = (dealer_sum + card, dealer_has_usable_ace)
+                    if card == 1 and dealer_sum <= 10:
+                        (new_sum, new_has_usable_ace) = (dealer_sum + 11, True)
+                    if new_sum > 21 and new_has_usable_ace:
+                        (new_sum, new_has_usable_ace) = (new_sum - 10, False)
+                    final_sum_probabilities += card_probability * FinalSumProbabilities(new_sum, new_has_usable_ace)
+                sumUsableAce_to_finalSumProbabilities[(dealer_sum, dealer_has_usable_ace)] = final_sum_probabilities
+            return sumUsableAce_to_finalSumProbabilities[(dealer_sum, dealer_has_usable_ace)]
+
+        _dealer_final_sum_probabilities_arr = np.zeros((11, 27))
+        for dealer_card1 in range(1, 11):
+            for dealer_card2, card_probability in card_probabilities.items():
+                has_usable_ace = dealer_card1 == 1 or dealer_card2 == 1
+                _dealer_final_sum_probabilities_arr[dealer_card1] += card_probability * FinalSumProbabilities(
+                    dealer_card1 + dealer_card2 + 10 * has_usable_ace, has_usable_ace)
+    return _dealer_final_sum_probabilities_arr
+
+_dealer_final_sum_probabilities_arr = None
+
+def StartObservationSampler():
+    # The CategoricalSampler of the outcome of BlackjackES.reset(): natural * NUMBER_OF_OBSERVATION_CODES + observation code
+    global _start_observation_sampler
+    if _start_observation_sampler is None:
+        card_probabilities = {card: (4 if card == 10 else 1) / 13 for card in range(1, 11)}  # Face cards count as 10
+
+        def AutomaticHitsProbabilities(player_sum, usable_ace):
+            # The probabilities of the (player_sum, usable_ace) pairs after the automatic hits below 12, which cannot bust
+            if player_sum >= 12:
+                return {(player_sum, usable_ace): 1.}
+            sumUsableAce_to_probability = collections.defaultdict(float)
+            for card, card_probability in card_probabilities.items():
+                (new_sum, new_usable_ace) = (player_sum + card, usable_ace)
+                if card == 1 and player_sum <= 10:
+                    (new_sum, new_usable_ace) = (player_sum + 11, True)
+                for sumUsableAce, probability in AutomaticHitsProbabilities(new_sum, new_usable_ace).items():
+                    sumUsableAce_to_probability[sumUsableAce] += card_probability * probability
+            return sumUsableAce_to_probability
+
+        probabilities_arr = np.zeros(2 * NUMBER_OF_OBSERVATION_CODES)
+        for card1, card1_probability in card_probabilities.items():
+            for card2, card2_probability in card_probabilities.items():
+                usable_ace = card1 == 1 or card2 == 1
+                player_sum = card1 + card2 + 10 * usable_ace
+                natural = player_sum == 21
+                for (final_sum, final_usable_ace), probability in AutomaticHitsProbabilities(player_sum, usable_ace).items():
+                    for dealer_card, dealer_card_probability in card_probabilities.items():
+                        probabilities_arr[natural * NUMBER_OF_OBSERVATION_CODES + ObservationCode(final_sum, final_usable_ace, dealer_card)] += \
+                            card1_probability * card2_probability * probability * dealer_card_probability
+        _start_observation_sampler = CategoricalSampler(probabilities_arr, number_of_buckets=2**14)
+    return _start_observation_sampler
+
+_start_observation_sampler = None
+
+
+class BlackjackEpisodes:
+    """
+    Episodes simulated by BlackjackESBatch, stored step by step: the start observations and rewards of the
+    number_of_episodes episodes, then the actions, rewards and observations of the steps of the episodes that play a
+    first step, then of those that play a second step, etc.
+    observation_codes_arr, rewards_arr: (number_of_episodes + number_of_actions,) The observation codes (Cf.
+        ObservationCode()) and the rewards received in them
+    actions_arr, episode_indices_arr: (number_of_actions,) The actions and their episodes. The observation and the reward
+        that follow action actionNdx are at number_of_episodes + actionNdx.
+    step_starts_arr: (number_of_steps + 1,) The start of each step in actions_arr, then number_of_actions
+    """
+    def __init__(self, observation_codes_arr, rewards_arr, actions_arr, episode_indices_arr, step_starts_arr):
+        self.observation_codes_arr = observation_codes_arr
+        self.rewards_arr = rewards_arr
+        self.actions_arr = actions_arr
+        self.episode_indices_arr = episode_indices_arr
+        self.step_starts_arr = step_starts_arr
+
+    def __len__(self):
+        return len(self.observation_codes_arr) - len(self.actions_arr)
+
+    def NumberOfSteps(self):
+        # The array of the number of actions of each episode
+        return np.bincount(self.episode_indices_arr, minlength=len(self))
+
+    def EpisodeOrder(self):
+        # Returns (actionNdxs_arr, episode_starts_arr): the indices of the actions sorted by episode, then by step, and the
+        # start of each episode in actionNdxs_arr
+        actionNdxs_arr = np.argsort(self.episode_indices_arr, kind='stable')  # The actions are stored by step
+        episode_starts_arr = np.concatenate(([0], np.cumsum(self.NumberOfSteps())))
+        return (actionNdxs_arr, episode_starts_arr)
+
+    def ToLists(self):
+        # Returns the episodes in the format of Episodic.Episode():
+        # [reward0, obs0, action1, reward1, obs1, action2, reward2, obs2, ..., obsN-1]
+        # The episodes are interleaved in a flat object array, so that the Python objects are created by numpy
+        number_of_episodes = len(self)
+        (actionNdxs_arr, episode_starts_arr) = self.EpisodeOrder()
+        list_starts_arr = 3 * episode_starts_arr + 2 * np.arange(number_of_episodes + 1)
+        observations_arr = ObservationTuples()[self.observation_codes_arr]
+        rewards_arr = self.rewards_arr.astype(object)
+        flat_episodes_arr = np.empty(list_starts_arr[-1], dtype=object)
+        flat_episodes_arr[list_starts_arr[: -1]] = rewards_arr[: number_of_episodes]
+        flat_episodes_arr[list_starts_arr[: -1] + 1] = observations_arr[: number_of_episodes]
+        # The position of each action: after the start of its episode and the 3 entries of each previous step
+        action_positions_arr = np.repeat(list_starts_arr[: -1] + 2 - 3 * episode_starts_arr[: -1], np.diff(episode_starts_arr)) + \
+                               3 * np.arange(len(actionNdxs_arr))
+        flat_episodes_arr[action_positions_arr] = self.actions_arr[actionNdxs_arr].astype(object)
+        flat_episodes_arr[action_positions_arr + 1] = rewards_arr[number_of_episodes + actionNdxs_arr]
+        flat_episodes_arr[action_positions_arr + 2] = observations_arr[number_of_episodes + actionNdxs_arr]
+        flat_episodes_list = flat_episodes_arr.tolist()
+        list_starts_list = list_starts_arr.tolist()
+        return [flat_episodes_list[start: end] for (start, end) in zip(list_starts_list[: -1], list_starts_list[1:])]
+
+    def StateIndices(self, states_list):
+        # Returns the array of the indices in states_list of the observations, len(states_list) for the other observations
+        code_to_index_arr = np.full(NUMBER_OF_OBSERVATION_CODES, len(states_list), dtype=np.intp)
+        for stateNdx, (player_sum, usable_ace, dealer_card) in enumerate(states_list):
+            code_to_index_arr[ObservationCode(player_sum, usable_ace, dealer_card)] = stateNdx
+        return code_to_index_arr[self.observation_codes_arr]
+
+    def Returns(self, gamma):
+        # Returns the array of the discounted returns from each observation, the reward received in the observation included
+        number_of_episodes = len(self)
+        returns_arr = np.empty(len(self.rewards_arr))
+        episode_returns_arr = np.zeros(number_of_episodes)  # The returns from the observations of the next step
+        for stepNdx in reversed(range(len(self.step_starts_arr) - 1)):
+            (start, end) = (int(self.step_starts_arr[stepNdx]), int(self.step_starts_arr[stepNdx + 1]))
+            episodeNdxs = self.episode_indices_arr[start: end]
+            step_returns_arr = self.rewards_arr[number_of_episodes + start: number_of_episodes + end] + gamma * episode_returns_arr[episodeNdxs]
+            episode_returns_arr[episodeNdxs] = step_returns_arr
+            returns_arr[number_of_episodes + start: number_of_episodes + end] = step_returns_arr
+        returns_arr[: number_of_episodes] = self.rewards_arr[: number_of_episodes] + gamma * episode_returns_arr
+        return returns_arr
+
+    def FirstVisitReturnSums(self, states_list, gamma):
+        # Returns the (counts, sums, sums_of_squares) arrays of the first-visit returns of the states of states_list, a
+        # list of (player_sum, usable_ace, dealer_card) tuples. A state cannot recur in an episode: the player's sum
+        # increases at each hit, except when the usable ace is softened, which clears usable_ace. So every visit is a
+        # first visit.
+        number_of_states = len(states_list)
+        state_indices_arr = self.StateIndices(states_list)
+        returns_arr = self.Returns(gamma)
+        return (np.bincount(state_indices_arr, minlength=number_of_states + 1)[: number_of_states],
+                np.bincount(state_indices_arr, weights=returns_arr, minlength=number_of_states + 1)[: number_of_states],
+                np.bincount(state_indices_arr, weights=returns_arr**2, minlength=number_of_states + 1)[: number_of_states])
+
+    def ToTrajectories(self, state_index=None, action_index=None):
+        # Returns the episodes as Trajectory objects, encoded with state_index and action_index (Cf. Episodic.Trajectory())
+        number_of_episodes = len(self)
+        (actionNdxs_arr, episode_starts_arr) = self.EpisodeOrder()
+        observation_codes_arr = self.observation_codes_arr
+        if state_index is not None:
+            observations_arr = self.StateIndices(state_index.states_list).astype(np.int32)
+            observations_arr[observations_arr == len(state_index.states_list)] = -1
+        else:
+            observations_arr = ObservationTuples()[observation_codes_arr]
+        actions_arr = self.actions_arr.astype(np.int32 if action_index is not None else object)
+        if action_index is not None:
+            action_to_index_arr = np.full(2, -1, dtype=np.int32)
+            for action, index in action_index.state_to_index.items():
+                action_to_index_arr[action] = index
+            actions_arr = action_to_index_arr[self.actions_arr]
+        trajectories_list = []
+        for episodeNdx in range(number_of_episodes):
+            episode_actionNdxs_arr = actionNdxs_arr[episode_starts_arr[episodeNdx]: episode_starts_arr[episodeNdx + 1]]
+            entryNdxs_arr = np.concatenate(([episodeNdx], number_of_episodes + episode_actionNdxs_arr))
+            episode_observations_arr = observations_arr[entryNdxs_arr]
+            time_to_unindexed_observation = {}
+            if state_index is not None:
+                for time in np.flatnonzero(episode_observations_arr < 0).tolist():
+                    time_to_unindexed_observation[time] = ObservationTuples()[observation_codes_arr[entryNdxs_arr[time]]]
+            trajectories_list.append(env_attributes.Trajectory.FromArrays(self.rewards_arr[entryNdxs_arr], episode_observations_arr,
+                                                                          actions_arr[episode_actionNdxs_arr], state_index, action_index,
+                                                                          time_to_unindexed_observation))
+        return trajectories_list
+
+
+class BufferedBlackjackES(BlackjackES):
+    """
+    BlackjackES whose Episode() and Trajectory() serve episodes simulated in batches by BlackjackESBatch, and whose
+    FirstVisitReturnSums() computes the first-visit return sums from the arrays of the batches, without Python objects.
+    Only the policies that have a revision attribute, incremented at each change, are buffered: the buffer is refilled
+    while the policy object, its revision and the episode arguments stay the same, and flushed when they change. The
+    other policies can change without notice, so their episodes are simulated by BlackjackES, with the random module.
+    The batch size starts at 1 after a flush and doubles with each refill, up to maximum_batch_size, so that policies
+    that change often don't pay for a large batch. All the batches are drawn from the generator seeded by seed() (or by
+    the seed argument). A batch costs at least about 0.2 ms, so the episodes whose policy or arguments change at each
+    episode, like the exploring starts of MonteCarloESPolicyIterator, are faster with BlackjackES.
+    Converting the episodes to lists or Trajectory objects costs more than their simulation: Episode() is only a few
+    times faster than BlackjackES.Episode(). FirstVisitReturnSums(), which FirstVisitPolicyEvaluator uses, is more than
+    50 times faster.
+    """
+    def __init__(self, maximum_batch_size=16384, seed=None):
+        super().__init__()
+        self.maximum_batch_size = maximum_batch_size
+        self.batch_simulator = BlackjackESBatch(seed)
+        self.buffered_episodes = collections.deque()
+        self.buffer_policy = None
+        self.buffer_key = None
+        self.batch_size = 1
+        self.hit_probabilities_arr = None  # The table of the buffer policy revision
+
+    def seed(self, seed=None):
+        self.batch_simulator = BlackjackESBatch(seed)
+        self.Flush()
+        return super().seed(seed)
+
+    def Flush(self):
+        self.buffered_episodes.clear()
+        self.buffer_policy = None
+        self.hit_probabilities_arr = None
+
+    def Episode(self, policy, start_state=None, start_action=None, maximum_number_of_steps=None):
+        if not self.IsBuffered(policy, (BlackjackEpisodes.ToLists, start_state, start_action, maximum_number_of_steps)):
+            return super().Episode(policy, start_state=start_state, start_action=start_action, maximum_number_of_steps=maximum_number_of_steps)
+        return self.NextBufferedEpisode(policy, start_state, start_action, maximum_number_of_steps, BlackjackEpisodes.ToLists)
+
+    def Trajectory(self, policy, start_state=None, start_action=None, maximum_number_of_steps=None, state_index=None, action_index=None):
+        if not self.IsBuffered(policy, (BlackjackEpisodes.ToTrajectories, start_state, start_action, maximum_number_of_steps, state_index, action_index)):
+            return super().Trajectory(policy, start_state=start_state, start_action=start_action, maximum_number_of_steps=maximum_number_of_steps,
+                                      state_index=state_index, action_index=action_index)
+        return self.NextBufferedEpisode(policy, start_state, start_action, maximum_number_of_steps,
+                                        lambda episodes: episodes.ToTrajectories(state_index, action_index))
+
+    def IsBuffered(self, policy, key):
+        # True if the policy has a revision. The buffer, whose key is the policy revision, the conversion and the episode
+        # arguments, is flushed when the key changes.
+        if not hasattr(policy, 'revision'):  # Changes of the policy cannot be detected
+            self.Flush()
+            return False
+        key = (policy.revision,) + key
+        if policy is not self.buffer_policy or key != self.buffer_key:
+            if policy is not self.buffer_policy or key[0] != self.buffer_key[0]:
+                self.hit_probabilities_arr = None
+            self.buffered_episodes.clear()
+            self.buffer_policy = policy
+            self.buffer_key = key
+            self.batch_size = 1
+        return True
+
+    def NextBufferedEpisode(self, policy, start_state, start_action, maximum_number_of_steps, Convert):
+        # Convert(BlackjackEpisodes) -> the list of the converted episodes
+        if len(self.buffered_episodes) == 0:
+            if self.hit_probabilities_arr is None:
+                self.hit_probabilities_arr = BlackjackESBatch.HitProbabilities(policy, self.StatesSet())
+            episodes = self.batch_simulator.Simulate(self.hit_probabilities_arr, self.batch_size,
+                                                     start_states=None if start_state is None else [start_state] * self.batch_size,
+                                                     start_actions=None if start_action is None else [start_action] * self.batch_size,
+                                                     maximum_number_of_steps=maximum_number_of_steps)
+            self.buffered_episodes.extend(Convert(episodes))
+            self.batch_size = min(2 * self.batch_size, self.maximum_batch_size)
+        return self.buffered_episodes.popleft()
+
+    def FirstVisitReturnSums(self, policy, number_of_episodes, states_list, gamma, maximum_number_of_steps=None):
+        # Simulates the episodes in batches of maximum_batch_size, from reset(), without buffering them
+        hit_probabilities_arr = BlackjackESBatch.HitProbabilities(policy, self.StatesSet())
+        counts_arr = np.zeros(len(states_list), dtype=np.int64)
+        sums_arr = np.zeros(len(states_list))
+        sums_of_squares_arr = np.zeros(len(states_list))
+        for batch_start in range(0, number_of_episodes, self.maximum_batch_size):
+            episodes = self.batch_simulator.Simulate(hit_probabilities_arr, min(self.maximum_batch_size, number_of_episodes - batch_start),
+                                                     maximum_number_of_steps=maximum_number_of_steps)
+            (batch_counts_arr, batch_sums_arr, batch_sums_of_squares_arr) = episodes.FirstVisitReturnSums(states_list, gamma)
+            counts_arr += batch_counts_arr
+            sums_arr += batch_sums_arr
+            sums_of_squares_arr += batch_sums_of_squares_arr
+        return (counts_arr, sums_arr, sums_of_squares_arr)
+
+
 class BlackjackES_noFaces(env_attributes.Tabulatable,
                   env_attributes.ExplorationStarts,
                   env_attributes.Episodic):
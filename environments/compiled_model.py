@@ -0,0 +1,261 @@
+import collections
+import copy
+import multiprocessing
+import os
+import numpy as np
+import scipy.sparse
+import ReinforcementLearning.environments.attributes as env_attributes
+
+
+class CompiledModel:
+    """
+    Array representation of a DynamicProgramming environment, for solvers that work on vectors instead of dictionaries
+        states_list, state_to_index: The state index map
+        actions_list, action_to_index: The action index map
+        transition_matrices: One sparse CSR matrix P[a] (S x S) per action, P[a][s, s'] = p(s' | s, a)
+        expected_rewards: (S, A) array, R[s, a] = sum_s' p(s' | s, a) r(s, a, s')
+        legal_actions_mask: (S, A) boolean array. The rows of P[a] and R[:, a] are zero where the action is illegal.
+    """
+    def __init__(self, states_list, actions_list, transition_matrices, expected_rewards, legal_actions_mask):
+        self.states_list = list(states_list)
+        self.state_to_index = {state: index for index, state in enumerate(self.states_list)}
+        self.actions_list = list(actions_list)
+        self.action_to_index = {action: index for index, action in enumerate(self.actions_list)}
+        number_of_states = len(self.states_list)
+        number_of_actions = len(self.actions_list)
+        if len(transition_matrices) != number_of_actions:
+            raise ValueError("CompiledModel.__init__(): The number of transition matrices ({}) is not the number of actions ({})".format(len(transition_matrices), number_of_actions))
+        self.transition_matrices = [scipy.sparse.csr_matrix(P) for P in transition_matrices]
+        for P in self.transition_matrices:
+            if P.shape != (number_of_states, number_of_states):
+                raise ValueError("CompiledModel.__init__(): A transition matrix has shape {}. Expected ({}, {})".format(P.shape, number_of_states, number_of_states))
+        self.expected_rewards = np.asarray(expected_rewards, dtype=float)
+        self.legal_actions_mask = np.asarray(legal_actions_mask, dtype=bool)
+        if self.expected_rewards.shape != (number_of_states, number_of_actions):
+            raise ValueError("CompiledModel.__init__(): expected_rewards.shape {} is not ({}, {})".format(self.expected_rewards.shape, number_of_states, number_of_actions))
+        if self.legal_actions_mask.shape != (number_of_states, number_of_actions):
+            raise ValueError("CompiledModel.__init__(): legal_actions_mask.shape {} is not ({}, {})".format(self.legal_actions_mask.shape, number_of_states, number_of_actions))
+        self.stacked_transition_matrix = None  # Built on demand by StackedTransitionMatrix()
+
+    def NumberOfStates(self):
+        return len(self.states_list)
+
+    def NumberOfActions(self):
+        return len(self.actions_list)
+
+    def ValuesArray(self, state_to_value_dict):
+        return np.array([state_to_value_dict[state] for state in self.states_list], dtype=float)
+
+    def ValuesDict(self, values_arr):
+        return {state: float(values_arr[index]) for index, state in enumerate(self.states_list)}
+
+    def PolicyMatrix(self, policy):
+        # Returns the (S, A) array pi[s, a] of the policy's action probabilities
+        policy_arr = np.zeros((self.NumberOfStates(), self.NumberOfActions()), dtype=float)
+        for stateNdx, state in enumerate(self.states_list):
+            for action, probability in policy.ActionProbabilities(state).items():
+                if probability == 0:
+                    continue
+                if action not in self.action_to_index:
+                    raise ValueError("CompiledModel.PolicyMatrix(): The policy selects action {} in state {}, which is not in the compiled actions list".format(action, state))
+                policy_arr[stateNdx, self.action_to_index[action]] += probability
+        return policy_arr
+
+    def PolicyTransitionMatrixAndRewards(self, policy_arr):
+        # Returns (P_pi, r_pi), with P_pi = sum_a diag(pi[:, a]) P[a] and r_pi = sum_a pi[:, a] * R[:, a]
+        P_pi = scipy.sparse.csr_matrix((self.NumberOfStates(), self.NumberOfStates()), dtype=float)
+        for actionNdx in range(self.NumberOfActions()):
+            action_probabilities = policy_arr[:, actionNdx]
+            if not action_probabilities.any():
+                continue
+            P_pi = P_pi + scipy.sparse.diags(action_probabilities) @ self.transition_matrices[actionNdx]
+        r_pi = (policy_arr * self.expected_rewards).sum(axis=1)
+        return (scipy.sparse.csr_matrix(P_pi), r_pi)
+
+    def StackedTransitionMatrix(self):
+        # The (A * S, S) vertical stack of the P[a], to compute all the action values with a single product
+        if self.stacked_transition_matrix is None:
+            self.stacked_transition_matrix = scipy.sparse.vstack(self.transition_matrices, format='csr')
+        return self.stacked_transition_matrix
+
+    def ActionValues(self, values_arr, gamma):
+        # Returns the (S, A) array Q[s, a] = R[s, a] + gamma sum_s' P[a][s, s'] v[s'], with -inf for the illegal actions
+        successor_values_arr = (self.StackedTransitionMatrix() @ values_arr).reshape(self.NumberOfActions(), self.NumberOfStates()).T
+        action_values_arr = self.expected_rewards + gamma * successor_values_arr
+        action_values_arr[~self.legal_actions_mask] = -np.inf
+        return action_values_arr
+
+    def AbsorbingStatesMask(self):
+        # A state is absorbing if all its legal actions lead back to itself with probability 1
+        self_transition_arr = np.stack([P.diagonal() for P in self.transition_matrices], axis=1)  # (S, A)
+        is_absorbing_arr = np.isclose(self_transition_arr, 1.0) | ~self.legal_actions_mask
+        return np.all(is_absorbing_arr, axis=1) & np.any(self.legal_actions_mask, axis=1)
+
+    def TerminalDistances(self):
+        # Returns the (S,) array of the minimum number of transitions to reach an absorbing state, with any action
+        # sequence. States that cannot reach an absorbing state get an infinite distance.
+        number_of_states = self.NumberOfStates()
+        reachability = scipy.sparse.csr_matrix((number_of_states, number_of_states), dtype=bool)
+        for P in self.transition_matrices:
+            reachability = reachability + (P != 0)
+        predecessors = scipy.sparse.csr_matrix(reachability.T)
+        distances_arr = np.full(number_of_states, np.inf)
+        queue = collections.deque()
+        for stateNdx in np.flatnonzero(self.AbsorbingStatesMask()):
+            distances_arr[stateNdx] = 0
+            queue.append(stateNdx)
+        while len(queue) > 0:  # Breadth-first search from the absorbing states, on the reversed transitions
+            stateNdx = queue.popleft()
+            for predecessorNdx in predecessors.indices[predecessors.indptr[stateNdx]: predecessors.indptr[stateNdx + 1]]:
+                if distances_arr[predecessorNdx] == np.inf:
+                    distances_arr[predecessorNdx] = distances_arr[stateNdx] + 1
+                    queue.append(predecessorNdx)
+        return distances_arr
+
+
+def Compile(environment, legal_actions_authority=None, number_of_processes=None):
+    """
+    Builds a CompiledModel from the transition probabilities and rewards of a DynamicProgramming environment.
+    If legal_actions_authority is None, all the actions of environment.ActionsSet() are legal in every state.
+    If number_of_processes is not None, the transitions are first computed in parallel by PrecomputeTransitions().
+    Environments that implement a vectorized ComputeCompiledModel() build the model themselves.
+    """
+    if not isinstance(environment, env_attributes.DynamicProgramming):
+        raise TypeError("compiled_model.Compile(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.DynamicProgramming".format(type(environment)))
+    model = environment.ComputeCompiledModel(legal_actions_authority)
+    if model is not None:
+        return model
+    (states_list, _, actions_list) = LegalStateActionPairs(environment, legal_actions_authority)
+    stateAction_to_newStateToProbabilityReward = {}
+    if number_of_processes is not None:
+        stateAction_to_newStateToProbabilityReward = PrecomputeTransitions(environment, legal_actions_authority, number_of_processes)
+    state_to_index = {state: index for index, state in enumerate(states_list)}
+
+    number_of_states = len(states_list)
+    number_of_actions = len(actions_list)
+    expected_rewards = np.zeros((number_of_states, number_of_actions), dtype=float)
+    legal_actions_mask = LegalActionsMask(states_list, actions_list, legal_actions_authority)
+    # Arrays of (row, column, probability) per action, concatenated at the end
+    action_to_rows = [[] for action in actions_list]
+    action_to_columns = [[] for action in actions_list]
+    action_to_probabilities = [[] for action in actions_list]
+    # The TransitionRecord objects with the same state index as the compiled model are used without conversion
+    records_state_index = environment.TransitionStateIndex() if environment.transition_record_type == 'arrays' else None
+    records_share_state_index = records_state_index is not None and records_state_index.states_list == states_list
+    for stateNdx, state in enumerate(states_list):
+        for actionNdx in np.flatnonzero(legal_actions_mask[stateNdx]).tolist():
+            action = actions_list[actionNdx]
+            new_state_to_probability_reward = stateAction_to_newStateToProbabilityReward.get((state, action))
+            if new_state_to_probability_reward is None:
+                new_state_to_probability_reward = environment.TransitionProbabilitiesAndRewards(state, action)
+            if records_share_state_index and isinstance(new_state_to_probability_reward, env_attributes.TransitionRecord) and \
+                    new_state_to_probability_reward.state_index is records_state_index:
+                columns_arr = new_state_to_probability_reward.successor_indices
+                probabilities_arr = new_state_to_probability_reward.probabilities
+                expected_rewards[stateNdx, actionNdx] = probabilities_arr @ new_state_to_probability_reward.rewards
+            else:
+                columns = []
+                probabilities = []
+                for (new_state, (probability, reward)) in new_state_to_probability_reward.items():
+                    if probability == 0:
+                        continue
+                    if new_state not in state_to_index:
+                        raise ValueError("compiled_model.Compile(): The transition ({}, {}) -> {} leads to a state that is not in environment.StatesSet()".format(state, action, new_state))
+                    columns.append(state_to_index[new_state])
+                    probabilities.append(probability)
+                    expected_rewards[stateNdx, actionNdx] += probability * reward
+                columns_arr = np.array(columns, dtype=np.int64)
+                probabilities_arr = np.array(probabilities, dtype=float)
+            action_to_rows[actionNdx].append(np.full(len(columns_arr), stateNdx, dtype=np.int64))
+            action_to_columns[actionNdx].append(columns_arr)
+            action_to_probabilities[actionNdx].append(probabilities_arr)
+
+    transition_matrices = []
+    for actionNdx in range(number_of_actions):
+        # Duplicate (row, column) entries are summed by the conversion to CSR
+        P = scipy.sparse.coo_matrix((np.concatenate(action_to_probabilities[actionNdx] + [np.zeros(0, dtype=float)]),
+                                     (np.concatenate(action_to_rows[actionNdx] + [np.zeros(0, dtype=np.int64)]),
+                                      np.concatenate(action_to_columns[actionNdx] + [np.zeros(0, dtype=np.int64)]))),
+                                    shape=(number_of_states, number_of_states)).tocsr()
+        transition_matrices.append(P)
+    return CompiledModel(states_list, actions_list, transition_matrices, expected_rewards, legal_actions_mask)
+
+
+def LegalActionsMask(states_list, actions_list, legal_actions_authority=None):
+    # Returns the (S, A) boolean array of the legal actions. None: all the actions are legal
+    if legal_actions_authority is None:
+        return np.ones((len(states_list), len(actions_list)), dtype=bool)
+    return legal_actions_authority.LegalActionMask(states_list, actions_list)
+
+
+def LegalStateActionPairs(environment, legal_actions_authority=None):
+    # Returns (states_list, state_to_legal_actions, actions_list), with sorted lists of legal actions
+    states_list = SortedIfPossible(environment.StatesSet())
+    actions_set = set(environment.ActionsSet())
+    state_to_legal_actions = {}
+    for state in states_list:
+        if legal_actions_authority is None:
+            state_to_legal_actions[state] = SortedIfPossible(actions_set)
+        else:
+            state_to_legal_actions[state] = SortedIfPossible(legal_actions_authority.ImmutableLegalActions(state))
+            actions_set = actions_set.union(state_to_legal_actions[state])  # Some authorities allow actions outside ActionsSet(), e.g. a stake of 0 in a terminal state
+    actions_list = SortedIfPossible(actions_set)
+    return (states_list, state_to_legal_actions, actions_list)
+
+
+def PrecomputeTransitions(environment, legal_actions_authority=None, number_of_processes=None, number_of_chunks_per_process=4):
+    """
+    Eagerly computes the transitions of all the (state, legal action) pairs of a DynamicProgramming environment, splitting
+    the pairs across a pool of worker processes, and merges them into the environment's transition cache.
+    The pairs are split into contiguous chunks of a fixed order, and merged in that order, so the result does not depend
+    on the number of processes. number_of_processes=None uses all the CPUs.
+    Returns the dictionary (state, action) -> newState_to_probabilityReward for all the legal pairs.
+    """
+    if not isinstance(environment, env_attributes.DynamicProgramming):
+        raise TypeError("compiled_model.PrecomputeTransitions(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.DynamicProgramming".format(type(environment)))
+    (states_list, state_to_legal_actions, actions_list) = LegalStateActionPairs(environment, legal_actions_authority)
+    stateAction_pairs = [(state, action) for state in states_list for action in state_to_legal_actions[state]]
+    cache = environment.originStateAction_to_newStateToProbabilityReward
+    stateAction_to_newStateToProbabilityReward = {stateAction: cache[stateAction] for stateAction in stateAction_pairs if stateAction in cache}
+    missing_stateAction_pairs = [stateAction for stateAction in stateAction_pairs if stateAction not in stateAction_to_newStateToProbabilityReward]
+    if number_of_processes is None:
+        number_of_processes = os.cpu_count()
+
+    if number_of_processes <= 1 or len(missing_stateAction_pairs) == 0:
+        for (state, action) in missing_stateAction_pairs:
+            stateAction_to_newStateToProbabilityReward[(state, action)] = environment.ComputeTransitionProbabilitiesAndRewards(state, action)
+    else:
+        number_of_chunks = min(len(missing_stateAction_pairs), number_of_processes * number_of_chunks_per_process)
+        chunk_boundaries = np.linspace(0, len(missing_stateAction_pairs), number_of_chunks + 1).astype(int)
+        chunks = [missing_stateAction_pairs[chunk_boundaries[chunkNdx]: chunk_boundaries[chunkNdx + 1]] for chunkNdx in range(number_of_chunks)]
+        worker_environment = copy.copy(environment)  # Don't send the transition cache to the workers
+        worker_environment.originStateAction_to_newStateToProbabilityReward = {}
+        worker_environment.stateAction_to_size_in_bytes = {}
+        with multiprocessing.Pool(number_of_processes, initializer=_InitializeWorker, initargs=(worker_environment,)) as pool:
+            chunk_results = pool.map(_ComputeTransitionsChunk, chunks)
+        for (chunk, results) in zip(chunks, chunk_results):
+            for (stateAction, newState_to_probabilityReward) in zip(chunk, results):
+                stateAction_to_newStateToProbabilityReward[stateAction] = newState_to_probabilityReward
+    for (state, action) in missing_stateAction_pairs:  # Merged in the fixed order of the pairs, according to the cache policy
+        environment.CacheTransitions(state, action, stateAction_to_newStateToProbabilityReward[(state, action)])
+    return {stateAction: stateAction_to_newStateToProbabilityReward[stateAction] for stateAction in stateAction_pairs}
+
+
+_worker_environment = None  # The environment copy of a worker process of PrecomputeTransitions()
+
+
+def _InitializeWorker(environment):
+    global _worker_environment
+    _worker_environment = environment
+
+
+def _ComputeTransitionsChunk(stateAction_pairs):
+    return [_worker_environment.ComputeTransitionProbabilitiesAndRewards(state, action) for (state, action) in stateAction_pairs]
+
+
+def SortedIfPossible(collection):
+    # States and actions are usually integers or tuples: sort them for a reproducible index map
+    try:
+        return sorted(collection)
+    except TypeError:
+        return list(collection)
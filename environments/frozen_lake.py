@@ -1,46 +1,124 @@
 import gym
 from gym import spaces
 from gym.utils import seeding
+import collections
 import numpy as np
 import random
+import scipy.sparse
 import ReinforcementLearning.algorithms.policy as rl_policy
 #import ReinforcementLearning.environments.dpenv as dpenv
 import ReinforcementLearning.environments.attributes as env_attributes
+import ReinforcementLearning.environments.compiled_model as env_compiled_model
 
-class FrozenLake(env_attributes.DynamicProgramming, env_attributes.Episodic):
-    def __init__(self, size='4x4'):
+MAPS = {  # Cf. gym.envs.toy_text.frozen_lake
+    '4x4': ("SFFF",
+            "FHFH",
+            "FFFH",
+            "HFFG"),
+    '8x8': ("SFFFFFFF",
+            "FFFFFFFF",
+            "FFFHFFFF",
+            "FFFFFHFF",
+            "FFFHFFFF",
+            "FHHFFFHF",
+            "FHFFHFHF",
+            "FFFHFFFG")
+}
+
+
+class FrozenLake(env_attributes.DynamicProgramming,
+                 env_attributes.ExplorationStarts,
+                 env_attributes.Episodic):
+    """
+    Native implementation of gym's FrozenLake. The map is a sequence of strings of 'S' (start), 'F' (frozen), 'H' (hole)
+    and 'G' (goal) cells. The states are the indices row * ncol + column.
+    Actions: 0: left, 1: down, 2: right, 3: up. On slippery ice, the agent moves with probability 1/3 in the selected
+    direction and in each of the two perpendicular directions. Moving into the border leaves the cell unchanged.
+    Entering the goal gives a reward of 1. The holes and the goal are absorbing.
+        size: '4x4' or '8x8', the maps of gym's FrozenLake-v0 and FrozenLake8x8-v0. Ignored if map_description is given.
+        map_description: A custom map, e.g. from RandomMap()
+    Unlike gym.make(), there is no limit on the number of steps: use the maximum_number_of_steps of Episode().
+    """
+    metadata = {
+        'render.modes': ['human']
+    }
+    row_column_deltas = [(0, -1), (1, 0), (0, 1), (-1, 0)]  # left, down, right, up
+
+    def __init__(self, size='4x4', map_description=None, is_slippery=True):
         super().__init__()
-        if size == '4x4':
-            self.frozen_lake = gym.make('FrozenLake-v0')
-        elif size == '8x8':
-            self.frozen_lake = gym.make('FrozenLake8x8-v0')
-        else:
-            raise NotImplementedError("FrozenLake.__init__(): Not implemented size {}".format(size))
-        self.frozen_lake.reset()
+        if map_description is None:
+            if size not in MAPS:
+                raise NotImplementedError("FrozenLake.__init__(): Not implemented size {}".format(size))
+            map_description = MAPS[size]
+        self.map_description = tuple(map_description)
+        self.nrow = len(self.map_description)
+        self.ncol = len(self.map_description[0])
+        if any(len(row_description) != self.ncol for row_description in self.map_description):
+            raise ValueError("FrozenLake.__init__(): The rows of the map don't have the same length")
+        if any(cell not in 'SFHG' for row_description in self.map_description for cell in row_description):
+            raise ValueError("FrozenLake.__init__(): The map contains characters other than 'S', 'F', 'H' and 'G'")
+        self.size = "{}x{}".format(self.nrow, self.ncol)
+        self.is_slippery = is_slippery
+        self.observation_space = spaces.Discrete(self.nrow * self.ncol)
+        self.action_space = spaces.Discrete(4)
         self.actions_set = set(range(4))
-        self.states_set = set(range(self.frozen_lake.nrow * self.frozen_lake.ncol))
-        self.holes = None
-        if size == '4x4':
-            self.holes = [(1, 1), (1, 3), (2, 3), (3, 0)]
-        elif size == '8x8':
-            self.holes = [(2, 3), (3, 5), (4, 3), (5, 1), (5, 2), (5, 6), (6, 1), (6, 4), (6, 6), (7, 3)]
-        self.goals = None
-        if size == '4x4':
-            self.goals = [(3, 3)]
-        elif size == '8x8':
-            self.goals = [(7, 7)]
-
-
-    def render(self):
-        self.frozen_lake.render()
+        self.states_set = set(range(self.nrow * self.ncol))
+        self.holes = [(row, column) for row in range(self.nrow) for column in range(self.ncol) if self.map_description[row][column] == 'H']
+        self.goals = [(row, column) for row in range(self.nrow) for column in range(self.ncol) if self.map_description[row][column] == 'G']
+        self.start_states = [self.StateFromCoordinates(row, column) for row in range(self.nrow) for column in range(self.ncol)
+                             if self.map_description[row][column] == 'S']
+        if len(self.start_states) == 0:
+            raise ValueError("FrozenLake.__init__(): The map has no start cell 'S'")
+        self.rng = np.random.default_rng()
+        self.seed()
+        (self.successors_arr, self.successor_probabilities_arr, self.successor_rewards_arr) = self.TransitionArrays()
+        self.is_terminal_arr = np.array([cell in 'GH' for row_description in self.map_description for cell in row_description])
+        # Python lists, for the scalar step()
+        self.successors_list = self.successors_arr.tolist()
+        self.successor_rewards_list = self.successor_rewards_arr.tolist()
+        self.is_terminal_list = self.is_terminal_arr.tolist()
+        self.state = self.start_states[0]
+
+    def TransitionArrays(self):
+        """
+        Returns (successors_arr, probabilities_arr, rewards_arr), of shape (S, 4, K): the K equally likely outcomes of
+        each (state, action) pair, with K = 3 on slippery ice, 1 otherwise. An outcome can appear more than once,
+        e.g. when two directions bump into the border.
+        """
+        number_of_states = self.nrow * self.ncol
+        cells_arr = np.array([cell for row_description in self.map_description for cell in row_description])
+        states_arr = np.arange(number_of_states)
+        rows_arr = states_arr // self.ncol
+        columns_arr = states_arr % self.ncol
+        direction_to_successors = np.zeros((4, number_of_states), dtype=np.int64)
+        for direction, (row_delta, column_delta) in enumerate(self.row_column_deltas):
+            new_rows_arr = np.clip(rows_arr + row_delta, 0, self.nrow - 1)
+            new_columns_arr = np.clip(columns_arr + column_delta, 0, self.ncol - 1)
+            direction_to_successors[direction] = new_rows_arr * self.ncol + new_columns_arr
+        directions_arr = np.array([[(action - 1) % 4, action, (action + 1) % 4] if self.is_slippery else [action]
+                                   for action in range(4)])  # (4, K)
+        successors_arr = direction_to_successors[directions_arr, :].transpose(2, 0, 1)  # (S, 4, K)
+        is_terminal_arr = (cells_arr == 'G') | (cells_arr == 'H')
+        successors_arr[is_terminal_arr] = states_arr[is_terminal_arr, None, None]  # The holes and the goal are absorbing
+        rewards_arr = (cells_arr[successors_arr] == 'G').astype(float)
+        rewards_arr[is_terminal_arr] = 0
+        probabilities_arr = np.full(successors_arr.shape, 1. / successors_arr.shape[2])
+        return (successors_arr, probabilities_arr, rewards_arr)
+
+    def render(self, mode='human'):
+        (row, column) = self.Coordinates()
+        for map_row, row_description in enumerate(self.map_description):
+            if map_row == row:
+                row_description = row_description[: column] + 'X' + row_description[column + 1:]
+            print(row_description)
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
+        self.rng = np.random.default_rng(seed)
         return [seed]
 
     def reset(self):
-        self.state = 0
-        self.frozen_lake.reset()
+        self.state = self.start_states[0] if len(self.start_states) == 1 else int(self.rng.choice(self.start_states))
         return (self.state, 0, False, {})
 
     def close(self):
@@ -53,38 +131,117 @@ class FrozenLake(env_attributes.DynamicProgramming, env_attributes.Episodic):
         return self.actions_set
 
     def SetState(self, state):
-        """if state not in self.states_set:
-            raise ValueError("FrozenLake.SetState(): state {} is not part of the states set ({})".format(state, self.states_set))
-        self.frozen_lake.reset()  # In case a previous experiment reached a terminal state
-        self.frozen_lake.s = state
+        if state not in self.states_set:
+            raise ValueError("FrozenLake.SetState(): state {} is not part of the states set".format(state))
         self.state = state
-        """
-        raise NotImplementedError("FrozenLake.SetState(): Not allowed by openai gym interface.")
+        return (self.state, 0, self.is_terminal_list[state], {})
 
     def step(self, action):
-        observation, reward, done, info = self.frozen_lake.step(action)
-        self.state = self.frozen_lake.s
-        return observation, reward, done, info
+        if self.is_terminal_list[self.state]:
+            return (self.state, 0, True, {})
+        successors = self.successors_list[self.state][action]
+        outcomeNdx = 0 if len(successors) == 1 else int(self.rng.random() * len(successors))
+        reward = self.successor_rewards_list[self.state][action][outcomeNdx]
+        self.state = successors[outcomeNdx]
+        return (self.state, reward, self.is_terminal_list[self.state], {})
+
+    def StepMany(self, states, actions, rng=None):
+        """
+        Vectorized step() of independent agents: states[i] and actions[i] are the state and the action of agent i
+        rng: The numpy Generator that draws the slips. None: self.rng
+        Returns (new_states_arr, rewards_arr, dones_arr). self.state is not changed.
+        """
+        if rng is None:
+            rng = self.rng
+        states_arr = np.asarray(states, dtype=np.int64)
+        actions_arr = np.asarray(actions, dtype=np.int64)
+        if states_arr.shape != actions_arr.shape:
+            raise ValueError("FrozenLake.StepMany(): The shape of the states ({}) is not the shape of the actions ({})".format(states_arr.shape, actions_arr.shape))
+        number_of_outcomes = self.successors_arr.shape[2]
+        outcomeNdxs_arr = rng.integers(0, number_of_outcomes, size=states_arr.shape) if number_of_outcomes > 1 else np.zeros(states_arr.shape, dtype=np.int64)
+        new_states_arr = self.successors_arr[states_arr, actions_arr, outcomeNdxs_arr]
+        rewards_arr = self.successor_rewards_arr[states_arr, actions_arr, outcomeNdxs_arr]
+        return (new_states_arr, rewards_arr, self.is_terminal_arr[new_states_arr])
 
     def ComputeTransitionProbabilitiesAndRewards(self, state, action):
-        newState_to_probabilityReward = {}
         """
         action: 0 = left     1 = down     2 = right       3 = up
         """
-        action_to_probStateRewardDoneList = self.frozen_lake.P[state]
-        probStateRewardDoneList = action_to_probStateRewardDoneList[action]
-        for newStateNdx in range(len(probStateRewardDoneList)):
-            newState = probStateRewardDoneList[newStateNdx][1]
-            probability = probStateRewardDoneList[newStateNdx][0]
-            reward = probStateRewardDoneList[newStateNdx][2]
-            newState_to_probabilityReward[newState] = (probability, reward)
+        newState_to_probabilityReward = {}
+        for (new_state, probability, reward) in zip(self.successors_list[state][action],
+                                                    self.successor_probabilities_arr[state, action].tolist(),
+                                                    self.successor_rewards_list[state][action]):
+            # A successor reached by several directions accumulates their probabilities. Its reward doesn't depend on the direction.
+            previous_probability = newState_to_probabilityReward.get(new_state, (0, reward))[0]
+            newState_to_probabilityReward[new_state] = (previous_probability + probability, reward)
         return newState_to_probabilityReward
 
+    def ComputeCompiledModel(self, legal_actions_authority=None):
+        number_of_states = self.nrow * self.ncol
+        states_list = list(range(number_of_states))
+        actions_list = [0, 1, 2, 3]
+        legal_actions_mask = env_compiled_model.LegalActionsMask(states_list, actions_list, legal_actions_authority)
+        number_of_outcomes = self.successors_arr.shape[2]
+        transition_matrices = []
+        for action in actions_list:
+            probabilities_arr = self.successor_probabilities_arr[:, action, :] * legal_actions_mask[:, action, None]
+            # Duplicate (row, column) entries are summed by the conversion to CSR
+            P = scipy.sparse.coo_matrix((probabilities_arr.ravel(), (np.repeat(np.arange(number_of_states), number_of_outcomes), self.successors_arr[:, action, :].ravel())),
+                                        shape=(number_of_states, number_of_states)).tocsr()
+            transition_matrices.append(P)
+        expected_rewards = np.sum(self.successor_probabilities_arr * self.successor_rewards_arr, axis=2) * legal_actions_mask
+        return env_compiled_model.CompiledModel(states_list, actions_list, transition_matrices, expected_rewards, legal_actions_mask)
 
-    def Coordinates(self, state):
-        row = state//self.frozen_lake.ncol
-        column = state - self.frozen_lake.ncol * row
+    def ModelParameters(self):
+        model_parameters = super().ModelParameters()
+        for name in ['states_set', 'start_states', 'holes', 'goals', 'successors_list', 'successor_rewards_list', 'is_terminal_list']:
+            model_parameters.pop(name, None)  # Derived from the map
+        return model_parameters
+
+    def Coordinates(self, state=None):
+        if state is None:
+            state = self.state
+        row = state//self.ncol
+        column = state - self.ncol * row
         return (row, column)
 
     def StateFromCoordinates(self, row, column):
-        return self.frozen_lake.ncol * row + column
\ No newline at end of file
+        return self.ncol * row + column
+
+
+def RandomMap(size=8, frozen_probability=0.8, rng=None):
+    """
+    Returns a random size x size map, with the start in the top left corner and the goal in the bottom right corner.
+    Each other cell is frozen with probability frozen_probability, otherwise it is a hole. Maps without a path from
+    the start to the goal are rejected, Cf. gym.envs.toy_text.frozen_lake.generate_random_map()
+    """
+    if size < 2:
+        raise ValueError("frozen_lake.RandomMap(): The size ({}) must be at least 2".format(size))
+    if frozen_probability <= 0 or frozen_probability > 1:
+        raise ValueError("frozen_lake.RandomMap(): The frozen probability ({}) is not in (0, 1]".format(frozen_probability))
+    if rng is None:
+        rng = np.random.default_rng()
+    while True:
+        cells_arr = np.where(rng.random((size, size)) < frozen_probability, 'F', 'H')
+        cells_arr[0, 0] = 'S'
+        cells_arr[-1, -1] = 'G'
+        if GoalIsReachable(cells_arr != 'H'):
+            return tuple(''.join(row_cells) for row_cells in cells_arr)
+
+def GoalIsReachable(is_safe_arr):
+    # Breadth-first search from the top left corner to the bottom right corner, through the safe cells
+    (number_of_rows, number_of_columns) = is_safe_arr.shape
+    is_safe_list = is_safe_arr.tolist()
+    is_discovered_list = [[False] * number_of_columns for row in range(number_of_rows)]
+    is_discovered_list[0][0] = True
+    frontier = collections.deque([(0, 0)])
+    while len(frontier) > 0:
+        (row, column) = frontier.popleft()
+        if row == number_of_rows - 1 and column == number_of_columns - 1:
+            return True
+        for (new_row, new_column) in [(row, column - 1), (row + 1, column), (row, column + 1), (row - 1, column)]:
+            if 0 <= new_row < number_of_rows and 0 <= new_column < number_of_columns and \
+                    is_safe_list[new_row][new_column] and not is_discovered_list[new_row][new_column]:
+                is_discovered_list[new_row][new_column] = True
+                frontier.append((new_row, new_column))
+    return False
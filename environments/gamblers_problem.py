@@ -8,13 +8,26 @@ import ReinforcementLearning.algorithms.policy as rl_policy
 import ReinforcementLearning.environments.attributes as env_attributes
 import math
 
+MAXIMUM_GOAL = 10**5  # A sweep of IterateValues() takes about 4 s at this goal
+STAKES_BLOCK_SIZE = 2**20  # The number of action values computed at once by IterateValues()
+MINIMUM_CAPITALS_BLOCK_SIZE = 16  # Keeps the number of blocks low where the stakes are many
+
 class GamblersProblem(env_attributes.DynamicProgramming):
-    def __init__(self, heads_probability=0.5):
+    # Cf. 'Reinforcement Learning', Sutton and Barto, p. 84
+    # The states are the capitals [0, 1, ..., goal] and the actions are the stakes [1, 2, ..., goal - 1]. StatesSet() and
+    # ActionsSet() return sets; states_range and actions_range hold the same values as ranges.
+    # goal: Up to MAXIMUM_GOAL, since a sweep of value iteration is quadratic in the goal
+    def __init__(self, heads_probability=0.5, goal=100):
         super().__init__()
+        if not isinstance(goal, int) or not 2 <= goal <= MAXIMUM_GOAL:
+            raise ValueError("GamblersProblem.__init__(): The goal ({}) must be an integer in [2, {}]".format(goal, MAXIMUM_GOAL))
         self.heads_probability = heads_probability
+        self.goal = goal
         self.state = 1
-        self.actions_set = set(list(range(1, 100)))  # [1, 2, ..., 99]
-        self.states_set = set(list(range(0, 101)))
+        self.actions_range = range(1, goal)  # [1, 2, ..., goal - 1]
+        self.states_range = range(0, goal + 1)
+        self.actions_set = set(self.actions_range)
+        self.states_set = set(self.states_range)
         self.seed()
         self.rng = np.random.default_rng()
 
@@ -26,14 +39,14 @@ class GamblersProblem(env_attributes.DynamicProgramming):
         reward = 0
         done = False
         info_dict = None
-        if self.state == 0 or self.state == 100:
+        if self.state == 0 or self.state == self.goal:
             return (self.state, 0, True, info_dict)
 
         random_0to1 = random.random()
         if random_0to1 < self.heads_probability:  # gambler wins
             self.state += stake
-            if self.state >= 100:
-                self.state = 100
+            if self.state >= self.goal:
+                self.state = self.goal
                 reward = 1
                 done = True
         else:  # gambler loses
@@ -54,6 +67,7 @@ class GamblersProblem(env_attributes.DynamicProgramming):
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
+        self.rng = np.random.default_rng(seed)
         return [seed]
 
     def StatesSet(self):
@@ -69,11 +83,11 @@ class GamblersProblem(env_attributes.DynamicProgramming):
 
     def ComputeTransitionProbabilitiesAndRewards(self, state, action):
         newState_to_probabilityAndReward_dict = {}
-        if state == 0 or state == 100:
+        if state == 0 or state == self.goal:
             return {state: (1, 0)}
         stake = action
-        if state + stake >= 100:
-            newState_to_probabilityAndReward_dict[100] = (self.heads_probability, 1)
+        if state + stake >= self.goal:
+            newState_to_probabilityAndReward_dict[self.goal] = (self.heads_probability, 1)
         else:
             newState_to_probabilityAndReward_dict[state + stake] = (self.heads_probability, 0)
 
@@ -83,15 +97,86 @@ class GamblersProblem(env_attributes.DynamicProgramming):
             newState_to_probabilityAndReward_dict[state - stake] = (1 - self.heads_probability, 0)
         return newState_to_probabilityAndReward_dict
 
+    def IterateValues(self, gamma, minimum_change, maximum_number_of_iterations, legal_actions_authority=None):
+        """
+        Value iteration with the stakes of GamblersPossibleStakes. With a legal stake, the two successors of a capital s
+        are s + stake and s - stake. The capitals are processed in blocks: the action values of a block, for all the
+        stakes up to the largest legal stake in the block, are the sum of two (capitals, stakes) windows of the win and
+        loss value arrays, padded with -inf so that the illegal stakes are never selected. A sweep still costs
+        O(goal^2 / 4) operations: about 50 ms at goal 10^4 and 4 s at 10^5 (MAXIMUM_GOAL).
+        Returns (state_to_value, state_to_most_valuable_action, completed_iterations), or None for other authorities
+        """
+        if not isinstance(legal_actions_authority, GamblersPossibleStakes) or legal_actions_authority.goal != self.goal:
+            return None
+        goal = self.goal
+        maximum_stake = goal//2
+        values_arr = np.zeros(goal + 1, dtype=float)
+        highest_values_arr = np.zeros(goal + 1, dtype=float)
+        most_valuable_stakes_arr = np.zeros(goal + 1, dtype=np.int64)  # The terminal states keep the stake 0
+        # padded_win_values_arr[maximum_stake + capital]; the loss values are reversed, so that the windows of both arrays
+        # run over increasing stakes
+        padded_win_values_arr = np.full(goal + 1 + 2 * maximum_stake, float('-inf'))
+        reversed_padded_loss_values_arr = np.full(goal + 1 + 2 * maximum_stake, float('-inf'))
+        blocks_list = []  # [(first_capital, end_capital, number_of_stakes)], with about STAKES_BLOCK_SIZE action values each
+        first_capital = 1
+        while first_capital < goal:
+            estimated_number_of_stakes = max(min(first_capital + math.isqrt(STAKES_BLOCK_SIZE), goal - first_capital, maximum_stake), 1)
+            end_capital = min(first_capital + max(STAKES_BLOCK_SIZE//estimated_number_of_stakes, MINIMUM_CAPITALS_BLOCK_SIZE), goal)
+            number_of_stakes = min(end_capital - 1, goal - first_capital, maximum_stake)  # The largest legal stake in the block
+            blocks_list.append((first_capital, end_capital, number_of_stakes))
+            first_capital = end_capital
+        action_values_buffer_arr = np.empty(max((end_capital - first_capital) * number_of_stakes
+                                                for (first_capital, end_capital, number_of_stakes) in blocks_list), dtype=float)
+        evaluation_is_stable = False
+        completed_iterations = 0
+        while not evaluation_is_stable and completed_iterations < maximum_number_of_iterations:
+            # The value of landing in each capital: the reward (1 at the goal) plus the discounted value
+            landing_values_arr = gamma * values_arr
+            landing_values_arr[goal] += 1
+            padded_win_values_arr[maximum_stake: maximum_stake + goal + 1] = self.heads_probability * landing_values_arr
+            reversed_padded_loss_values_arr[maximum_stake: maximum_stake + goal + 1] = (1 - self.heads_probability) * landing_values_arr[::-1]
+            for (first_capital, end_capital, number_of_stakes) in blocks_list:
+                # Row capital, column stake - 1: win value of capital + stake, loss value of capital - stake
+                win_windows_arr = np.lib.stride_tricks.sliding_window_view(padded_win_values_arr, number_of_stakes)[
+                    maximum_stake + first_capital + 1: maximum_stake + end_capital + 1]
+                loss_windows_arr = np.lib.stride_tricks.sliding_window_view(reversed_padded_loss_values_arr, number_of_stakes)[
+                    maximum_stake + goal - end_capital + 2: maximum_stake + goal - first_capital + 2][::-1]
+                action_values_arr = action_values_buffer_arr[: (end_capital - first_capital) * number_of_stakes].reshape(end_capital - first_capital, number_of_stakes)
+                np.add(win_windows_arr, loss_windows_arr, out=action_values_arr)
+                stake_indices_arr = np.argmax(action_values_arr, axis=1)  # Ties keep the lowest stake
+                highest_values_arr[first_capital: end_capital] = np.take_along_axis(action_values_arr, stake_indices_arr[:, None], axis=1)[:, 0]
+                most_valuable_stakes_arr[first_capital: end_capital] = stake_indices_arr + 1
+            evaluation_is_stable = not np.any(np.abs(highest_values_arr - values_arr) > minimum_change)
+            values_arr[:] = highest_values_arr
+            completed_iterations += 1
+        state_to_value = dict(zip(self.states_range, values_arr.tolist()))
+        state_to_most_valuable_action = dict(zip(self.states_range, most_valuable_stakes_arr.tolist()))
+        return (state_to_value, state_to_most_valuable_action, completed_iterations)
+
 
 class GamblersPossibleStakes(rl_policy.LegalActionsAuthority):
-    def __init__(self):
+    def __init__(self, goal=100):
         super().__init__()
+        self.goal = goal
 
     def LegalActions(self, state):
-        if state == 100 or state == 0:
-            return {0}
-        max_stake = state
-        if state + max_stake > 100:
-            max_stake = 100 - state
-        return set(list(range(1, max_stake + 1)))
\ No newline at end of file
+        # Returns an immutable range of stakes
+        if state == self.goal or state == 0:
+            return range(0, 1)  # {0}
+        return range(1, min(state, self.goal - state) + 1)
+
+    def MaximumStakes(self, states_arr):
+        # Vectorized upper bound of the legal stakes, for an array of capitals. The terminal capitals get 0.
+        states_arr = np.asarray(states_arr)
+        return np.minimum(states_arr, self.goal - states_arr)
+
+    def LegalActionMask(self, states_list, actions_list):
+        states_arr = np.asarray(states_list, dtype=np.int64)
+        actions_arr = np.asarray(actions_list, dtype=np.int64)
+        maximum_stakes_arr = self.MaximumStakes(states_arr)
+        is_terminal_arr = maximum_stakes_arr == 0
+        legal_actions_mask = np.where(is_terminal_arr[:, None], actions_arr[None, :] == 0,
+                                      (actions_arr[None, :] >= 1) & (actions_arr[None, :] <= maximum_stakes_arr[:, None]))
+        if np.any(np.sum(legal_actions_mask, axis=1) != np.maximum(maximum_stakes_arr, 1)):
+            raise ValueError("GamblersPossibleStakes.LegalActionMask(): Some legal stakes are not in the actions list")
+        return legal_actions_mask
@@ -2,10 +2,12 @@ import gym
 from gym import spaces
 from gym.utils import seeding
 import numpy as np
+import scipy.sparse
 import random
 import ReinforcementLearning.algorithms.policy as rl_policy
 #import ReinforcementLearning.environments.dpenv as dpenv
 import ReinforcementLearning.environments.attributes as env_attributes
+import ReinforcementLearning.environments.compiled_model as env_compiled_model
 
 
 class GridWorld1(env_attributes.DynamicProgramming,
@@ -291,6 +293,217 @@ class GridWorld2x2(env_attributes.DynamicProgramming,
         return new_state_to_probability_reward
 
 
+class GridWorld(env_attributes.DynamicProgramming,
+                env_attributes.GymCompatible):
+    """
+    Parametric grid world. The states are the indices row * width + column of the cells that are not walls.
+    Actions: 0: north, 1: south, 2: east, 3: west
+        teleports: {(row, column): ((new_row, new_column), reward)}. From these cells, any action leads to the new cell,
+            like A -> A' and B -> B' in 'Reinforcement Learning', Sutton and Barto, p.71
+        walls: Iterable of (row, column) cells that cannot be entered. Bumping into a wall or the border leaves the state
+            unchanged, with reward bump_reward.
+        terminals: Iterable of (row, column) absorbing cells, with reward 0. An episode ends when it enters one.
+        slip_probability: The probability to move in one of the two directions perpendicular to the selected
+            action (slip_probability / 2 each)
+    The successors are computed arithmetically, and ComputeCompiledModel() builds the whole model with array operations.
+    GridWorld(5, 5, teleports={(0, 1): ((4, 1), 10.), (0, 3): ((2, 3), 5.)}) has the same dynamics as GridWorld1.
+    """
+    metadata = {
+        'render.modes': ['human']
+    }
+    row_column_deltas = [(-1, 0), (1, 0), (0, 1), (0, -1)]  # north, south, east, west
+    perpendicular_actions = [(2, 3), (2, 3), (0, 1), (0, 1)]
+
+    def __init__(self, width=5, height=5, teleports=None, walls=None, terminals=None, slip_probability=0.,
+                 bump_reward=-1., step_reward=0.):
+        super().__init__()
+        if width < 1 or height < 1:
+            raise ValueError("GridWorld.__init__(): The width ({}) and the height ({}) must be positive".format(width, height))
+        if slip_probability < 0 or slip_probability > 1:
+            raise ValueError("GridWorld.__init__(): The slip probability ({}) is not in [0, 1]".format(slip_probability))
+        self.width = width
+        self.height = height
+        self.teleports = {} if teleports is None else dict(teleports)
+        self.walls = set() if walls is None else set(walls)
+        self.terminals = set() if terminals is None else set(terminals)
+        self.slip_probability = slip_probability
+        self.bump_reward = bump_reward
+        self.step_reward = step_reward
+        for (row, column) in list(self.teleports.keys()) + [destination for (destination, reward) in self.teleports.values()] + \
+                list(self.walls) + list(self.terminals):
+            if row < 0 or row >= self.height or column < 0 or column >= self.width:
+                raise ValueError("GridWorld.__init__(): Cell ({}, {}) is out of the {}x{} grid".format(row, column, self.height, self.width))
+        for (row, column) in list(self.teleports.keys()) + [destination for (destination, reward) in self.teleports.values()] + list(self.terminals):
+            if (row, column) in self.walls:
+                raise ValueError("GridWorld.__init__(): Cell ({}, {}) is a wall".format(row, column))
+        self.states_set = set(range(self.width * self.height)) - {self.StateFromCoordinates(row, column) for (row, column) in self.walls}
+        self.observation_space = spaces.Discrete(self.width * self.height)
+        self.action_space = spaces.Discrete(4)
+        self.actionsList = ['north', 'south', 'east', 'west']
+        self.state = min(self.states_set)
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def step(self, action_index):
+        direction = action_index
+        if self.slip_probability > 0:
+            random_0to1 = random.random()
+            if random_0to1 < self.slip_probability / 2:
+                direction = self.perpendicular_actions[action_index][0]
+            elif random_0to1 < self.slip_probability:
+                direction = self.perpendicular_actions[action_index][1]
+        (self.state, reward) = self.Successor(self.state, direction)
+        return (self.state, reward, self.Coordinates() in self.terminals, None)
+
+    def reset(self):
+        non_terminal_states = sorted(self.states_set - {self.StateFromCoordinates(row, column) for (row, column) in self.terminals})
+        self.state = random.choice(non_terminal_states)
+        return self.state
+
+    def render(self, mode='human'):
+        coordinates = self.Coordinates()
+        for row in range(self.height):
+            for column in range(self.width):
+                if (row, column) == coordinates:
+                    print (' X ', end='', flush=True)
+                elif (row, column) in self.walls:
+                    print (' # ', end='', flush=True)
+                elif (row, column) in self.terminals:
+                    print (' T ', end='', flush=True)
+                else:
+                    print (' . ', end='', flush=True)
+            print()
+
+    def close(self):
+        pass
+
+    def Coordinates(self, state=None):
+        if state is None:
+            state = self.state
+        if state < 0 or state >= self.width * self.height:
+            raise ValueError("GridWorld.Coordinates(): state {} is out of range [0, {}]".format(state, self.width * self.height - 1))
+        return (state // self.width, state % self.width)
+
+    def StateFromCoordinates(self, row, column):
+        if row < 0 or row >= self.height or column < 0 or column >= self.width:
+            raise ValueError("GridWorld.StateFromCoordinates(): Coordinates ({}, {}) are out of range".format(row, column))
+        return row * self.width + column
+
+    def StatesSet(self):
+        return self.states_set
+
+    def SetState(self, index):
+        if index not in self.states_set:
+            raise ValueError("GridWorld.SetState(): index {} is not a state".format(index))
+        self.state = index
+
+    def ActionsSet(self):
+        return set(range(4))
+
+    def ModelParameters(self):
+        model_parameters = super().ModelParameters()
+        model_parameters.pop('states_set')
+        model_parameters['teleports'] = tuple(sorted(self.teleports.items()))
+        return model_parameters
+
+    def Successor(self, state, direction):
+        # Returns (new_state, reward) when the agent moves in the direction, without slipping
+        (row, column) = self.Coordinates(state)
+        if (row, column) in self.terminals:
+            return (state, 0)
+        if (row, column) in self.teleports:
+            ((new_row, new_column), reward) = self.teleports[(row, column)]
+            return (self.StateFromCoordinates(new_row, new_column), reward)
+        (row_delta, column_delta) = self.row_column_deltas[direction]
+        (new_row, new_column) = (row + row_delta, column + column_delta)
+        if new_row < 0 or new_row >= self.height or new_column < 0 or new_column >= self.width or (new_row, new_column) in self.walls:
+            return (state, self.bump_reward)
+        return (self.StateFromCoordinates(new_row, new_column), self.step_reward)
+
+    def DirectionProbabilities(self, action):
+        # Returns the list of (direction, probability) of the actual moves, with non-zero probabilities
+        direction_probability_list = [(action, 1. - self.slip_probability)]
+        for perpendicular_action in self.perpendicular_actions[action]:
+            direction_probability_list.append((perpendicular_action, self.slip_probability / 2))
+        return [(direction, probability) for (direction, probability) in direction_probability_list if probability > 0]
+
+    def ComputeTransitionProbabilitiesAndRewards(self, state, action):
+        new_state_to_probability_reward = {}
+        for (direction, probability) in self.DirectionProbabilities(action):
+            (new_state, reward) = self.Successor(state, direction)
+            (previous_probability, previous_reward) = new_state_to_probability_reward.get(new_state, (0, 0))
+            total_probability = previous_probability + probability
+            new_state_to_probability_reward[new_state] = (total_probability,
+                                                          (previous_probability * previous_reward + probability * reward) / total_probability)
+        return new_state_to_probability_reward
+
+    def ComputeCompiledModel(self, legal_actions_authority=None):
+        number_of_cells = self.width * self.height
+        is_wall_arr = np.zeros(number_of_cells, dtype=bool)
+        for (row, column) in self.walls:
+            is_wall_arr[self.StateFromCoordinates(row, column)] = True
+        cells_arr = np.flatnonzero(~is_wall_arr)  # The states, in increasing order
+        number_of_states = len(cells_arr)
+        cell_to_stateNdx_arr = np.full(number_of_cells, -1, dtype=np.int64)
+        cell_to_stateNdx_arr[cells_arr] = np.arange(number_of_states)
+        rows_arr = cells_arr // self.width
+        columns_arr = cells_arr % self.width
+
+        # Special cells: their successor doesn't depend on the direction
+        special_stateNdxs = []
+        special_destination_cells = []
+        special_rewards = []
+        for ((row, column), ((new_row, new_column), reward)) in self.teleports.items():
+            if (row, column) not in self.terminals:
+                special_stateNdxs.append(cell_to_stateNdx_arr[self.StateFromCoordinates(row, column)])
+                special_destination_cells.append(self.StateFromCoordinates(new_row, new_column))
+                special_rewards.append(reward)
+        for (row, column) in self.terminals:
+            special_stateNdxs.append(cell_to_stateNdx_arr[self.StateFromCoordinates(row, column)])
+            special_destination_cells.append(self.StateFromCoordinates(row, column))
+            special_rewards.append(0)
+
+        # Successor state indices and rewards of the moves in each direction, (4, S)
+        direction_to_successors = np.zeros((4, number_of_states), dtype=np.int64)
+        direction_to_rewards = np.zeros((4, number_of_states), dtype=float)
+        for direction, (row_delta, column_delta) in enumerate(self.row_column_deltas):
+            new_rows_arr = rows_arr + row_delta
+            new_columns_arr = columns_arr + column_delta
+            is_inside_arr = (new_rows_arr >= 0) & (new_rows_arr < self.height) & (new_columns_arr >= 0) & (new_columns_arr < self.width)
+            new_cells_arr = np.where(is_inside_arr, new_rows_arr * self.width + new_columns_arr, cells_arr)
+            is_blocked_arr = ~is_inside_arr | is_wall_arr[new_cells_arr]
+            direction_to_successors[direction] = np.where(is_blocked_arr, np.arange(number_of_states), cell_to_stateNdx_arr[new_cells_arr])
+            direction_to_rewards[direction] = np.where(is_blocked_arr, self.bump_reward, self.step_reward)
+            direction_to_successors[direction, special_stateNdxs] = cell_to_stateNdx_arr[special_destination_cells]
+            direction_to_rewards[direction, special_stateNdxs] = special_rewards
+
+        states_list = cells_arr.tolist()
+        actions_list = [0, 1, 2, 3]
+        legal_actions_mask = env_compiled_model.LegalActionsMask(states_list, actions_list, legal_actions_authority)
+        transition_matrices = []
+        expected_rewards = np.zeros((number_of_states, len(actions_list)), dtype=float)
+        for action in actions_list:
+            rows_list = []
+            columns_list = []
+            probabilities_list = []
+            for (direction, probability) in self.DirectionProbabilities(action):
+                rows_list.append(np.arange(number_of_states))
+                columns_list.append(direction_to_successors[direction])
+                probabilities_list.append(np.full(number_of_states, probability))
+                expected_rewards[:, action] += probability * direction_to_rewards[direction]
+            probabilities_arr = np.concatenate(probabilities_list) * np.tile(legal_actions_mask[:, action], len(probabilities_list))
+            # Duplicate (row, column) entries, e.g. two directions blocked by walls, are summed by the conversion to CSR
+            P = scipy.sparse.coo_matrix((probabilities_arr, (np.concatenate(rows_list), np.concatenate(columns_list))),
+                                        shape=(number_of_states, number_of_states)).tocsr()
+            P.eliminate_zeros()
+            transition_matrices.append(P)
+        expected_rewards[~legal_actions_mask] = 0
+        return env_compiled_model.CompiledModel(states_list, actions_list, transition_matrices, expected_rewards, legal_actions_mask)
+
+
 
 
 """ 
@@ -6,6 +6,7 @@ import random
 import ReinforcementLearning.algorithms.policy as rl_policy
 #import ReinforcementLearning.environments.dpenv as dpenv
 import ReinforcementLearning.environments.attributes as env_attributes
+import ReinforcementLearning.environments.compiled_model as env_compiled_model
 import math
 
 
@@ -31,9 +32,12 @@ class JacksCarRental(env_attributes.DynamicProgramming):
         self.exercise_4_4_additional_parking_cost = 4.
         self.exercise_4_4_parking_limit = 10
         self.rng = np.random.default_rng()
+        self.poisson_maximum = 13  # The rentals and returns are truncated at this value in the transition model
+        self.location_transition_tables = None  # Built on demand by LocationTransitionTables()
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
+        self.rng = np.random.default_rng(seed)
         return [seed]
 
     @staticmethod
@@ -89,6 +93,44 @@ class JacksCarRental(env_attributes.DynamicProgramming):
 
         return (new_state, reward, False, None)
 
+    def StepMany(self, states, actions, rng=None):
+        """
+        Vectorized step() of independent rental systems: states[i] and actions[i] are the state and the action of system i
+        rng: The numpy Generator that draws the rentals and returns. None: self.rng
+        Returns (new_states_arr, rewards_arr). self.state is not changed.
+        """
+        if rng is None:
+            rng = self.rng
+        states_arr = np.asarray(states, dtype=np.int64)
+        actions_arr = np.asarray(actions, dtype=np.int64)
+        if states_arr.shape != actions_arr.shape:
+            raise ValueError("JacksCarRental.StepMany(): The shape of the states ({}) is not the shape of the actions ({})".format(states_arr.shape, actions_arr.shape))
+        out_of_range_arr = (states_arr < 0) | (states_arr >= self.observation_space.n)
+        if np.any(out_of_range_arr):
+            raise ValueError("JacksCarRental.StepMany(): state {} is out of range [0, {}]".format(states_arr[out_of_range_arr][0], self.observation_space.n - 1))
+        cars_at_location1_arr = states_arr // 21 - actions_arr
+        cars_at_location2_arr = states_arr % 21 + actions_arr
+        illegal_arr = (cars_at_location1_arr < 0) | (cars_at_location2_arr < 0)
+        if np.any(illegal_arr):
+            firstNdx = np.flatnonzero(illegal_arr)[0]
+            raise ValueError("JacksCarRental.StepMany(): action = {}, state = {}; the number of cars at a location would be < 0 ({}, {})".format(
+                actions_arr.flat[firstNdx], states_arr.flat[firstNdx], cars_at_location1_arr.flat[firstNdx], cars_at_location2_arr.flat[firstNdx]))
+        start_cars_at_location1_arr = np.minimum(cars_at_location1_arr, 20)
+        start_cars_at_location2_arr = np.minimum(cars_at_location2_arr, 20)
+
+        # Rentals
+        location1_rentals_arr = np.minimum(rng.poisson(self.location1_rental_average, size=states_arr.shape), start_cars_at_location1_arr)
+        location2_rentals_arr = np.minimum(rng.poisson(self.location2_rental_average, size=states_arr.shape), start_cars_at_location2_arr)
+
+        # Returns
+        cars_at_location1_arr = np.minimum(start_cars_at_location1_arr - location1_rentals_arr + rng.poisson(self.location1_return_average, size=states_arr.shape), 20)
+        cars_at_location2_arr = np.minimum(start_cars_at_location2_arr - location2_rentals_arr + rng.poisson(self.location2_return_average, size=states_arr.shape), 20)
+
+        rewards_arr = self.Rewards(actions_arr, location1_rentals_arr, location2_rentals_arr,
+                                   start_cars_at_location1_arr, start_cars_at_location2_arr)
+        new_states_arr = self.StateFromCarsAtEachLocation(cars_at_location1_arr, cars_at_location2_arr)
+        return (new_states_arr, rewards_arr)
+
     def reset(self):
         self.state = np.random.randint(self.observation_space.n)
         return self.state
@@ -112,61 +154,89 @@ class JacksCarRental(env_attributes.DynamicProgramming):
         return set(self.actions_list)
 
     def ComputeTransitionProbabilitiesAndRewards(self, state, action):
-        poisson_maximum = 13
         (cars_at_location1, cars_at_location2) = self.NumberOfCarsAtEachLocation(state)
-        number_of_moves_from_location1_to_location2 = action  # [-5, -4, ...., 5]
-        transition_probabilities_arr = np.zeros((21, 21), dtype=float)
-        final_state_to_weighted_reward = {s: 0 for s in self.StatesSet()}
-
-        start_cars_at_location1 = np.clip(cars_at_location1 - number_of_moves_from_location1_to_location2, 0, 20)
-        start_cars_at_location2 = np.clip(cars_at_location2 + number_of_moves_from_location1_to_location2, 0, 20)
-        for rentals_at_location1 in range(poisson_maximum + 1):
-            actual_rentals_at_location1 = min(rentals_at_location1, start_cars_at_location1)
-            for rentals_at_location2 in range(poisson_maximum + 1):
-                actual_rentals_at_location2 = min(rentals_at_location2, start_cars_at_location2)
-                for returns_at_location1 in range(poisson_maximum + 1):
-                    final_cars_at_location1 = np.clip(start_cars_at_location1 - actual_rentals_at_location1 + returns_at_location1, 0, 20)
-                    for returns_at_location2 in range(poisson_maximum + 1):
-                        final_cars_at_location2 = np.clip(start_cars_at_location2 - actual_rentals_at_location2 + returns_at_location2, 0, 20)
-                        probability = Poisson(self.location1_return_average, returns_at_location1) * \
-                                      Poisson(self.location1_rental_average, rentals_at_location1) * \
-                                      Poisson(self.location2_return_average, returns_at_location2) * \
-                                      Poisson(self.location2_rental_average, rentals_at_location2)
-                        reward = self.Reward(number_of_moves_from_location1_to_location2, actual_rentals_at_location1,
-                                             actual_rentals_at_location2, start_cars_at_location1, start_cars_at_location2)
-                        if final_cars_at_location1 < 0 or final_cars_at_location1 > 20 or final_cars_at_location2 < 0 or final_cars_at_location2 > 20:
-                            print(" ********** JacksCarRental.TransitionProbabilitiesAndRewards() **********")
-                            print("final_cars_at_location1 = {}; final_cars_at_location2 = {}".format(
-                                final_cars_at_location1, final_cars_at_location2))
-                            print("self.state = {}; action = {}".format(self.state, action))
-                            print("cars_at_location1 = {}; cars_at_location2 = {}".format(cars_at_location1,
-                                                                                          cars_at_location2))
-                            jacks_possible_moves = JacksPossibleMoves()
-                            legal_actions = jacks_possible_moves.LegalActions(self.state)
-                            print("legal_actions = {}".format(legal_actions))
-                            print("returns_at_location1 = {}".format(returns_at_location1))
-                            print("start_cars_at_location1 = {}".format(start_cars_at_location1))
-                            print("returns_at_location2 = {}".format(returns_at_location2))
-                            print("start_cars_at_location2 = {}".format(start_cars_at_location2))
-                            print("rentals_at_location1 = {}; actual_rentals_at_location1 = {}".format(
-                                rentals_at_location1, actual_rentals_at_location1))
-                            print("rentals_at_location2 = {}; actual_rentals_at_location2 = {}".format(
-                                rentals_at_location2, actual_rentals_at_location2))
-                            print("")
-                        transition_probabilities_arr[final_cars_at_location1, final_cars_at_location2] += probability
-                        final_state = self.StateFromCarsAtEachLocation(final_cars_at_location1, final_cars_at_location2)
-                        final_state_to_weighted_reward[final_state] += probability * reward
-
+        (transition_probabilities_arr, expected_rewards_arr) = self.TransitionArraysFromCars(cars_at_location1, cars_at_location2, action)
+        transition_probabilities_list = transition_probabilities_arr.ravel().tolist()
+        expected_rewards_list = expected_rewards_arr.ravel().tolist()
         state_to_probability_and_reward = {}
-        for new_state in self.StatesSet():
-            (final_cars_at_location1, final_cars_at_location2) = self.NumberOfCarsAtEachLocation(new_state)
-            transition_probability = transition_probabilities_arr[final_cars_at_location1, final_cars_at_location2]
-            expected_reward = 0
-            if transition_probability > 1e-9:
-                expected_reward = final_state_to_weighted_reward[new_state] / transition_probability
-            state_to_probability_and_reward[new_state] = (transition_probability, expected_reward)
+        for new_state in range(self.observation_space.n):  # new_state = 21 * final_cars_at_location1 + final_cars_at_location2
+            state_to_probability_and_reward[new_state] = (transition_probabilities_list[new_state], expected_rewards_list[new_state])
         return state_to_probability_and_reward
 
+    def TransitionArraysFromCars(self, cars_at_location1, cars_at_location2, action):
+        # Returns the (21, 21) arrays of the probabilities of the final numbers of cars (final_cars_at_location1, final_cars_at_location2),
+        # and of the expected rewards given these final numbers of cars
+        (location1_probabilities_arr, location1_weighted_rentals_arr,
+         location2_probabilities_arr, location2_weighted_rentals_arr) = self.LocationTransitionTables()
+        start_cars_at_location1 = min(max(cars_at_location1 - action, 0), 20)
+        start_cars_at_location2 = min(max(cars_at_location2 + action, 0), 20)
+        probabilities1 = location1_probabilities_arr[start_cars_at_location1]
+        probabilities2 = location2_probabilities_arr[start_cars_at_location2]
+        # The reward is a constant that depends on the moves and the start numbers of cars, plus the rental reward
+        reward_without_rentals = self.Reward(action, 0, 0, start_cars_at_location1, start_cars_at_location2)
+        transition_probabilities_arr = np.outer(probabilities1, probabilities2)
+        weighted_rewards_arr = reward_without_rentals * transition_probabilities_arr + self.rental_reward * (
+            np.outer(location1_weighted_rentals_arr[start_cars_at_location1], probabilities2) +
+            np.outer(probabilities1, location2_weighted_rentals_arr[start_cars_at_location2]))
+        expected_rewards_arr = np.zeros_like(transition_probabilities_arr)
+        np.divide(weighted_rewards_arr, transition_probabilities_arr, out=expected_rewards_arr, where=transition_probabilities_arr > 1e-9)
+        return (transition_probabilities_arr, expected_rewards_arr)
+
+    def LocationTransitionTables(self):
+        # Given the action, the two locations are independent. For each location and each start number of cars n (after the moves):
+        #   probabilities_arr[n, f]: The probability to end the day with f cars
+        #   weighted_rentals_arr[n, f]: The sum of probability * actual rentals over the outcomes that end the day with f cars
+        # The rentals and returns follow Poisson distributions truncated at poisson_maximum, as in the per-outcome enumeration
+        if self.location_transition_tables is None:
+            self.location_transition_tables = LocationTransitionTables(self.location1_rental_average, self.location1_return_average, self.poisson_maximum) + \
+                LocationTransitionTables(self.location2_rental_average, self.location2_return_average, self.poisson_maximum)
+        return self.location_transition_tables
+
+    def ComputeTransitionArrays(self):
+        """
+        Vectorized transition model of all the (state, action) pairs, with the actions of self.actions_list
+        Returns (transition_probabilities_arr, expected_rewards_arr), both of shape (441, 11, 441):
+            transition_probabilities_arr[s, a, s'] = p(s' | s, a)
+            expected_rewards_arr[s, a, s'] = E[reward | s, a, s'], as returned by ComputeTransitionProbabilitiesAndRewards()
+        """
+        (location1_probabilities_arr, location1_weighted_rentals_arr,
+         location2_probabilities_arr, location2_weighted_rentals_arr) = self.LocationTransitionTables()
+        number_of_states = self.observation_space.n
+        states_arr = np.arange(number_of_states)
+        cars_at_location1_arr = states_arr // 21
+        cars_at_location2_arr = states_arr % 21
+        transition_probabilities_arr = np.zeros((number_of_states, len(self.actions_list), number_of_states), dtype=float)
+        expected_rewards_arr = np.zeros((number_of_states, len(self.actions_list), number_of_states), dtype=float)
+        for actionNdx, action in enumerate(self.actions_list):
+            start_cars_at_location1_arr = np.clip(cars_at_location1_arr - action, 0, 20)
+            start_cars_at_location2_arr = np.clip(cars_at_location2_arr + action, 0, 20)
+            probabilities1_arr = location1_probabilities_arr[start_cars_at_location1_arr][:, :, None]  # (441, 21, 1)
+            probabilities2_arr = location2_probabilities_arr[start_cars_at_location2_arr][:, None, :]  # (441, 1, 21)
+            rewards_without_rentals_arr = self.Rewards(np.full(number_of_states, action), 0, 0, start_cars_at_location1_arr, start_cars_at_location2_arr)
+            action_probabilities_arr = probabilities1_arr * probabilities2_arr
+            weighted_rewards_arr = rewards_without_rentals_arr[:, None, None] * action_probabilities_arr + self.rental_reward * (
+                location1_weighted_rentals_arr[start_cars_at_location1_arr][:, :, None] * probabilities2_arr +
+                probabilities1_arr * location2_weighted_rentals_arr[start_cars_at_location2_arr][:, None, :])
+            action_rewards_arr = np.zeros_like(action_probabilities_arr)
+            np.divide(weighted_rewards_arr, action_probabilities_arr, out=action_rewards_arr, where=action_probabilities_arr > 1e-9)
+            transition_probabilities_arr[:, actionNdx, :] = action_probabilities_arr.reshape(number_of_states, number_of_states)
+            expected_rewards_arr[:, actionNdx, :] = action_rewards_arr.reshape(number_of_states, number_of_states)
+        return (transition_probabilities_arr, expected_rewards_arr)
+
+    def ModelParameters(self):
+        model_parameters = super().ModelParameters()
+        model_parameters.pop('location_transition_tables', None)  # None until the tables are built
+        return model_parameters
+
+    def ComputeCompiledModel(self, legal_actions_authority=None):
+        (transition_probabilities_arr, expected_rewards_arr) = self.ComputeTransitionArrays()
+        states_list = list(range(self.observation_space.n))
+        legal_actions_mask = env_compiled_model.LegalActionsMask(states_list, self.actions_list, legal_actions_authority)
+        transition_probabilities_arr = transition_probabilities_arr * legal_actions_mask[:, :, None]
+        transition_matrices = [transition_probabilities_arr[:, actionNdx, :] for actionNdx in range(len(self.actions_list))]
+        expected_rewards = np.sum(transition_probabilities_arr * expected_rewards_arr, axis=2)
+        return env_compiled_model.CompiledModel(states_list, self.actions_list, transition_matrices, expected_rewards, legal_actions_mask)
+
     def Reward(self, number_of_moves_from_location1_to_location2, actual_rentals_at_location1, actual_rentals_at_location2,
                start_cars_at_location1, start_cars_at_location2):
         if self.version == 'original':
@@ -188,6 +258,21 @@ class JacksCarRental(env_attributes.DynamicProgramming):
         else:
             raise NotImplementedError("JacksCarRental.Reward(): Not implemented version '{}'".format(self.version))
 
+    def Rewards(self, numbers_of_moves_from_location1_to_location2, actual_rentals_at_location1, actual_rentals_at_location2,
+                start_cars_at_location1, start_cars_at_location2):
+        # Vectorized Reward(): the arguments are arrays of the same shape
+        numbers_of_moves_arr = np.asarray(numbers_of_moves_from_location1_to_location2)
+        rentals_arr = np.asarray(actual_rentals_at_location1) + np.asarray(actual_rentals_at_location2)
+        if self.version == 'original':
+            return -self.cost_for_move * np.abs(numbers_of_moves_arr) + self.rental_reward * rentals_arr
+        elif self.version == 'exercise_4.4':
+            numbers_of_costly_moves_arr = np.where(numbers_of_moves_arr > 0, numbers_of_moves_arr - 1, numbers_of_moves_arr)  # One move from location1 to location2 is free
+            numbers_of_additional_parking_lots_arr = (np.asarray(start_cars_at_location1) > self.exercise_4_4_parking_limit).astype(int) + \
+                (np.asarray(start_cars_at_location2) > self.exercise_4_4_parking_limit)
+            return -self.cost_for_move * np.abs(numbers_of_costly_moves_arr) + self.rental_reward * rentals_arr + \
+                -self.exercise_4_4_additional_parking_cost * numbers_of_additional_parking_lots_arr
+        else:
+            raise NotImplementedError("JacksCarRental.Rewards(): Not implemented version '{}'".format(self.version))
 
 
 class JacksPossibleMoves(rl_policy.LegalActionsAuthority):
@@ -198,11 +283,17 @@ class JacksPossibleMoves(rl_policy.LegalActionsAuthority):
         (cars_at_location1, cars_at_location2) = JacksCarRental.NumberOfCarsAtEachLocation(state)
         minimum = max(-5, -cars_at_location2)
         maximum = min(5, cars_at_location1)
-        legal_actions_list = []
-        for moves in range(minimum, maximum + 1):
-            legal_actions_list.append(moves)
+        return frozenset(range(minimum, maximum + 1))
 
-        return set(legal_actions_list)
+    def LegalActionMask(self, states_list, actions_list):
+        states_arr = np.asarray(states_list, dtype=np.int64)
+        actions_arr = np.asarray(actions_list, dtype=np.int64)
+        minimums_arr = np.maximum(-5, -(states_arr % 21))
+        maximums_arr = np.minimum(5, states_arr // 21)
+        legal_actions_mask = (actions_arr[None, :] >= minimums_arr[:, None]) & (actions_arr[None, :] <= maximums_arr[:, None])
+        if np.any(np.sum(legal_actions_mask, axis=1) != maximums_arr - minimums_arr + 1):
+            raise ValueError("JacksPossibleMoves.LegalActionMask(): Some legal moves are not in the actions list")
+        return legal_actions_mask
 
 
 def Poisson(lambda_, n):
@@ -210,6 +301,25 @@ def Poisson(lambda_, n):
         return 0
     return pow(lambda_, n) * math.exp(-lambda_)/math.factorial(n)
 
+def LocationTransitionTables(rental_average, return_average, poisson_maximum):
+    # Returns (probabilities_arr, weighted_rentals_arr), of shape (21, 21), for a location.
+    # probabilities_arr[n, f]: The probability that a location that starts the day with n cars ends it with f cars
+    # weighted_rentals_arr[n, f]: The sum of probability * actual rentals over the outcomes (rentals, returns) that lead to f
+    rental_probabilities_arr = np.array([Poisson(rental_average, n) for n in range(poisson_maximum + 1)])
+    return_probabilities_arr = np.array([Poisson(return_average, n) for n in range(poisson_maximum + 1)])
+    start_cars_arr = np.arange(21)[:, None, None]  # (21, 1, 1)
+    rentals_arr = np.arange(poisson_maximum + 1)[None, :, None]  # (1, R, 1)
+    returns_arr = np.arange(poisson_maximum + 1)[None, None, :]  # (1, 1, R)
+    actual_rentals_arr = np.minimum(rentals_arr, start_cars_arr)  # (21, R, 1)
+    final_cars_arr = np.clip(start_cars_arr - actual_rentals_arr + returns_arr, 0, 20)  # (21, R, R)
+    outcome_probabilities_arr = np.broadcast_to(rental_probabilities_arr[None, :, None] * return_probabilities_arr[None, None, :], final_cars_arr.shape)
+    start_cars_index_arr = np.broadcast_to(start_cars_arr, final_cars_arr.shape)
+    probabilities_arr = np.zeros((21, 21), dtype=float)
+    weighted_rentals_arr = np.zeros((21, 21), dtype=float)
+    np.add.at(probabilities_arr, (start_cars_index_arr, final_cars_arr), outcome_probabilities_arr)
+    np.add.at(weighted_rentals_arr, (start_cars_index_arr, final_cars_arr), outcome_probabilities_arr * actual_rentals_arr)
+    return (probabilities_arr, weighted_rentals_arr)
+
 def ProbabilityOfDelta(returns_lambda, rentals_lambda, customers_delta, poisson_maximum=12):
     # customers_delta = returns - rentals
     probability = 0
@@ -0,0 +1,196 @@
+import ast
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse
+import ReinforcementLearning.environments.attributes as env_attributes
+import ReinforcementLearning.environments.compiled_model as env_compiled_model
+
+CACHE_FORMAT_VERSION = 1  # Increment when the layout of the cached files changes
+
+
+class ModelCache:
+    """
+    Content-addressed on-disk cache of CompiledModel objects.
+    The key is a digest of the environment class, its ModelParameters(), the legal actions authority and its simple
+    attributes, and a code version: the source of the modules that define the environment and the authority. Editing
+    these modules therefore invalidates their entries.
+    Each entry is a directory of .npy files (the stacked CSR transition matrix, the expected rewards and the legal
+    actions mask), loaded as read-only memory maps, and a metadata.json file with the states and actions lists.
+    When the total size exceeds maximum_size_in_bytes, the least recently used entries are deleted.
+    """
+    def __init__(self, directory=None, maximum_size_in_bytes=2**30):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'ReinforcementLearning', 'compiled_models')
+        self.directory = directory
+        self.maximum_size_in_bytes = maximum_size_in_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.number_of_hits = 0
+        self.number_of_misses = 0
+        self.number_of_evictions = 0
+
+    def Key(self, environment, legal_actions_authority=None):
+        if not isinstance(environment, env_attributes.DynamicProgramming):
+            raise TypeError("ModelCache.Key(): The environment type ({}) is not an instance of ReinforcementLearning.environments.attributes.DynamicProgramming".format(type(environment)))
+        description = [CACHE_FORMAT_VERSION,
+                       ClassIdentifier(type(environment)), sorted(environment.ModelParameters().items()), SourceDigest(type(environment))]
+        if legal_actions_authority is not None:
+            description += [ClassIdentifier(type(legal_actions_authority)),
+                            sorted(env_attributes.SimpleAttributes(legal_actions_authority).items()),
+                            SourceDigest(type(legal_actions_authority))]
+        return hashlib.sha256(repr(description).encode('utf-8')).hexdigest()
+
+    def Load(self, environment, legal_actions_authority=None):
+        # Returns the cached CompiledModel, or None
+        entry_directory = os.path.join(self.directory, self.Key(environment, legal_actions_authority))
+        if not os.path.isdir(entry_directory):
+            self.number_of_misses += 1
+            return None
+        try:
+            model = LoadEntry(entry_directory)
+        except (OSError, ValueError, SyntaxError, KeyError):  # Incomplete or corrupted entry
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            self.number_of_misses += 1
+            return None
+        os.utime(entry_directory)  # Mark the entry as recently used
+        self.number_of_hits += 1
+        return model
+
+    def Store(self, environment, model, legal_actions_authority=None):
+        if not isinstance(model, env_compiled_model.CompiledModel):
+            raise TypeError("ModelCache.Store(): The model type ({}) is not ReinforcementLearning.environments.compiled_model.CompiledModel".format(type(model)))
+        for (name, objects_list) in [('states', model.states_list), ('actions', model.actions_list)]:
+            if not ReprIsLiteral(objects_list):
+                raise ValueError("ModelCache.Store(): The {} cannot be stored, since their representation is not a Python literal".format(name))
+        key = self.Key(environment, legal_actions_authority)
+        entry_directory = os.path.join(self.directory, key)
+        temporary_directory = tempfile.mkdtemp(prefix='.tmp-' + key, dir=self.directory)
+        try:
+            StoreEntry(temporary_directory, model, environment)
+            if os.path.isdir(entry_directory):
+                shutil.rmtree(entry_directory)
+            os.rename(temporary_directory, entry_directory)  # Atomic: a reader never sees a partial entry
+        finally:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+        self.Evict()
+
+    def CompiledModel(self, environment, legal_actions_authority=None, number_of_processes=None):
+        # Returns the cached model, or compiles and stores it
+        model = self.Load(environment, legal_actions_authority)
+        if model is None:
+            model = env_compiled_model.Compile(environment, legal_actions_authority, number_of_processes)
+            self.Store(environment, model, legal_actions_authority)
+        return model
+
+    def Invalidate(self, environment, legal_actions_authority=None):
+        # Deletes the entry of the environment, if any. Returns True if an entry was deleted.
+        entry_directory = os.path.join(self.directory, self.Key(environment, legal_actions_authority))
+        if not os.path.isdir(entry_directory):
+            return False
+        shutil.rmtree(entry_directory)
+        return True
+
+    def Clear(self):
+        for entry_name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, entry_name), ignore_errors=True)
+
+    def Entries(self):
+        # Returns the list of (entry_directory, size_in_bytes, last_use_time), from the least recently used
+        entries_list = []
+        for entry_name in os.listdir(self.directory):
+            entry_directory = os.path.join(self.directory, entry_name)
+            if entry_name.startswith('.') or not os.path.isdir(entry_directory):
+                continue
+            try:
+                size_in_bytes = sum(os.path.getsize(os.path.join(entry_directory, filename)) for filename in os.listdir(entry_directory))
+                entries_list.append((entry_directory, size_in_bytes, os.path.getmtime(entry_directory)))
+            except OSError:  # Deleted concurrently
+                continue
+        entries_list.sort(key=lambda entry: entry[2])
+        return entries_list
+
+    def Size(self):
+        return sum(size_in_bytes for (_, size_in_bytes, _) in self.Entries())
+
+    def Evict(self):
+        # Deletes the least recently used entries until the total size is at most maximum_size_in_bytes.
+        # The most recent entry is kept, even if it exceeds the budget by itself.
+        entries_list = self.Entries()
+        total_size = sum(size_in_bytes for (_, size_in_bytes, _) in entries_list)
+        for (entry_directory, size_in_bytes, _) in entries_list[:-1]:
+            if total_size <= self.maximum_size_in_bytes:
+                break
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            total_size -= size_in_bytes
+            self.number_of_evictions += 1
+
+
+def StoreEntry(entry_directory, model, environment):
+    stacked_transition_matrix = model.StackedTransitionMatrix()
+    np.save(os.path.join(entry_directory, 'data.npy'), stacked_transition_matrix.data)
+    np.save(os.path.join(entry_directory, 'indices.npy'), stacked_transition_matrix.indices)
+    np.save(os.path.join(entry_directory, 'indptr.npy'), stacked_transition_matrix.indptr)
+    np.save(os.path.join(entry_directory, 'expected_rewards.npy'), model.expected_rewards)
+    np.save(os.path.join(entry_directory, 'legal_actions_mask.npy'), model.legal_actions_mask)
+    metadata = {'format_version': CACHE_FORMAT_VERSION,
+                'environment': ClassIdentifier(type(environment)),
+                'model_parameters': repr(sorted(environment.ModelParameters().items())),
+                'states_list': repr(model.states_list),
+                'actions_list': repr(model.actions_list)}
+    with open(os.path.join(entry_directory, 'metadata.json'), 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+
+def LoadEntry(entry_directory):
+    with open(os.path.join(entry_directory, 'metadata.json'), 'r') as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata['format_version'] != CACHE_FORMAT_VERSION:
+        raise ValueError("model_cache.LoadEntry(): Format version {} is not {}".format(metadata['format_version'], CACHE_FORMAT_VERSION))
+    states_list = ast.literal_eval(metadata['states_list'])
+    actions_list = ast.literal_eval(metadata['actions_list'])
+    data_arr = np.load(os.path.join(entry_directory, 'data.npy'), mmap_mode='r')
+    indices_arr = np.load(os.path.join(entry_directory, 'indices.npy'), mmap_mode='r')
+    indptr_arr = np.load(os.path.join(entry_directory, 'indptr.npy'), mmap_mode='r')
+    expected_rewards = np.load(os.path.join(entry_directory, 'expected_rewards.npy'), mmap_mode='r')
+    legal_actions_mask = np.load(os.path.join(entry_directory, 'legal_actions_mask.npy'), mmap_mode='r')
+    number_of_states = len(states_list)
+    number_of_actions = len(actions_list)
+    if len(indptr_arr) != number_of_actions * number_of_states + 1:
+        raise ValueError("model_cache.LoadEntry(): The length of indptr ({}) does not match {} states and {} actions".format(len(indptr_arr), number_of_states, number_of_actions))
+    # The per-action matrices are views of the stacked matrix: only their indptr is copied
+    transition_matrices = []
+    for actionNdx in range(number_of_actions):
+        first_row = actionNdx * number_of_states
+        start = indptr_arr[first_row]
+        end = indptr_arr[first_row + number_of_states]
+        transition_matrices.append(scipy.sparse.csr_matrix((data_arr[start: end], indices_arr[start: end],
+                                                            indptr_arr[first_row: first_row + number_of_states + 1] - start),
+                                                           shape=(number_of_states, number_of_states)))
+    model = env_compiled_model.CompiledModel(states_list, actions_list, transition_matrices, expected_rewards, legal_actions_mask)
+    model.stacked_transition_matrix = scipy.sparse.csr_matrix((data_arr, indices_arr, indptr_arr),
+                                                              shape=(number_of_actions * number_of_states, number_of_states))
+    return model
+
+def ClassIdentifier(cls):
+    return cls.__module__ + '.' + cls.__qualname__
+
+def SourceDigest(cls):
+    # The digest of the source file that defines the class
+    if cls not in _class_to_source_digest:
+        try:
+            with open(inspect.getsourcefile(cls), 'rb') as source_file:
+                _class_to_source_digest[cls] = hashlib.sha256(source_file.read()).hexdigest()
+        except (TypeError, OSError):  # Built-in or dynamically defined class
+            _class_to_source_digest[cls] = None
+    return _class_to_source_digest[cls]
+
+_class_to_source_digest = {}
+
+def ReprIsLiteral(objects_list):
+    try:
+        return ast.literal_eval(repr(objects_list)) == objects_list
+    except (ValueError, SyntaxError):
+        return False
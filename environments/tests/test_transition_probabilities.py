@@ -8,6 +8,7 @@ from ReinforcementLearning.environments import gamblers_problem
 from ReinforcementLearning.environments import frozen_lake
 import random
 import ast
+import numpy as np
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--randomSeed', help="The seed for the random module. Default: 0", type=int, default=0)
@@ -31,6 +32,27 @@ def main():
     logging.info("test_transition_probabilities.py  main()\t\tenvironment = {}\t\tlegalActionsAuthority = {}".format(args.environment, args.legalActionsAuthority))
 
 
+def SimulatedOccurrencesAndRewardSums(environment, state, action, number_of_trials, states_set):
+    # Returns (new_state_to_numberOfOccurrences, new_state_to_rewardSum). Environments with StepMany() simulate all the trials at once.
+    new_state_to_numberOfOccurrences = {s: 0 for s in states_set}
+    new_state_to_rewardSum = {s: 0 for s in states_set}
+    if hasattr(environment, 'StepMany'):
+        (new_states_arr, rewards_arr) = environment.StepMany(np.full(number_of_trials, state), np.full(number_of_trials, action))[:2]
+        (unique_new_states_arr, unique_inverse_arr) = np.unique(new_states_arr, return_inverse=True)
+        numbers_of_occurrences_arr = np.bincount(unique_inverse_arr)
+        reward_sums_arr = np.bincount(unique_inverse_arr, weights=rewards_arr)
+        for (new_state, number_of_occurrences, reward_sum) in zip(unique_new_states_arr.tolist(), numbers_of_occurrences_arr.tolist(), reward_sums_arr.tolist()):
+            new_state_to_numberOfOccurrences[new_state] += number_of_occurrences
+            new_state_to_rewardSum[new_state] += reward_sum
+    else:
+        for trialNdx in range(number_of_trials):
+            environment.SetState(state)
+            new_state, reward, done, info = environment.step(action)
+            new_state_to_numberOfOccurrences[new_state] += 1
+            new_state_to_rewardSum[new_state] += reward
+    return (new_state_to_numberOfOccurrences, new_state_to_rewardSum)
+
+
 if __name__ == '__main__':
     main()
 
@@ -80,13 +102,8 @@ if __name__ == '__main__':
         if args.action not in legal_actions:
             raise ValueError("main(): args.action ({}) is not in the legal actions set ({})".format(args.action, legal_actions))
 
-        new_state_to_numberOfOccurrences = {s: 0 for s in states_set}
-        new_state_to_rewardSum = {s: 0 for s in states_set}
-        for trialNdx in range(args.numberOfTrials):
-            environment.SetState(args.state)
-            new_state, reward, done, info = environment.step(args.action)
-            new_state_to_numberOfOccurrences[new_state] += 1
-            new_state_to_rewardSum[new_state] += reward
+        (new_state_to_numberOfOccurrences, new_state_to_rewardSum) = SimulatedOccurrencesAndRewardSums(
+            environment, args.state, args.action, args.numberOfTrials, states_set)
         simulated_new_state_to_probability_reward = {}
         for s in states_set:
             probability = new_state_to_numberOfOccurrences[s]/args.numberOfTrials
@@ -124,13 +141,8 @@ if __name__ == '__main__':
             logging.info("origin_state = {}".format(origin_state))
             legal_actions = legal_actions_authority.LegalActions(origin_state)
             for action in legal_actions:
-                new_state_to_numberOfOccurrences = {s: 0 for s in states_set}
-                new_state_to_rewardSum = {s: 0 for s in states_set}
-                for trialNdx in range(args.numberOfTrials):
-                    environment.SetState(origin_state)
-                    new_state, reward, done, info = environment.step(action)
-                    new_state_to_numberOfOccurrences[new_state] += 1
-                    new_state_to_rewardSum[new_state] += reward
+                (new_state_to_numberOfOccurrences, new_state_to_rewardSum) = SimulatedOccurrencesAndRewardSums(
+                    environment, origin_state, action, args.numberOfTrials, states_set)
                 simulated_new_state_to_probability_reward = {}
                 for s in states_set:
                     probability = new_state_to_numberOfOccurrences[s] / args.numberOfTrials
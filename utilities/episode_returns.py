@@ -0,0 +1,36 @@
+import numpy as np
+import scipy.signal
+
+VECTORIZED_MINIMUM_LENGTH = 512  # Below this length, the Python loop is faster than scipy.signal.lfilter()
+
+
+def Returns(rewards_list, gamma, bootstrap_value=0):
+    """
+    Returns the list of discounted returns [G_0, G_1, ..., G_T-1], with G_t = sum_k gamma^k rewards_list[t + k] + gamma^(T - t) bootstrap_value,
+    in a single backward pass: G_t = rewards_list[t] + gamma G_t+1, G_T = bootstrap_value
+    bootstrap_value: The estimated value of the state reached after the last reward, for an episode that was truncated
+    before reaching a terminal state. 0 for a complete episode.
+    Long episodes are filtered by scipy.signal.lfilter(), which computes the same recursion.
+    """
+    number_of_rewards = len(rewards_list)
+    if number_of_rewards >= VECTORIZED_MINIMUM_LENGTH:
+        return ReturnsArray(np.asarray(rewards_list, dtype=float), gamma, bootstrap_value).tolist()
+    returns_list = [0] * number_of_rewards
+    discounted_return = bootstrap_value
+    for rewardNdx in range(number_of_rewards - 1, -1, -1):
+        discounted_return = rewards_list[rewardNdx] + gamma * discounted_return
+        returns_list[rewardNdx] = discounted_return
+    return returns_list
+
+def ReturnsArray(rewards_arr, gamma, bootstrap_value=0):
+    # Returns() for a float array of rewards, as an array, with scipy.signal.lfilter() for the long arrays
+    if len(rewards_arr) < VECTORIZED_MINIMUM_LENGTH:
+        return np.array(Returns(rewards_arr.tolist(), gamma, bootstrap_value), dtype=float)
+    initial_conditions_arr = np.array([gamma * bootstrap_value], dtype=float)  # The filter's state before the last reward
+    (reversed_returns_arr, _) = scipy.signal.lfilter([1.], [1., -gamma], rewards_arr[::-1], zi=initial_conditions_arr)
+    return reversed_returns_arr[::-1]
+
+def EpisodeRewards(episode):
+    # episode = [reward0, obs0, action1, reward1, obs1, action2, reward2, obs2, ..., obsN-1]
+    # Returns [reward1, reward2, ..., rewardN-1], the rewards that follow the actions
+    return episode[3::3]
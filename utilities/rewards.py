@@ -1,23 +1,116 @@
+import math
+import statistics
 import numpy as np
 
 class RunningSum():
     def __init__(self):
         self.sum = 0
         self.count = 0
+        self.mean = 0
+        self.sum_of_squared_deviations = 0  # Welford's algorithm
 
     def Append(self, value):
         self.sum += value
         self.count += 1
+        deviation = value - self.mean
+        self.mean += deviation/self.count
+        self.sum_of_squared_deviations += deviation * (value - self.mean)
 
     def Average(self):
         if self.count < 1:
             raise ValueError("RunningSum.Average(): Attempt to call average when the count is 0")
         return self.sum/self.count
 
+    def Variance(self):
+        # The sample variance
+        if self.count < 2:
+            raise ValueError("RunningSum.Variance(): Attempt to call variance when the count ({}) is less than 2".format(self.count))
+        return self.sum_of_squared_deviations/(self.count - 1)
+
+    def StandardError(self):
+        # The standard deviation of the average
+        return math.sqrt(self.Variance()/self.count)
+
+
+class RunningStatistics():
+    """
+    Constant-memory estimators of the mean and the variance of number_of_estimators streams of values, stored in arrays.
+    step_size=None: The mean is the sample average and the variance is the sample variance, updated with Welford's algorithm.
+    Constant step_size: The mean and the variance are exponentially weighted, which tracks non-stationary streams.
+    """
+    def __init__(self, number_of_estimators, step_size=None, initial_mean=0):
+        if step_size is not None and not 0 < step_size <= 1:
+            raise ValueError("RunningStatistics.__init__(): The step size ({}) is not in (0, 1]".format(step_size))
+        self.step_size = step_size
+        self.counts = np.zeros(number_of_estimators, dtype=np.int64)
+        self.means = np.full(number_of_estimators, initial_mean, dtype=float)
+        self.sums_of_squared_deviations = np.zeros(number_of_estimators)  # With a constant step size: the weighted variances
+
+    def Append(self, indices, values):
+        # Appends values[i] to the stream indices[i]. The indices must be distinct.
+        indices_arr = np.asarray(indices, dtype=np.intp)
+        values_arr = np.asarray(values, dtype=float)
+        if indices_arr.shape != values_arr.shape:
+            raise ValueError("RunningStatistics.Append(): The shape of the indices {} doesn't match the shape of the values {}".format(indices_arr.shape, values_arr.shape))
+        if len(np.unique(indices_arr)) != len(indices_arr):
+            raise ValueError("RunningStatistics.Append(): The indices are not distinct")
+        self.counts[indices_arr] += 1
+        deviations_arr = values_arr - self.means[indices_arr]
+        if self.step_size is None:
+            self.means[indices_arr] += deviations_arr/self.counts[indices_arr]
+            self.sums_of_squared_deviations[indices_arr] += deviations_arr * (values_arr - self.means[indices_arr])
+        else:
+            self.means[indices_arr] += self.step_size * deviations_arr
+            self.sums_of_squared_deviations[indices_arr] = (1 - self.step_size) * (self.sums_of_squared_deviations[indices_arr] + self.step_size * deviations_arr**2)
+
+    def MergeSums(self, counts, sums, sums_of_squares):
+        # Merges the counts, sums and sums of squares of batches of values, one batch per stream, as if the values had been
+        # appended (Chan et al.'s parallel algorithm). Only for sample averages.
+        if self.step_size is not None:
+            raise ValueError("RunningStatistics.MergeSums(): Batches cannot be merged with a constant step size ({})".format(self.step_size))
+        counts_arr = np.asarray(counts, dtype=np.int64)
+        merged_mask = counts_arr > 0
+        batch_counts_arr = counts_arr[merged_mask]
+        batch_means_arr = np.asarray(sums, dtype=float)[merged_mask]/batch_counts_arr
+        batch_sums_of_squared_deviations_arr = np.maximum(np.asarray(sums_of_squares, dtype=float)[merged_mask] - batch_counts_arr * batch_means_arr**2, 0)
+        previous_counts_arr = self.counts[merged_mask]
+        self.counts[merged_mask] += batch_counts_arr
+        deviations_arr = batch_means_arr - self.means[merged_mask]
+        self.means[merged_mask] += deviations_arr * batch_counts_arr/self.counts[merged_mask]
+        self.sums_of_squared_deviations[merged_mask] += batch_sums_of_squared_deviations_arr + deviations_arr**2 * previous_counts_arr * batch_counts_arr/self.counts[merged_mask]
+
+    def Variances(self):
+        # nan for the streams that have less than 2 values
+        variances_arr = np.full(len(self.counts), np.nan)
+        counted_mask = self.counts >= 2
+        if self.step_size is None:
+            variances_arr[counted_mask] = self.sums_of_squared_deviations[counted_mask]/(self.counts[counted_mask] - 1)
+        else:
+            variances_arr[counted_mask] = self.sums_of_squared_deviations[counted_mask]
+        return variances_arr
+
+    def StandardErrors(self):
+        # The standard deviations of the means; inf for the streams that have less than 2 values
+        variances_arr = self.Variances()
+        standard_errors_arr = np.full(len(self.counts), np.inf)
+        counted_mask = self.counts >= 2
+        if self.step_size is None:
+            standard_errors_arr[counted_mask] = np.sqrt(variances_arr[counted_mask]/self.counts[counted_mask])
+        else:  # Stationary variance of an exponentially weighted average
+            standard_errors_arr[counted_mask] = np.sqrt(variances_arr[counted_mask] * self.step_size/(2 - self.step_size))
+        return standard_errors_arr
+
+    def ConfidenceHalfWidths(self, confidence_level=0.95):
+        # The half-widths of the normal confidence intervals of the means
+        if not 0 < confidence_level < 1:
+            raise ValueError("RunningStatistics.ConfidenceHalfWidths(): The confidence level ({}) is not in (0, 1)".format(confidence_level))
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence_level/2)
+        return z * self.StandardErrors()
+
 
 def Return(reward_list, gamma):
     discounted_sum = 0
     for rewardNdx in range(len(reward_list)):
         discount = pow(gamma, rewardNdx)
         discounted_sum += discount * reward_list[rewardNdx]
-    return discounted_sum
\ No newline at end of file
+    return discounted_sum